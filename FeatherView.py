@@ -1,100 +1,700 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import time
+
+launch = time.perf_counter()
+
+import os
+import sys
+
+if __name__ == "__main__":
+    if "--batch" in sys.argv:
+        # Batch exports never open a window, so none of the viewer is imported
+        from batch import main
+
+        sys.exit(main(sys.argv[1:]))
+
+    # Handing the file to a running viewer must not pay for importing PyQt5
+    from singleinstance import handoff
+
+    if handoff(sys.argv):
+        sys.exit(0)
+
 from PyQt5 import QtWidgets, QtCore, QtGui
 from qlabelextended import QLabelExtended
-import os
+from imageloader import ImageLoader
+from imagecache import ImageCache
+from viewstate import ViewStateStore, ConfigSignals, ConfigTask, read_config
+from tilepyramid import PreviewPyramid, IDENTITY, orient_image, oriented_size
+from sources import SOURCE_ERRORS, absolute, exists, first_image, is_url, is_virtual, split_member, list_archive, \
+    natural_key
+from tonemap import ArrayPyramid, ARRAY_EXTENSIONS
+from profiler import profiler, StartupTimer
 import json
-import sip
-import sys
 
 
-sip.setapi("QVariant", 2)
+startup = StartupTimer(launch)
+startup.mark("imports")
 
 
 class FeatherView(QtWidgets.QMainWindow):
     draw_image = QtCore.pyqtSignal()
 
-    def __init__(self, file_name, directory, sep):
+    def __init__(self, file_name, directory, sep, single_instance=False):
         super(FeatherView, self).__init__()
 
         self.sep = sep
         self.directory = directory
         self.file_name = file_name
+        self.single_instance = single_instance
+        self.server = None
+        self.watcher = None
+        self.reloading = False
+        self.reload_pending = None
+        self.player = None
+        self.group = None
+        self.compare_waiting = {}
+        self.compare_pyramids = {}
+        self.inspector = None
+        self.annotations = None
+        self.started = False
 
         self.main_layout = None
         self.view = None
-        self.qpixmap = None
+        self.pyramid = None
+        # Absolute name of the file self.pyramid was decoded from, None for frames and remembered previews
+        self.pyramid_file = None
         self.initUI()
+        self.view.first_frame.connect(self.after_first_frame)
+        self.loader = ImageLoader(self)
+        self.loader.preview_ready.connect(self.show_preview)
+        self.loader.image_ready.connect(self.show_image)
+        self.loader.failed.connect(self.show_error)
+        self.loader.prefetched.connect(self.store_prefetched)
+        self.loader.prefetch_failed.connect(self.prefetch_failed)
+        self.cache = ImageCache()
+        self.files = [absolute(file_name)]
+        self.index = 0
         self.draw_image.connect(self.open_file, type=QtCore.Qt.QueuedConnection)
         self.draw_image.emit()
-        self.controls = dict()
 
         home = os.path.expanduser("~")
-        if not os.path.isdir(home + sep + ".config"):
-            os.mkdir(home + sep + ".config")
-        if not os.path.isdir(home + sep + ".config" + sep + "FeatherView"):
-            os.mkdir(home + sep + ".config" + sep + "FeatherView")
         self.home = home + sep + ".config" + sep + "FeatherView" + sep
-        with open(self.home + "config", 'r', 1) as file:
-            try:
-                self.controls = json.load(file)
-            except json.JSONDecodeError:
-                pass
+        self.view_states = ViewStateStore(self.home + "views.sqlite")
+
+        # The defaults apply until the config file has been read off the GUI thread, which is usually after the
+        # first decode has started, so that one runs with the default loader settings
+        self.config_loaded = False
+        self.apply_config(dict())
+        self.config_signals = ConfigSignals(self)
+        self.config_signals.loaded.connect(self.config_arrived)
+        QtCore.QThreadPool.globalInstance().start(ConfigTask(self.home + "config", self.config_signals))
+
+    def config_arrived(self, controls):
+        self.config_loaded = True
+        self.apply_config(controls)
 
+    def apply_config(self, controls):
+        self.controls = controls
         try:
             self.setGeometry(0, 0, self.controls['size'][0], self.controls['size'][1])
-        except KeyError:
+        except (KeyError, IndexError, TypeError):
             pass
 
-        try:
-            if self.controls['maximized']:
-                self.showMaximized()
-        except KeyError:
-            pass
+        if self.controls.get('maximized'):
+            self.showMaximized()
+
+        self.cache.max_bytes = self.controls.get('cache_megabytes', 1024) * 1024 * 1024
+        self.prefetch_count = self.controls.get('prefetch', 2)
+        # Images that would decode to more than this are kept as compressed tiles, spilling to disk past the budget,
+        # and at most decode_megabytes of them are decoded at once
+        megabyte = 1024 * 1024
+        self.loader.store = (self.controls.get('tile_store_threshold_megabytes', 1024) * megabyte,
+                             self.controls.get('tile_store_megabytes', 512) * megabyte,
+                             self.controls.get('tile_store_hot_megabytes', 128) * megabyte,
+                             self.controls.get('decode_megabytes', 2048) * megabyte)
+        # Embedded color profiles are converted to the display profile, sRGB unless an ICC file is configured
+        self.loader.colors = None
+        if self.controls.get('color_management', True):
+            from colormanagement import color_manager
+
+            self.loader.colors = color_manager(self.controls.get('display_profile'))
+
+    def after_first_frame(self):
+        startup.mark("first frame")
+        self.start_deferred()
+
+    def start_deferred(self):
+        """
+        Work that the first frame does not need: the window icon, the directory listing used for navigation, the
+        config directory and the single-instance server.  It also runs when the first file fails to open, so there
+        is still a listing to browse away from it.
+        :return:
+        """
+        if self.started:
+            return
+        self.started = True
+        app_icon = QtGui.QIcon()
+        app_icon.addFile(self.sep.join([self.directory, "feather.svg"]))
+        self.setWindowIcon(app_icon)
+
+        self.list_directory(self.file_name)
+        self.prefetch_neighbours()
+        self.ensure_home()
+        if self.single_instance:
+            from singleinstance import InstanceServer
+
+            self.server = InstanceServer(self.open_path)
+            QtWidgets.QApplication.instance().aboutToQuit.connect(self.server.shutdown)
+        startup.mark("deferred")
+        startup.finish()
+
+    def ensure_home(self):
+        home = os.path.expanduser("~")
+        if not os.path.isdir(home + self.sep + ".config"):
+            os.mkdir(home + self.sep + ".config")
+        if not os.path.isdir(self.home):
+            os.mkdir(self.home)
+
+    def list_directory(self, file_name):
+        member = split_member(file_name)
+        if member is not None:
+            # The pages of an archive are the siblings of each other
+            try:
+                self.files = list_archive(member[0], image_extensions())
+            except SOURCE_ERRORS:
+                self.files = []
+        elif is_url(file_name):
+            self.files = []
+        else:
+            self.files = image_files(os.path.dirname(os.path.abspath(file_name)))
+        self.index = self.find_index(file_name)
 
     def mouseMoveEvent(self, event):
         if self.view is not None:
             self.view.mouseMoveEvent(event)
 
     def initUI(self):
-        self.view = QLabelExtended(self)
+        self.panel = QtWidgets.QWidget(self)
+        self.grid = QtWidgets.QGridLayout(self.panel)
+        self.grid.setContentsMargins(0, 0, 0, 0)
+        self.grid.setSpacing(2)
+        self.view = QLabelExtended(self.panel)
         self.view.setMouseTracking(True)
-        self.setCentralWidget(self.view)
+        self.grid.addWidget(self.view, 0, 0)
+        self.views = [self.view]
+        self.sheet = None
+        self.stack = QtWidgets.QStackedWidget(self)
+        self.stack.addWidget(self.panel)
+        self.setCentralWidget(self.stack)
+
+    def toggle_contact_sheet(self):
+        """
+        Switches between the image and a thumbnail grid of the images in its directory
+        :return:
+        """
+        if self.sheet is None:
+            from contactsheet import ContactSheet
+
+            self.ensure_home()
+            self.sheet = ContactSheet(self.home + "thumbnails",
+                                      cache_bytes=self.controls.get('thumbnail_cache_megabytes', 512) * 1024 * 1024)
+            self.sheet.activated.connect(self.open_from_sheet)
+            self.stack.addWidget(self.sheet)
+        if self.stack.currentWidget() is self.sheet:
+            self.stack.setCurrentWidget(self.panel)
+        else:
+            self.stack.setCurrentWidget(self.sheet)
+            self.sheet.set_files(self.files, self.index)
+            self.sheet.setFocus()
+
+    def open_from_sheet(self, index):
+        self.stack.setCurrentWidget(self.panel)
+        self.navigate(index)
+
+    def compare(self, file_names):
+        """
+        Shows up to four images side by side with zoom and pan locked together.  The first one is the current file,
+        and files that are already decoded, or named more than once, share one pyramid and its tile cache.
+        :param file_names:
+        :return:
+        """
+        from viewgroup import ViewGroup
+
+        file_names = [absolute(file_name) for file_name in file_names[:4]]
+        columns = 2 if len(file_names) == 4 else len(file_names)
+        self.group = ViewGroup(self)
+        self.group.add(self.view)
+        for position, file_name in enumerate(file_names[1:], 1):
+            view = QLabelExtended(self.panel)
+            view.setMouseTracking(True)
+            self.grid.addWidget(view, position // columns, position % columns)
+            self.group.add(view)
+            self.views.append(view)
+            self.show_in(view, file_name)
+        self.setWindowTitle(" | ".join(os.path.basename(file_name) for file_name in file_names))
+
+    def show_in(self, view, file_name):
+        pyramid = self.cache.get(file_name)
+        if pyramid is not None:
+            self.attach(view, pyramid)
+            return
+        self.compare_waiting.setdefault(file_name, []).append(view)
+        if file_name != absolute(self.file_name):
+            # The current file is already being decoded by open_file
+            self.loader.prefetch(file_name)
+
+    def attach(self, view, pyramid):
+        # Views only hold weak references, and the cache may evict the pyramid
+        self.compare_pyramids[view] = pyramid
+        view.initialize(pyramid)
+        if self.view.qpixmap_ref() is not None:
+            view.set_relative_view(self.view.relative_view())
+        view.request_frame(full=True)
+
+    def attach_waiting(self, file_name, pyramid):
+        for view in self.compare_waiting.pop(file_name, []):
+            self.attach(view, pyramid)
+
+    def toggle_inspector(self):
+        """
+        Shows or hides the pixel readout and the histogram of the visible area
+        :return:
+        """
+        if self.inspector is None:
+            from inspector import InspectorPanel
+
+            self.inspector = InspectorPanel(self.view, self.panel)
+            self.place_inspector()
+        self.inspector.setVisible(not self.inspector.isVisible())
+        if self.inspector.isVisible():
+            self.inspector.raise_()
+            self.inspector.refresh()
+
+    def toggle_annotations(self):
+        """
+        Shows or hides the boxes, points and polylines of the annotation sidecar of the current file
+        :return:
+        """
+        if self.annotations is None:
+            from annotations import AnnotationOverlay
+
+            self.annotations = AnnotationOverlay(self)
+            self.annotations.changed.connect(self.view.update)
+            self.view.hovered.connect(self.hover_annotation)
+        if self.view.overlay is None:
+            self.view.overlay = self.annotations
+            self.annotations.show_file(absolute(self.file_name))
+        else:
+            self.view.overlay = None
+            QtWidgets.QToolTip.hideText()
+        self.view.request_frame(full=True)
+
+    def hover_annotation(self, x, y):
+        if self.view.overlay is None:
+            return
+        if self.annotations.hover(x, y, 6 / self.view.image_scale()):
+            label = self.annotations.label()
+            if label:
+                QtWidgets.QToolTip.showText(QtGui.QCursor.pos(), label, self.view)
+            else:
+                QtWidgets.QToolTip.hideText()
+            self.view.update()
+
+    def place_inspector(self):
+        if self.inspector is not None:
+            self.inspector.move(self.view.geometry().right() - self.inspector.width() - 8,
+                                self.view.geometry().top() + 8)
+
+    def find_index(self, file_name):
+        file_name = absolute(file_name)
+        if file_name not in self.files:
+            self.files.append(file_name)
+            self.files.sort(key=natural_key)
+        return self.files.index(file_name)
 
     def open_file(self):
-        qimage = QtGui.QImage()
-        qimage.load(self.file_name)
-        size = qimage.size()
-        self.qpixmap = QtGui.QPixmap(size.width(), size.height())
-        self.qpixmap.convertFromImage(qimage)
-        self.view.initialize(self.qpixmap)
+        self.stop_playback()
+        self.loader.cancel_prefetch()
+        self.reloading = False
+        self.reload_pending = None
+        for file_name in self.compare_waiting:
+            if file_name != absolute(self.file_name):
+                self.loader.prefetch(file_name)
+        pyramid = self.cache.get(absolute(self.file_name))
+        if pyramid is not None:
+            self.view.initialize(pyramid)
+            self.pyramid = pyramid
+            self.pyramid_file = absolute(self.file_name)
+            self.attach_waiting(absolute(self.file_name), pyramid)
+        else:
+            preview_size = int(max(self.view.width(), self.view.height()) * self.devicePixelRatioF())
+            if self.show_remembered(absolute(self.file_name)):
+                preview_size = 0
+            self.loader.load(self.file_name, preview_size=preview_size)
+        if self.view.overlay is not None:
+            self.view.overlay.show_file(absolute(self.file_name))
+        self.prefetch_neighbours()
+
+    def show_remembered(self, file_name):
+        """
+        Paints the stored preview of a file at its last zoom and pan while the full decode runs
+        :param file_name:
+        :return: True when there was something to show
+        """
+        import sqlite3
+
+        try:
+            state = self.view_states.get(file_name)
+        except (sqlite3.Error, OSError):
+            return False
+        if state is None or state["preview"] is None:
+            return False
+        pyramid = PreviewPyramid(state["preview"], state["width"], state["height"])
+        self.view.initialize(pyramid)
+        self.pyramid = pyramid
+        self.pyramid_file = None
+        self.view.set_relative_view(state["view"])
+        self.view.request_frame(full=True)
+        return True
+
+    def remember(self):
+        """
+        Stores the zoom and pan of the current file, and a preview of it the first time.  Both are stored with the
+        EXIF orientation applied, the way the view works, and nothing is stored for a view the user has turned.
+        :return:
+        """
+        pyramid = self.pyramid
+        if (pyramid is None or isinstance(pyramid, PreviewPyramid) or self.player is not None or
+                self.view.qpixmap_ref() is not pyramid or is_virtual(self.file_name) or
+                self.view.extra_orientation != IDENTITY):
+            return
+        import sqlite3
+
+        file_name = absolute(self.file_name)
+        try:
+            preview = None
+            if not self.view_states.has_preview(file_name):
+                preview = orient_image(pyramid.tile_image(pyramid.level_count() - 1, 0, 0), pyramid.orientation)
+            width, height = oriented_size(pyramid.orientation, pyramid.width, pyramid.height)
+            image_format = bytes(QtGui.QImageReader(file_name).format()).decode()
+            self.view_states.put(file_name, width, height, image_format, self.view.relative_view(), preview)
+        except (sqlite3.Error, OSError):
+            pass
+
+    def open_path(self, file_name):
+        """
+        Opens a file handed over by another launch, switching the sibling listing to its directory, or to the pages
+        of the archive it names
+        :param file_name:
+        :return:
+        """
+        file_name = first_image(file_name, image_extensions())
+        if file_name is None or not exists(file_name):
+            return
+        self.list_directory(file_name)
+        index = self.index
+        self.index = -1
+        self.navigate(index)
+        if self.isMinimized():
+            self.showNormal()
+        self.raise_()
+        self.activateWindow()
+
+    def watch(self, path):
+        """
+        Follows a file that is still being written, or the newest image in a directory, redrawing it as it changes
+        :param path:
+        :return:
+        """
+        if self.watcher is None:
+            from filewatcher import FileWatcher
+
+            self.watcher = FileWatcher(extensions=image_extensions(), parent=self)
+            self.watcher.changed.connect(self.reload)
+        self.watcher.watch(path)
+
+    def toggle_watch(self):
+        if self.watcher is not None and self.watcher.file_name is not None:
+            self.watcher.stop()
+        else:
+            self.watch(self.file_name)
+
+    def reload(self, file_name):
+        """
+        Shows the new contents of a watched file keeping the zoom and pan.  One reload runs at a time and changes
+        that arrive meanwhile are folded into the next one, so a slow decode cannot starve the display.
+        :param file_name:
+        :return:
+        """
+        if self.reloading:
+            self.reload_pending = file_name
+            return
+        self.reloading = True
+        previous = None
+        if absolute(file_name) == self.pyramid_file:
+            # Only an earlier version of the same file has work worth reusing; a first decode that failed leaves
+            # the pyramid of another file on screen
+            previous = self.pyramid
+        if absolute(file_name) != absolute(self.file_name):
+            self.file_name = file_name
+            self.index = self.find_index(file_name)
+            self.setWindowTitle(self.file_name[self.file_name.rfind(self.sep) + 1:])
+        self.loader.cancel_prefetch()
+        self.loader.reload(file_name, previous)
+
+    def reload_finished(self):
+        self.reloading = False
+        if self.reload_pending is not None:
+            file_name, self.reload_pending = self.reload_pending, None
+            self.reload(file_name)
+
+    def playback_source(self):
+        """
+        The frames of the current file when it is animated or has several pages, otherwise the numbered sequence
+        it belongs to
+        :return: a source for Player, or None
+        """
+        from playback import AnimationSource, SequenceSource, sequence_files
+
+        if is_virtual(self.file_name):
+            # Opening a URL here would block the GUI thread on the network, so the count of its decode is used
+            count = self.pyramid.frame_count if self.pyramid is not None else 1
+        else:
+            count = QtGui.QImageReader(self.file_name).imageCount()
+        if count > 1:
+            return AnimationSource(self.file_name, count)
+        files = sequence_files(self.file_name, self.files)
+        if len(files) > 1:
+            return SequenceSource(files, self.controls.get('sequence_fps', 24.))
+        return None
+
+    def start_player(self, play=True):
+        from playback import Player, SequenceSource
+
+        source = self.playback_source()
+        if source is None:
+            return False
+        self.player = Player(source, capacity=self.controls.get('playback_frames', 16), parent=self)
+        self.player.frame_changed.connect(self.show_frame)
+        if isinstance(source, SequenceSource):
+            self.player.index = source.files.index(absolute(self.file_name))
+        if play:
+            self.player.play()
+        return True
+
+    def toggle_playback(self):
+        if self.player is None:
+            self.start_player()
+        else:
+            self.player.toggle()
+
+    def step_frame(self, delta):
+        if self.player is None and not self.start_player(play=False):
+            return
+        self.player.step(delta)
+
+    def stop_playback(self):
+        if self.player is not None:
+            self.player.stop()
+            self.player.deleteLater()
+            self.player = None
+
+    def show_frame(self, index, pyramid):
+        from playback import SequenceSource
+
+        self.view.replace(pyramid)
+        self.pyramid = pyramid
+        self.pyramid_file = None
+        source = self.player.source
+        if isinstance(source, SequenceSource):
+            self.file_name = source.files[index]
+            self.index = self.find_index(self.file_name)
+            self.setWindowTitle(self.file_name[self.file_name.rfind(self.sep) + 1:])
+
+    def prefetch_neighbours(self):
+        for offset in range(1, self.prefetch_count + 1):
+            for index in (self.index + offset, self.index - offset):
+                if 0 <= index < len(self.files) and self.files[index] not in self.cache:
+                    self.loader.prefetch(self.files[index])
+
+    def navigate(self, index):
+        """
+        Shows the sibling file at index in the directory listing, from the cache when it has been prefetched
+        :param index:
+        :return:
+        """
+        index = min(max(index, 0), len(self.files) - 1)
+        if index == self.index:
+            return
+        self.remember()
+        if self.pyramid is not None:
+            self.pyramid.clear_tiles()
+        self.index = index
+        self.file_name = self.files[index]
+        self.setWindowTitle(self.file_name[self.file_name.rfind(self.sep) + 1:])
+        self.open_file()
+
+    def show_preview(self, file_name, pyramid):
+        self.view.initialize(pyramid)
+        self.pyramid = pyramid
+        self.pyramid_file = absolute(file_name)
+
+    def show_image(self, file_name, pyramid):
+        pyramid.adopt_tiles()
+        self.view.replace(pyramid)
+        self.pyramid = pyramid
+        self.pyramid_file = absolute(file_name)
+        self.cache.put(absolute(file_name), pyramid)
+        self.attach_waiting(absolute(file_name), pyramid)
+        if self.reloading:
+            self.reload_finished()
+        elif self.player is None and not is_virtual(file_name):
+            # Every GIF supports animation, so only files with more than one frame start playing on their own
+            reader = QtGui.QImageReader(file_name)
+            if reader.supportsAnimation() and reader.imageCount() > 1:
+                self.start_player()
+
+    def store_prefetched(self, file_name, pyramid):
+        self.cache.put(file_name, pyramid)
+        self.attach_waiting(file_name, pyramid)
+
+    def prefetch_failed(self, file_name, message):
+        if self.compare_waiting.pop(file_name, None) is not None:
+            print("Cannot open file: " + message)
+
+    def show_error(self, file_name, message):
+        if self.reloading:
+            # A file caught halfway through being written; the next change will bring the rest
+            self.reload_finished()
+            return
+        print("Cannot open file: " + message)
+        self.compare_waiting.pop(absolute(file_name), None)
+        self.start_deferred()
 
     def keyPressEvent(self, event):
-        self.view.keyPressEvent(event)
+        if event.key() == QtCore.Qt.Key_T:
+            self.toggle_contact_sheet()
+        elif self.sheet is not None and self.stack.currentWidget() is self.sheet:
+            if event.key() == QtCore.Qt.Key_Escape:
+                self.toggle_contact_sheet()
+        elif isinstance(self.pyramid, ArrayPyramid) and event.key() in TONE_KEYS:
+            self.adjust_tone(event.key())
+        elif event.key() == QtCore.Qt.Key_PageDown:
+            self.navigate(self.index + 1)
+        elif event.key() == QtCore.Qt.Key_PageUp:
+            self.navigate(self.index - 1)
+        elif event.key() == QtCore.Qt.Key_Home:
+            self.navigate(0)
+        elif event.key() == QtCore.Qt.Key_End:
+            self.navigate(len(self.files) - 1)
+        elif event.key() == QtCore.Qt.Key_W:
+            self.toggle_watch()
+        elif event.key() == QtCore.Qt.Key_H:
+            self.toggle_inspector()
+        elif event.key() == QtCore.Qt.Key_N:
+            self.toggle_annotations()
+        elif event.key() == QtCore.Qt.Key_Space:
+            self.toggle_playback()
+        elif event.key() == QtCore.Qt.Key_Comma:
+            self.step_frame(-1)
+        elif event.key() == QtCore.Qt.Key_Period:
+            self.step_frame(1)
+        else:
+            self.view.keyPressEvent(event)
+
+    def adjust_tone(self, key):
+        """
+        A auto-contrasts on what is on screen, [ and ] narrow and widen the window, ; and ' move it down and up and
+        G cycles the gamma.  Only the visible tiles are mapped again.
+        :param key:
+        :return:
+        """
+        tone = self.pyramid.tone
+        if key == QtCore.Qt.Key_A:
+            level = self.pyramid.level_for(self.view.get_magnification())
+            self.pyramid.auto_contrast(level, self.view.return_viewport())
+        elif key == QtCore.Qt.Key_BracketLeft:
+            tone.window(0.9)
+        elif key == QtCore.Qt.Key_BracketRight:
+            tone.window(1 / 0.9)
+        elif key == QtCore.Qt.Key_Semicolon:
+            tone.shift(-0.05)
+        elif key == QtCore.Qt.Key_Apostrophe:
+            tone.shift(0.05)
+        elif key == QtCore.Qt.Key_G:
+            tone.cycle_gamma()
+        self.pyramid.retone()
+        self.view.request_frame(full=True)
 
     def resizeEvent(self, event):
         super(FeatherView, self).resizeEvent(event)
         if self.view is not None:
-            self.view.resetView()
+            for view in self.views:
+                view.resetView()
+            # The layout moves the view after this event, so the panel follows once it has
+            QtCore.QTimer.singleShot(0, self.place_inspector)
 
     def closeEvent(self, closeEvent):
+        if not self.config_loaded:
+            # Closed before the config arrived, so the defaults in use must not overwrite the user's settings
+            self.controls = read_config(self.home + "config")
         size = self.size()
         self.controls['size'] = [size.width(), size.height()]
         self.controls['maximized'] = self.isMaximized()
+        self.ensure_home()
         with open(self.home + "config", 'w') as file:
             json.dump(self.controls, file, indent=2, sort_keys=True)
+        self.remember()
+        self.view_states.close()
+        profiler.dump()
 
         closeEvent.accept()
 
 
+TONE_KEYS = (QtCore.Qt.Key_A, QtCore.Qt.Key_BracketLeft, QtCore.Qt.Key_BracketRight, QtCore.Qt.Key_Semicolon,
+             QtCore.Qt.Key_Apostrophe, QtCore.Qt.Key_G)
+
+
+def image_extensions():
+    extensions = set("." + bytes(fmt).decode().lower() for fmt in QtGui.QImageReader.supportedImageFormats())
+    extensions.update(ARRAY_EXTENSIONS)
+    return extensions
+
+
+def image_files(directory):
+    """
+    Lists the files in directory that Qt has an image reader for, in natural sort order
+    :param directory:
+    :return:
+    """
+    extensions = image_extensions()
+    files = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+            files.append(entry.path)
+    files.sort(key=natural_key)
+    return files
+
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith("--")]
+    if len(arguments) < 1:
         print("No file do open")
-    elif not os.path.isfile(sys.argv[1]):
+    elif not exists(arguments[0]) and not ("--watch" in sys.argv and os.path.isdir(arguments[0])):
+        print("Cannot open file")
+    elif not all(exists(argument) for argument in arguments[1:]):
         print("Cannot open file")
     else:
+        # High DPI attributes only take effect when set before the QApplication is created
+        QtWidgets.QApplication.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling, True)
+        QtWidgets.QApplication.setAttribute(QtCore.Qt.AA_UseHighDpiPixmaps, True)
+        if hasattr(QtGui.QGuiApplication, "setHighDpiScaleFactorRoundingPolicy"):
+            # Qt 5.14+: keep fractional scales such as 1.5 instead of rounding them, so device pixels map exactly
+            QtGui.QGuiApplication.setHighDpiScaleFactorRoundingPolicy(
+                QtCore.Qt.HighDpiScaleFactorRoundingPolicy.PassThrough)
         app = QtWidgets.QApplication(sys.argv)
-        QtWidgets.QApplication.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling, on=QtCore.Qt.Checked)
+        startup.mark("qapplication")
 
         directory = os.path.dirname(__file__)
         if os.name == 'nt':
@@ -102,11 +702,24 @@ if __name__ == "__main__":
         else:
             sep = '/'
 
-        name = sys.argv[1]
-        main_app = FeatherView(name, directory=directory, sep=sep)
-        app_icon = QtGui.QIcon()
-        app_icon.addFile(sep.join([directory, "feather.svg"]))
-        main_app.setWindowIcon(app_icon)
+        name = arguments[0]
+        if os.path.isdir(name):
+            files = image_files(name)
+            name = max(files, key=os.path.getmtime) if files else None
+        else:
+            # An archive opens at its first page
+            name = first_image(name, image_extensions())
+        others = [first_image(argument, image_extensions()) for argument in arguments[1:]]
+        if name is None or None in others:
+            print("No file do open")
+            sys.exit(1)
+        main_app = FeatherView(name, directory=directory, sep=sep, single_instance="--new-window" not in sys.argv)
         main_app.setWindowTitle(name[name.rfind(sep) + 1:])
+        if "--watch" in sys.argv:
+            main_app.watch(arguments[0])
+        elif others:
+            main_app.compare([name] + others)
+        startup.mark("window")
         main_app.show()
+        startup.mark("show")
         sys.exit(app.exec_())
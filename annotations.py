@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+Boxes, points and polylines read from a sidecar next to the image, <image>.annotations.json or
+<image>.annotations.csv, in full resolution image coordinates.
+
+    {"annotations": [{"box": [x, y, width, height], "label": "car"},
+                     {"point": [x, y], "label": "seed"},
+                     {"polyline": [[x, y], [x, y], ...], "label": "edge"}]}
+
+CSV sidecars have a header row with x, y and optionally width, height and label columns; rows with a width and
+height are boxes, the others points.
+"""
+from PyQt5 import QtGui, QtCore
+from collections import OrderedDict
+import csv
+import json
+import math
+import os
+
+
+BOX = 0
+POINT = 1
+POLYLINE = 2
+SIDECAR_SUFFIXES = (".annotations.json", ".annotations.csv")
+CLUSTER_PIXELS = 48
+
+
+class QuadNode(object):
+    __slots__ = ("x0", "y0", "x1", "y1", "items", "children", "count", "center_x", "center_y")
+
+
+class QuadTree(object):
+    """
+    Bulk loaded loose quadtree over bounding boxes.  An item goes to the quadrant holding its center, so every item
+    ends up in a leaf, and the bounds of each node grow to cover the items below it.  Every node also holds the number
+    of items below it and their centroid, which is what gets drawn for a node too small on screen to show its items
+    one by one.
+    """
+
+    def __init__(self, bounds, capacity=32, max_depth=16):
+        """
+        :param bounds: list of (x0, y0, x1, y1), one per item
+        :param capacity: most items in a leaf above max_depth
+        :param max_depth:
+        """
+        self.bounds = bounds
+        self.capacity = capacity
+        self.max_depth = max_depth
+        if bounds:
+            extent = (min(b[0] for b in bounds), min(b[1] for b in bounds),
+                      max(b[2] for b in bounds), max(b[3] for b in bounds))
+        else:
+            extent = (0., 0., 0., 0.)
+        self.root = self.build(list(range(len(bounds))), extent, 0)
+
+    def build(self, indices, extent, depth):
+        """
+        :param indices: items whose centers lie in extent
+        :param extent: (x0, y0, x1, y1) of the quadrant that is split, which the bounds of the node may overhang
+        :param depth:
+        :return: QuadNode
+        """
+        node = QuadNode()
+        node.children = []
+        node.count = len(indices)
+        node.center_x = node.center_y = 0.
+        node.x0, node.y0, node.x1, node.y1 = extent
+        bounds = self.bounds
+        if indices:
+            node.x0 = min(bounds[i][0] for i in indices)
+            node.y0 = min(bounds[i][1] for i in indices)
+            node.x1 = max(bounds[i][2] for i in indices)
+            node.y1 = max(bounds[i][3] for i in indices)
+            node.center_x = sum(bounds[i][0] + bounds[i][2] for i in indices) / (2. * len(indices))
+            node.center_y = sum(bounds[i][1] + bounds[i][3] for i in indices) / (2. * len(indices))
+        if len(indices) <= self.capacity or depth >= self.max_depth:
+            node.items = indices
+            return node
+
+        x0, y0, x1, y1 = extent
+        middle_x = (x0 + x1) / 2.
+        middle_y = (y0 + y1) / 2.
+        node.items = []
+        quadrants = ([], [], [], [])
+        for index in indices:
+            x_min, y_min, x_max, y_max = bounds[index]
+            column = 1 if x_min + x_max >= 2 * middle_x else 0
+            row = 2 if y_min + y_max >= 2 * middle_y else 0
+            quadrants[row + column].append(index)
+        extents = ((x0, y0, middle_x, middle_y), (middle_x, y0, x1, middle_y),
+                   (x0, middle_y, middle_x, y1), (middle_x, middle_y, x1, y1))
+        for quadrant, quadrant_extent in zip(quadrants, extents):
+            if quadrant:
+                node.children.append(self.build(quadrant, quadrant_extent, depth + 1))
+        return node
+
+    def query(self, x0, y0, x1, y1):
+        """
+        :return: indices of the items whose bounds intersect the rectangle
+        """
+        bounds = self.bounds
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.x0 > x1 or node.x1 < x0 or node.y0 > y1 or node.y1 < y0:
+                continue
+            for index in node.items:
+                b = bounds[index]
+                if b[0] <= x1 and b[2] >= x0 and b[1] <= y1 and b[3] >= y0:
+                    yield index
+            stack.extend(node.children)
+
+
+class AnnotationLayer(object):
+    """
+    The annotations of one image with a QuadTree over their bounds
+    """
+
+    def __init__(self, kinds, shapes, labels):
+        """
+        :param kinds: BOX, POINT or POLYLINE per annotation
+        :param shapes: (x0, y0, x1, y1) for boxes, (x, y) for points and a list of (x, y) for polylines
+        :param labels:
+        """
+        self.kinds = kinds
+        self.shapes = shapes
+        self.labels = labels
+        self.bounds = [shape_bounds(kind, shape) for kind, shape in zip(kinds, shapes)]
+        self.tree = QuadTree(self.bounds)
+        self.simplified = OrderedDict()
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def visible(self, viewport, cell):
+        """
+        Walks the quadtree down to the viewport, stopping at nodes whose items all fit in a cell.  Only items larger
+        than a cell, or alone in their leaf, are returned one by one.
+        :param viewport: (x, y, width, height) in image coordinates
+        :param cell: size in image coordinates below which a node is drawn as a cluster
+        :return: (indices of the annotations to draw, (count, x, y) of the clusters)
+        """
+        x0, y0 = viewport[0], viewport[1]
+        x1, y1 = x0 + viewport[2], y0 + viewport[3]
+        bounds = self.bounds
+        items = []
+        clusters = []
+        stack = [self.tree.root]
+        while stack:
+            node = stack.pop()
+            if node.count == 0 or node.x0 > x1 or node.x1 < x0 or node.y0 > y1 or node.y1 < y0:
+                continue
+            if node.count > 1 and max(node.x1 - node.x0, node.y1 - node.y0) < cell:
+                clusters.append((node.count, node.center_x, node.center_y))
+                continue
+            for index in node.items:
+                b = bounds[index]
+                if b[0] <= x1 and b[2] >= x0 and b[1] <= y1 and b[3] >= y0:
+                    items.append(index)
+            stack.extend(node.children)
+        return items, clusters
+
+    def hit(self, x, y, tolerance):
+        """
+        :return: index of the annotation nearest to x, y within tolerance, or None
+        """
+        best = None
+        best_distance = tolerance
+        for index in self.tree.query(x - tolerance, y - tolerance, x + tolerance, y + tolerance):
+            distance = shape_distance(self.kinds[index], self.shapes[index], x, y)
+            if distance <= best_distance:
+                best = index
+                best_distance = distance
+        return best
+
+    def polyline(self, index, tolerance, limit=4096):
+        """
+        A polyline with the vertices closer than tolerance to the last one kept dropped.  Tolerances are rounded
+        down to powers of two so the simplified polylines can be cached.
+        :param index:
+        :param tolerance: in image coordinates, about a screen pixel
+        :param limit: most simplified polylines cached
+        :return: QPolygonF
+        """
+        step = int(math.floor(math.log(max(tolerance, 1e-6), 2)))
+        key = (index, step)
+        polygon = self.simplified.get(key)
+        if polygon is not None:
+            self.simplified.move_to_end(key)
+            return polygon
+        tolerance = 2. ** step
+        points = self.shapes[index]
+        kept = [points[0]]
+        for x, y in points[1:-1]:
+            if abs(x - kept[-1][0]) >= tolerance or abs(y - kept[-1][1]) >= tolerance:
+                kept.append((x, y))
+        kept.append(points[-1])
+        polygon = self.simplified[key] = QtGui.QPolygonF([QtCore.QPointF(x, y) for x, y in kept])
+        while len(self.simplified) > limit:
+            self.simplified.popitem(last=False)
+        return polygon
+
+
+def shape_bounds(kind, shape):
+    if kind == BOX:
+        return shape
+    if kind == POINT:
+        return shape[0], shape[1], shape[0], shape[1]
+    xs = [x for x, _ in shape]
+    ys = [y for _, y in shape]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def shape_distance(kind, shape, x, y):
+    """
+    Distance from x, y to a point or polyline, or to a box, which is 0 inside it
+    """
+    if kind == BOX:
+        return math.hypot(max(shape[0] - x, 0, x - shape[2]), max(shape[1] - y, 0, y - shape[3]))
+    if kind == POINT:
+        return math.hypot(x - shape[0], y - shape[1])
+    return min(segment_distance(a, b, x, y) for a, b in zip(shape[:-1], shape[1:]))
+
+
+def segment_distance(a, b, x, y):
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length = dx * dx + dy * dy
+    t = 0. if length == 0 else min(max(((x - a[0]) * dx + (y - a[1]) * dy) / length, 0.), 1.)
+    return math.hypot(x - a[0] - t * dx, y - a[1] - t * dy)
+
+
+def sidecar(file_name):
+    for suffix in SIDECAR_SUFFIXES:
+        if os.path.isfile(file_name + suffix):
+            return file_name + suffix
+    return None
+
+
+def load_layer(file_name):
+    """
+    :param file_name: image file
+    :return: AnnotationLayer, or None when the image has no sidecar
+    """
+    path = sidecar(file_name)
+    if path is None:
+        return None
+    kinds = []
+    shapes = []
+    labels = []
+    if path.endswith(".json"):
+        with open(path, 'r') as file:
+            entries = json.load(file)
+        if isinstance(entries, dict):
+            entries = entries.get("annotations", [])
+        for entry in entries:
+            if "box" in entry:
+                x, y, width, height = [float(value) for value in entry["box"]]
+                kinds.append(BOX)
+                shapes.append((x, y, x + width, y + height))
+            elif "point" in entry:
+                kinds.append(POINT)
+                shapes.append((float(entry["point"][0]), float(entry["point"][1])))
+            elif "polyline" in entry and len(entry["polyline"]) > 1:
+                kinds.append(POLYLINE)
+                shapes.append([(float(point[0]), float(point[1])) for point in entry["polyline"]])
+            else:
+                continue
+            labels.append(str(entry.get("label", "")))
+    else:
+        with open(path, 'r', newline='') as file:
+            for row in csv.DictReader(file):
+                x, y = float(row["x"]), float(row["y"])
+                if row.get("width") and row.get("height"):
+                    kinds.append(BOX)
+                    shapes.append((x, y, x + float(row["width"]), y + float(row["height"])))
+                else:
+                    kinds.append(POINT)
+                    shapes.append((x, y))
+                labels.append(row.get("label") or "")
+    return AnnotationLayer(kinds, shapes, labels)
+
+
+class AnnotationSignals(QtCore.QObject):
+    loaded = QtCore.pyqtSignal(str, object)
+
+
+class AnnotationTask(QtCore.QRunnable):
+    """
+    Reads a sidecar and builds its quadtree off the GUI thread.  A missing or damaged sidecar loads as no layer.
+    """
+
+    def __init__(self, file_name, signals):
+        super(AnnotationTask, self).__init__()
+        self.file_name = file_name
+        self.signals = signals
+
+    def run(self):
+        try:
+            layer = load_layer(self.file_name)
+        except (OSError, ValueError, TypeError, KeyError, IndexError, AttributeError):
+            layer = None
+        self.signals.loaded.emit(self.file_name, layer)
+
+
+class AnnotationOverlay(QtCore.QObject):
+    """
+    Draws the annotations of the current file over QLabelExtended.  Only what the quadtree returns for the viewport
+    is drawn, and nodes whose annotations fit in CLUSTER_PIXELS on screen are drawn as one marker with their number,
+    so the markers drawn are bounded by the screen area rather than the number of annotations.  Annotations larger
+    than that are drawn one by one.
+    """
+    changed = QtCore.pyqtSignal()
+
+    def __init__(self, parent=None, limit=8):
+        super(AnnotationOverlay, self).__init__(parent)
+        self.file_name = None
+        self.layer = None
+        self.highlight = None
+        self.layers = OrderedDict()
+        self.limit = limit
+        self.pen = QtGui.QPen(QtGui.QColor(255, 200, 0), 0)
+        self.highlight_pen = QtGui.QPen(QtGui.QColor(0, 220, 255), 2)
+        self.highlight_pen.setCosmetic(True)
+        self.signals = AnnotationSignals(self)
+        self.signals.loaded.connect(self.on_loaded)
+
+    def show_file(self, file_name):
+        self.file_name = file_name
+        self.highlight = None
+        if file_name in self.layers:
+            self.layers.move_to_end(file_name)
+            self.layer = self.layers[file_name]
+            self.changed.emit()
+            return
+        self.layer = None
+        QtCore.QThreadPool.globalInstance().start(AnnotationTask(file_name, self.signals))
+
+    @QtCore.pyqtSlot(str, object)
+    def on_loaded(self, file_name, layer):
+        self.layers[file_name] = layer
+        while len(self.layers) > self.limit:
+            self.layers.popitem(last=False)
+        if file_name == self.file_name:
+            self.layer = layer
+            self.changed.emit()
+
+    def hover(self, x, y, tolerance):
+        """
+        :param x:
+        :param y:
+        :param tolerance: in image coordinates
+        :return: True when the highlighted annotation changed
+        """
+        highlight = self.layer.hit(x, y, tolerance) if self.layer is not None else None
+        changed = highlight != self.highlight
+        self.highlight = highlight
+        return changed
+
+    def label(self):
+        if self.layer is None or self.highlight is None:
+            return ""
+        return self.layer.labels[self.highlight]
+
+    def paint(self, painter, view):
+        layer = self.layer
+        if layer is None or len(layer) == 0:
+            return
+        transform = view.image_transform()
+        scale = view.image_scale()
+        items, clusters = layer.visible(view.return_viewport(), CLUSTER_PIXELS / scale)
+
+        painter.save()
+        painter.setRenderHint(QtGui.QPainter.Antialiasing, True)
+        painter.setTransform(transform)
+        painter.setBrush(QtCore.Qt.NoBrush)
+        painter.setPen(self.pen)
+        for index in items:
+            self.draw(painter, layer, index, scale)
+        if self.highlight is not None:
+            painter.setPen(self.highlight_pen)
+            self.draw(painter, layer, self.highlight, scale)
+
+        painter.resetTransform()
+        painter.setPen(QtCore.Qt.black)
+        painter.setBrush(QtGui.QColor(255, 200, 0, 180))
+        for count, x, y in clusters:
+            center = transform.map(QtCore.QPointF(x, y))
+            radius = 8 + 4 * math.log10(count)
+            painter.drawEllipse(center, radius, radius)
+            painter.drawText(QtCore.QRectF(center.x() - radius, center.y() - radius, 2 * radius, 2 * radius),
+                             QtCore.Qt.AlignCenter, str(count))
+        painter.restore()
+
+    def draw(self, painter, layer, index, scale):
+        kind = layer.kinds[index]
+        shape = layer.shapes[index]
+        if kind == BOX:
+            painter.drawRect(QtCore.QRectF(QtCore.QPointF(shape[0], shape[1]), QtCore.QPointF(shape[2], shape[3])))
+        elif kind == POINT:
+            radius = 4 / scale
+            painter.drawEllipse(QtCore.QPointF(shape[0], shape[1]), radius, radius)
+        else:
+            painter.drawPolyline(layer.polyline(index, 1 / scale))
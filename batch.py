@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Headless export of a region of many images, without opening a window.  The crop is given in full resolution image
+pixels, the coordinates QLabelExtended.convert and return_viewport use, and files are processed in parallel with one
+image per worker process in memory at a time.
+
+    python3 FeatherView.py --batch --crop 1200,800,1024,768 --scale 0.5 --format png --output crops/ *.tif
+"""
+from PyQt5 import QtGui, QtCore
+from mappedimage import map_image
+import argparse
+import math
+import multiprocessing
+import os
+import sys
+
+
+def parse_crop(text):
+    """
+    :param text: "x,y,width,height", fractions allowed
+    :return: QRect covering the region, rounded outwards
+    """
+    x, y, width, height = [float(value) for value in text.split(",")]
+    left = int(math.floor(x))
+    top = int(math.floor(y))
+    return QtCore.QRect(left, top, int(math.ceil(x + width)) - left, int(math.ceil(y + height)) - top)
+
+
+def output_name(file_name, output, image_format):
+    """
+    Mirrors the path of the input below output and keeps its extension, so a/img.tif, b/img.tif and a/img.png each
+    get an export of their own
+    :param file_name:
+    :param output:
+    :param image_format:
+    :return: a/img.tif becomes output/a/img.tif.png
+    """
+    relative = os.path.relpath(os.path.abspath(file_name))
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        # Outside the working directory the absolute path is mirrored instead, without its root
+        relative = os.path.splitdrive(os.path.abspath(file_name))[1].lstrip(os.sep)
+    return os.path.join(output, relative + "." + image_format.lower())
+
+
+def export(job):
+    """
+    Crops, scales and saves one file.  Runs in a worker process.  Errors are returned rather than raised, so one
+    missing or unreadable file does not stop the run.
+    :param job: (file_name, crop as (x, y, width, height) or None, scale, image_format, quality, output)
+    :return: (file_name, error message or None)
+    """
+    try:
+        return crop_and_save(*job)
+    except (OSError, ValueError, MemoryError) as error:
+        return job[0], str(error) or type(error).__name__
+
+
+def crop_and_save(file_name, crop, scale, image_format, quality, output):
+    target = output_name(file_name, output, image_format)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    mapped = map_image(file_name)
+    if mapped is not None:
+        # Only the pages under the crop are read from disk
+        bounds = mapped.qimage.rect()
+        rect = QtCore.QRect(*crop).intersected(bounds) if crop is not None else bounds
+        if rect.isEmpty():
+            return file_name, "crop is outside the image"
+        if mapped.flipped:
+            rect.moveTop(bounds.height() - rect.y() - rect.height())
+            qimage = mapped.qimage.copy(rect).mirrored(False, True)
+        else:
+            qimage = mapped.qimage.copy(rect)
+        if scale != 1:
+            qimage = qimage.scaled(max(1, int(round(rect.width() * scale))),
+                                   max(1, int(round(rect.height() * scale))),
+                                   QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+    else:
+        reader = QtGui.QImageReader(file_name)
+        size = reader.size()
+        if not size.isValid():
+            return file_name, reader.errorString()
+        rect = QtCore.QRect(QtCore.QPoint(0, 0), size)
+        if crop is not None:
+            rect = QtCore.QRect(*crop).intersected(rect)
+        if rect.isEmpty():
+            return file_name, "crop is outside the image"
+        # Readers that support it, JPEG among them, decode only the clip and scale while decoding
+        reader.setClipRect(rect)
+        if scale != 1:
+            reader.setScaledSize(QtCore.QSize(max(1, int(round(rect.width() * scale))),
+                                              max(1, int(round(rect.height() * scale)))))
+        qimage = reader.read()
+        if qimage.isNull():
+            return file_name, reader.errorString()
+    if not qimage.save(target, image_format.upper(), quality):
+        return file_name, "cannot write " + target
+    return file_name, None
+
+
+def collect_files(paths, list_file=None):
+    """
+    Yields the files named on the command line, the image files in directories named there, and the lines of
+    list_file, without reading all of them first
+    :param paths:
+    :param list_file:
+    :return:
+    """
+    extensions = set("." + bytes(fmt).decode().lower() for fmt in QtGui.QImageReader.supportedImageFormats())
+    for path in paths:
+        if os.path.isdir(path):
+            for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                    yield entry.path
+        else:
+            yield path
+    if list_file is not None:
+        with open(list_file, 'r') as file:
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="FeatherView.py --batch",
+                                     description="Export a region of many images without opening a window")
+    parser.add_argument("files", nargs="*", help="image files, or directories of them")
+    parser.add_argument("--list", help="file with one image path per line")
+    parser.add_argument("--crop", help="region as x,y,width,height in full resolution pixels; the whole image "
+                                       "when left out")
+    parser.add_argument("--scale", type=float, default=1., help="scale applied after cropping")
+    parser.add_argument("--format", default="png", help="output format, e.g. png, jpg, tif")
+    parser.add_argument("--quality", type=int, default=-1, help="output quality for lossy formats, 0 to 100")
+    parser.add_argument("--output", required=True, help="directory the exports are written to")
+    parser.add_argument("--jobs", type=int, default=0, help="worker processes, all cores by default")
+    parser.add_argument("--skip-existing", action="store_true", help="leave files that were already exported")
+    arguments = parser.parse_args([argument for argument in argv if argument != "--batch"])
+
+    if not os.path.isdir(arguments.output):
+        os.makedirs(arguments.output)
+    crop = None
+    if arguments.crop:
+        rect = parse_crop(arguments.crop)
+        crop = (rect.x(), rect.y(), rect.width(), rect.height())
+
+    def jobs():
+        for file_name in collect_files(arguments.files, arguments.list):
+            if arguments.skip_existing and os.path.exists(output_name(file_name, arguments.output,
+                                                                      arguments.format)):
+                continue
+            yield file_name, crop, arguments.scale, arguments.format, arguments.quality, arguments.output
+
+    processes = arguments.jobs or multiprocessing.cpu_count()
+    done = 0
+    failed = 0
+    # Recycling workers keeps heap fragmentation from big decodes from piling up over a long run
+    pool = multiprocessing.Pool(processes, maxtasksperchild=500)
+    try:
+        for file_name, error in pool.imap_unordered(export, jobs(), chunksize=4):
+            done += 1
+            if error is not None:
+                failed += 1
+                sys.stderr.write("%s: %s\n" % (file_name, error))
+    finally:
+        pool.close()
+        pool.join()
+    print("Exported %d of %d files" % (done - failed, done))
+    return 1 if failed else 0
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless benchmark of the QLabelExtended zoom/pan pipeline.  Every image size runs in its own process so the peak
+RSS reported belongs to that size alone.  Results are written as JSON so runs of different releases can be diffed.
+The open time covers decoding a JPEG of the test image as well as building its pyramid and painting the first frame.
+A size of N megapixels needs about 5.5 N MB while it is open, so 1000 only fits on machines with 8 GB or more.
+
+    python3 benchmark.py --sizes 1,16,100 --output results.json
+"""
+import os
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5 import QtWidgets, QtCore, QtGui
+from qlabelextended import QLabelExtended
+from tilepyramid import TilePyramid
+import argparse
+import json
+import math
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def synthetic_image(megapixels):
+    """
+    Paints a square test image with a gradient and a grid of circles, so the downscaled levels are not flat
+    :param megapixels:
+    :return:
+    """
+    side = int(math.sqrt(megapixels * 1e6))
+    qimage = QtGui.QImage(side, side, QtGui.QImage.Format_RGB32)
+    gradient = QtGui.QLinearGradient(0, 0, side, side)
+    gradient.setColorAt(0, QtGui.QColor(20, 40, 160))
+    gradient.setColorAt(1, QtGui.QColor(230, 180, 30))
+
+    painter = QtGui.QPainter(qimage)
+    painter.fillRect(qimage.rect(), QtGui.QBrush(gradient))
+    painter.setPen(QtGui.QPen(QtCore.Qt.white, 2))
+    step = 64
+    for y in range(0, side, step * 8):
+        for x in range(0, side, step * 8):
+            painter.drawEllipse(x, y, step * 4, step * 4)
+    painter.end()
+    return qimage
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024. / 1024.
+    return peak / 1024.
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def pick(fraction):
+        return samples[min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))]
+
+    return {"count": len(samples), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": samples[-1]}
+
+
+def frame(app, view):
+    """
+    Runs one frame the way the event loop would and returns its duration in milliseconds
+    :param app:
+    :param view:
+    :return:
+    """
+    start = time.perf_counter()
+    view.render_frame()
+    app.processEvents()
+    return (time.perf_counter() - start) * 1000
+
+
+def wheel(view, delta):
+    position = QtCore.QPointF(view.width() / 2., view.height() / 2.)
+    return QtGui.QWheelEvent(position, view.mapToGlobal(position.toPoint()), QtCore.QPoint(0, 0),
+                             QtCore.QPoint(0, delta), QtCore.Qt.NoButton, QtCore.Qt.NoModifier,
+                             QtCore.Qt.NoScrollPhase, False)
+
+
+def run_size(megapixels, frames, width, height):
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    view = QLabelExtended()
+    view.resize(width, height)
+    view.show()
+    app.processEvents()
+
+    # The test image is written out first, so it is freed before the timed decode reads it back
+    directory = tempfile.mkdtemp()
+    file_name = os.path.join(directory, "benchmark.jpg")
+    synthetic_image(megapixels).save(file_name, "JPEG", 90)
+
+    start = time.perf_counter()
+    qimage = QtGui.QImageReader(file_name).read()
+    decode_ms = (time.perf_counter() - start) * 1000
+    os.remove(file_name)
+    os.rmdir(directory)
+    pyramid = TilePyramid(qimage)
+    pyramid.build_levels()
+    view.initialize(pyramid)
+    view.repaint()
+    open_ms = (time.perf_counter() - start) * 1000
+
+    center = QtCore.QPoint(width // 2, height // 2)
+    results = {"zoom": [], "pan": [], "reset": [], "settled": []}
+    for index in range(frames):
+        view.zoom(1.1 if (index // 20) % 2 == 0 else 1 / 1.1, center)
+        results["zoom"].append(frame(app, view))
+    for index in range(frames):
+        view.wheelEvent(wheel(view, -120 if (index // 20) % 2 == 0 else 120))
+        results["pan"].append(frame(app, view))
+    for index in range(frames):
+        view.zoom(2.0, center)
+        app.processEvents()
+        view.resetView()
+        results["reset"].append(frame(app, view))
+    for index in range(frames):
+        view.zoom(1.01 if index % 2 == 0 else 1 / 1.01, center)
+        view.settle()
+        results["settled"].append(frame(app, view))
+
+    return {"megapixels": megapixels,
+            "width": qimage.width(),
+            "height": qimage.height(),
+            "decode_ms": decode_ms,
+            "open_ms": open_ms,
+            "peak_rss_mb": peak_rss_mb(),
+            "frame_ms": dict((name, percentiles(samples)) for name, samples in results.items())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FeatherView rendering offscreen")
+    parser.add_argument("--sizes", default="1,16,100",
+                        help="comma separated image sizes in megapixels; each needs about 5.5 MB per megapixel")
+    parser.add_argument("--frames", type=int, default=200, help="frames measured per scenario")
+    parser.add_argument("--window", default="1920x1080", help="widget size as WIDTHxHEIGHT")
+    parser.add_argument("--output", help="file to write the JSON report to instead of stdout")
+    parser.add_argument("--single", type=float, help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    width, height = [int(value) for value in arguments.window.lower().split("x")]
+
+    if arguments.single is not None:
+        print(json.dumps(run_size(arguments.single, arguments.frames, width, height)))
+        return
+
+    results = []
+    for megapixels in [float(value) for value in arguments.sizes.split(",")]:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--single", str(megapixels),
+                                          "--frames", str(arguments.frames), "--window", arguments.window])
+        results.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+
+    report = {"python": platform.python_version(),
+              "qt": QtCore.QT_VERSION_STR,
+              "pyqt": QtCore.PYQT_VERSION_STR,
+              "platform": os.environ["QT_QPA_PLATFORM"],
+              "window": [width, height],
+              "results": results}
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
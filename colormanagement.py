@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtGui
+from tilepyramid import image_bytes
+from collections import OrderedDict
+import hashlib
+import importlib.util
+import threading
+
+
+LUT_SIZE = 33
+# Bands are bounded by pixels rather than rows, as apply_lut makes a dozen float temporaries the size of a band
+BAND_PIXELS = 1024 * 1024
+
+
+class ColorManager(object):
+    """
+    Converts images from their embedded color profile to the display profile.  Qt is asked once per source profile
+    to convert a LUT_SIZE ** 3 grid of colors, and images are then mapped through that grid with trilinear
+    interpolation in NumPy on the decode thread, or tile by tile as stored pyramids are cut.  Grids are kept by a hash of the profile, so a folder of photos from one
+    camera pays for one.
+    """
+
+    def __init__(self, display=None, limit=16):
+        """
+        :param display: QColorSpace of the display, sRGB when None
+        :param limit: most lookup tables kept
+        """
+        self.display = display if display is not None else QtGui.QColorSpace(QtGui.QColorSpace.SRgb)
+        self.limit = limit
+        self.luts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lut(self, source):
+        """
+        :param source: QColorSpace of an image
+        :return: float32 array of shape (LUT_SIZE, LUT_SIZE, LUT_SIZE, 3) indexed by red, green and blue
+        """
+        profile = bytes(source.iccProfile())
+        if profile:
+            key = hashlib.sha1(profile).hexdigest()
+        else:
+            key = (int(source.primaries()), int(source.transferFunction()), source.gamma())
+        with self.lock:
+            lut = self.luts.get(key)
+            if lut is not None:
+                self.luts.move_to_end(key)
+                return lut
+            lut = self.luts[key] = build_lut(source, self.display)
+            while len(self.luts) > self.limit:
+                self.luts.popitem(last=False)
+            return lut
+
+    def conversion(self, source):
+        """
+        :param source: QColorSpace of an image
+        :return: ColorConversion to the display, or None when the image has no profile or already matches
+        """
+        if not source.isValid() or source == self.display:
+            return None
+        return ColorConversion(self, source)
+
+
+class ColorConversion(object):
+    """
+    Converts the pixels of one image to the display color space.  The lookup table is only looked up when the first
+    pixels are converted.
+    """
+
+    def __init__(self, manager, source):
+        self.manager = manager
+        self.source = source
+        self.lut = None
+
+    def convert(self, qimage):
+        """
+        Safe to call from decode threads
+        :param qimage: converted in place when it is already 32-bit and its pixels are not shared
+        :return: qimage in the display color space
+        """
+        import numpy as np
+
+        if self.lut is None:
+            self.lut = self.manager.lut(self.source)
+        image_format = QtGui.QImage.Format_ARGB32 if qimage.hasAlphaChannel() else QtGui.QImage.Format_RGB32
+        if qimage.format() != image_format:
+            qimage = qimage.convertToFormat(image_format)
+        # bits() only copies the pixels when another QImage shares them
+        bits = qimage.bits()
+        bits.setsize(image_bytes(qimage))
+        pixels = np.frombuffer(bits, np.uint32).reshape(qimage.height(), qimage.bytesPerLine() // 4)
+        pixels = pixels[:, :qimage.width()]
+        rows = max(1, BAND_PIXELS // max(1, qimage.width()))
+        for top in range(0, qimage.height(), rows):
+            band = pixels[top:top + rows]
+            rgb = np.stack([(band >> 16) & 255, (band >> 8) & 255, band & 255], axis=-1).astype(np.uint8)
+            mapped = apply_lut(rgb, self.lut).astype(np.uint32)
+            band[...] = (band & 0xff000000) | (mapped[..., 0] << 16) | (mapped[..., 1] << 8) | mapped[..., 2]
+        qimage.setColorSpace(self.manager.display)
+        return qimage
+
+
+def build_lut(source, display):
+    import numpy as np
+
+    size = LUT_SIZE
+    levels = np.round(np.arange(size) * (255. / (size - 1))).astype(np.uint32)
+    red, green, blue = np.meshgrid(levels, levels, levels, indexing="ij")
+    grid = QtGui.QImage(size, size * size, QtGui.QImage.Format_RGB32)
+    bits = grid.bits()
+    bits.setsize(image_bytes(grid))
+    pixels = np.frombuffer(bits, np.uint32).reshape(size * size, grid.bytesPerLine() // 4)
+    pixels[:, :size] = (0xff000000 | (red << 16) | (green << 8) | blue).reshape(size * size, size)
+    grid.setColorSpace(source)
+    grid = grid.convertedToColorSpace(display).convertToFormat(QtGui.QImage.Format_RGB32)
+
+    bits = grid.constBits()
+    bits.setsize(image_bytes(grid))
+    pixels = np.frombuffer(bits, np.uint32).reshape(size * size, grid.bytesPerLine() // 4)[:, :size]
+    pixels = pixels.reshape(size, size, size)
+    return np.stack([(pixels >> 16) & 255, (pixels >> 8) & 255, pixels & 255], axis=-1).astype(np.float32)
+
+
+def apply_lut(rgb, lut):
+    """
+    :param rgb: uint8 array of shape (..., 3)
+    :param lut: array of shape (n, n, n, 3)
+    :return: uint8 array of the shape of rgb
+    """
+    import numpy as np
+
+    size = lut.shape[0]
+    last = size - 1
+    scaled = rgb.astype(np.float32) * (last / 255.)
+    index = np.minimum(scaled.astype(np.intp), last - 1)
+    fraction = scaled - index
+    fr, fg, fb = fraction[..., 0:1], fraction[..., 1:2], fraction[..., 2:3]
+    # One flat index and offsets to the corners of its cell, so each corner is a single take along the first axis
+    table = lut.reshape(-1, 3)
+    base = (index[..., 0] * size + index[..., 1]) * size + index[..., 2]
+
+    def corner(red, green, blue):
+        return np.take(table, base + (red * size + green) * size + blue, axis=0)
+
+    c00 = corner(0, 0, 0)
+    c00 += (corner(1, 0, 0) - c00) * fr
+    c01 = corner(0, 0, 1)
+    c01 += (corner(1, 0, 1) - c01) * fr
+    c10 = corner(0, 1, 0)
+    c10 += (corner(1, 1, 0) - c10) * fr
+    c11 = corner(0, 1, 1)
+    c11 += (corner(1, 1, 1) - c11) * fr
+    c00 += (c10 - c00) * fg
+    c01 += (c11 - c01) * fg
+    c00 += (c01 - c00) * fb + 0.5
+    return np.clip(c00, 0, 255).astype(np.uint8)
+
+
+def color_manager(display_profile=None):
+    """
+    :param display_profile: path of the ICC profile of the display, sRGB when None
+    :return: ColorManager, or None when Qt is older than 5.14 or NumPy is missing
+    """
+    # NumPy is only imported once a profiled image is drawn, which keeps it out of the start up
+    if importlib.util.find_spec("numpy") is None or not hasattr(QtGui, "QColorSpace"):
+        return None
+    display = None
+    if display_profile:
+        try:
+            with open(display_profile, 'rb') as file:
+                display = QtGui.QColorSpace.fromIccProfile(file.read())
+        except OSError:
+            display = None
+        if display is not None and not display.isValid():
+            display = None
+        if display is None:
+            print("Cannot read display profile " + display_profile + ", using sRGB")
+    return ColorManager(display)
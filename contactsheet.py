@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtGui, QtWidgets, QtCore
+from sources import SOURCE_ERRORS, absolute, open_reader, split_member
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+
+class ThumbnailSignals(QtCore.QObject):
+    ready = QtCore.pyqtSignal(str, object)
+
+
+class ThumbnailTask(QtCore.QRunnable):
+    """
+    Loads one thumbnail from the on-disk cache, or makes it with a scaled decode and stores it there
+    """
+
+    def __init__(self, file_name, cache, size, signals):
+        """
+        :param file_name:
+        :param cache: ThumbnailCache, or None
+        :param size:
+        :param signals:
+        """
+        super(ThumbnailTask, self).__init__()
+        self.file_name = file_name
+        self.cache = cache
+        self.size = size
+        self.signals = signals
+
+    def run(self):
+        qimage = self.cache.load(self.file_name) if self.cache is not None else QtGui.QImage()
+        if qimage.isNull():
+            try:
+                reader, device = open_reader(self.file_name)
+            except SOURCE_ERRORS:
+                return
+            size = reader.size()
+            if size.isValid():
+                reader.setScaledSize(size.scaled(self.size, self.size, QtCore.Qt.KeepAspectRatio))
+            qimage = reader.read()
+            if qimage.isNull():
+                return
+            if max(qimage.width(), qimage.height()) > self.size:
+                qimage = qimage.scaled(self.size, self.size, QtCore.Qt.KeepAspectRatio,
+                                       QtCore.Qt.SmoothTransformation)
+            if self.cache is not None:
+                self.cache.store(self.file_name, qimage)
+        self.signals.ready.emit(self.file_name, qimage)
+
+
+class ThumbnailCache(object):
+    """
+    Thumbnails stored as PNG files in a directory, bounded by max_bytes.  Files are touched when they are read, so
+    pruning removes the least recently used first.  The directory is only listed on the first write and when it goes
+    over max_bytes, and is then pruned to three quarters of it so pruning does not run on every write.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total = None
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, file_name):
+        """
+        :param file_name:
+        :return: cache file of the current version of file_name, or None when it cannot be found
+        """
+        try:
+            return os.path.join(self.directory, thumbnail_key(file_name) + ".png")
+        except (OSError, TypeError):
+            return None
+
+    def load(self, file_name):
+        qimage = QtGui.QImage()
+        path = self.path(file_name)
+        if path is not None and os.path.isfile(path) and qimage.load(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return qimage
+
+    def store(self, file_name, qimage):
+        path = self.path(file_name)
+        if path is None or not qimage.save(path, "PNG"):
+            return
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            try:
+                if self.total is None:
+                    self.total = self.scan()[1]
+                else:
+                    self.total += size
+                if self.total > self.max_bytes:
+                    self.prune(self.max_bytes * 3 // 4)
+            except OSError:
+                self.total = None
+
+    def scan(self):
+        """
+        :return: ([(modification time, which load refreshes, size, path), ...] of the cached thumbnails, their
+        total size)
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".png") and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries, sum(size for _, size, _ in entries)
+
+    def prune(self, target):
+        entries, total = self.scan()
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self.total = total
+
+
+class ContactSheet(QtWidgets.QAbstractScrollArea):
+    """
+    Scrollable grid of thumbnails of a list of files.  Only the rows on screen, and a couple of screens in the
+    direction of travel, are ever asked for, and anything still queued when the user scrolls elsewhere is dropped.
+    """
+    activated = QtCore.pyqtSignal(int)
+
+    def __init__(self, cache_directory=None, thumbnail_size=160, cache_bytes=512 * 1024 * 1024, parent=None):
+        """
+        :param cache_directory: directory thumbnails are kept in between runs, or None
+        :param thumbnail_size:
+        :param cache_bytes: most bytes of thumbnails kept in cache_directory
+        :param parent:
+        """
+        super(ContactSheet, self).__init__(parent)
+        self.cache = ThumbnailCache(cache_directory, cache_bytes) if cache_directory is not None else None
+        self.thumbnail_size = thumbnail_size
+        self.spacing = 8
+        self.files = []
+        self.current = 0
+
+        self.thumbnails = OrderedDict()
+        self.max_thumbnails = 1500
+        self.pending = set()
+        self.last_scroll = 0
+
+        self.pool = QtCore.QThreadPool(self)
+        self.signals = ThumbnailSignals(self)
+        self.signals.ready.connect(self.thumbnail_ready)
+        self.verticalScrollBar().valueChanged.connect(self.schedule)
+        self.verticalScrollBar().setSingleStep(self.cell_size() // 4)
+        self.setFocusPolicy(QtCore.Qt.StrongFocus)
+
+    def set_files(self, files, current=0):
+        self.files = files
+        self.current = current
+        self.pool.clear()
+        self.pending.clear()
+        self.update_scrollbar()
+        self.ensure_visible(current)
+        self.schedule()
+
+    def cell_size(self):
+        return self.thumbnail_size + self.spacing
+
+    def columns(self):
+        return max(1, self.viewport().width() // self.cell_size())
+
+    def update_scrollbar(self):
+        rows = (len(self.files) + self.columns() - 1) // self.columns()
+        scroll = self.verticalScrollBar()
+        scroll.setRange(0, max(0, rows * self.cell_size() - self.viewport().height()))
+        scroll.setPageStep(self.viewport().height())
+
+    def visible_range(self, margin=0):
+        """
+        Indices of the files whose cells are on screen, extended by margin pixels above and below
+        :param margin:
+        :return:
+        """
+        top = max(0, self.verticalScrollBar().value() - margin)
+        bottom = self.verticalScrollBar().value() + self.viewport().height() + margin
+        first = top // self.cell_size() * self.columns()
+        last = min(len(self.files), (bottom // self.cell_size() + 1) * self.columns())
+        return range(first, last)
+
+    def ensure_visible(self, index):
+        row = index // self.columns()
+        scroll = self.verticalScrollBar()
+        top = row * self.cell_size()
+        if top < scroll.value():
+            scroll.setValue(top)
+        elif top + self.cell_size() > scroll.value() + self.viewport().height():
+            scroll.setValue(top + self.cell_size() - self.viewport().height())
+
+    def schedule(self):
+        """
+        Queues thumbnails for the visible cells first and then for the next two screens in the scroll direction,
+        dropping requests that are no longer near the viewport
+        :return:
+        """
+        value = self.verticalScrollBar().value()
+        downwards = value >= self.last_scroll
+        self.last_scroll = value
+
+        self.pool.clear()
+        self.pending.clear()
+        visible = self.visible_range()
+        ahead = self.visible_range(2 * self.viewport().height())
+        if downwards:
+            ahead = [index for index in ahead if index >= visible.stop]
+        else:
+            ahead = [index for index in reversed(ahead) if index < visible.start]
+
+        for priority, indices in ((1, visible), (0, ahead)):
+            for index in indices:
+                file_name = self.files[index]
+                if file_name in self.thumbnails or file_name in self.pending:
+                    continue
+                self.pending.add(file_name)
+                self.pool.start(ThumbnailTask(file_name, self.cache, self.thumbnail_size, self.signals),
+                                priority)
+        self.viewport().update()
+
+    @QtCore.pyqtSlot(str, object)
+    def thumbnail_ready(self, file_name, qimage):
+        self.pending.discard(file_name)
+        self.thumbnails[file_name] = QtGui.QPixmap.fromImage(qimage)
+        while len(self.thumbnails) > self.max_thumbnails:
+            self.thumbnails.popitem(last=False)
+        self.viewport().update()
+
+    def index_at(self, position):
+        column = position.x() // self.cell_size()
+        if column >= self.columns():
+            return None
+        row = (position.y() + self.verticalScrollBar().value()) // self.cell_size()
+        index = row * self.columns() + column
+        if index >= len(self.files):
+            return None
+        return index
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self.viewport())
+        painter.fillRect(event.rect(), self.palette().window())
+        cell = self.cell_size()
+        columns = self.columns()
+        offset = self.verticalScrollBar().value()
+        for index in self.visible_range():
+            x = index % columns * cell + self.spacing // 2
+            y = index // columns * cell + self.spacing // 2 - offset
+            qpixmap = self.thumbnails.get(self.files[index])
+            if qpixmap is not None:
+                self.thumbnails.move_to_end(self.files[index])
+                painter.drawPixmap(x + (self.thumbnail_size - qpixmap.width()) // 2,
+                                   y + (self.thumbnail_size - qpixmap.height()) // 2, qpixmap)
+            else:
+                painter.fillRect(x, y, self.thumbnail_size, self.thumbnail_size, self.palette().mid())
+            if index == self.current:
+                painter.setPen(QtGui.QPen(self.palette().highlight(), 3))
+                painter.drawRect(x, y, self.thumbnail_size, self.thumbnail_size)
+        painter.end()
+
+    def resizeEvent(self, event):
+        super(ContactSheet, self).resizeEvent(event)
+        self.update_scrollbar()
+        self.schedule()
+
+    def mousePressEvent(self, event):
+        index = self.index_at(event.pos())
+        if index is not None:
+            self.current = index
+            self.viewport().update()
+
+    def mouseDoubleClickEvent(self, event):
+        index = self.index_at(event.pos())
+        if index is not None:
+            self.activated.emit(index)
+
+    def keyPressEvent(self, event):
+        moves = {QtCore.Qt.Key_Left: -1, QtCore.Qt.Key_Right: 1,
+                 QtCore.Qt.Key_Up: -self.columns(), QtCore.Qt.Key_Down: self.columns()}
+        if event.key() in moves and self.files:
+            self.current = min(max(self.current + moves[event.key()], 0), len(self.files) - 1)
+            self.ensure_visible(self.current)
+            self.viewport().update()
+        elif event.key() in (QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter):
+            self.activated.emit(self.current)
+        else:
+            super(ContactSheet, self).keyPressEvent(event)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtCore
+import os
+
+
+class FileWatcher(QtCore.QObject):
+    """
+    Watches a file, or a directory and the newest file in it, and announces changes at most once per interval.
+    Changes that leave the size and modification time as they were are not announced.
+    """
+    changed = QtCore.pyqtSignal(str)
+
+    def __init__(self, interval=100, extensions=None, parent=None):
+        super(FileWatcher, self).__init__(parent)
+        self.extensions = extensions
+        self.directory = None
+        self.file_name = None
+        self.signature = None
+
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.file_changed)
+        self.watcher.directoryChanged.connect(self.directory_changed)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.fire)
+
+    def watch(self, path):
+        self.stop()
+        if os.path.isdir(path):
+            self.directory = os.path.abspath(path)
+            self.watcher.addPath(self.directory)
+            self.follow(self.newest())
+        else:
+            self.follow(os.path.abspath(path))
+        self.signature = signature(self.file_name)
+
+    def stop(self):
+        paths = self.watcher.files() + self.watcher.directories()
+        if paths:
+            self.watcher.removePaths(paths)
+        self.timer.stop()
+        self.directory = None
+        self.file_name = None
+
+    def follow(self, file_name):
+        if self.file_name is not None and self.file_name in self.watcher.files():
+            self.watcher.removePath(self.file_name)
+        self.file_name = file_name
+        if file_name is not None and os.path.exists(file_name):
+            self.watcher.addPath(file_name)
+
+    def newest(self):
+        newest = None
+        newest_time = None
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if self.extensions is not None and os.path.splitext(entry.name)[1].lower() not in self.extensions:
+                continue
+            modified = entry.stat().st_mtime_ns
+            if newest_time is None or modified > newest_time:
+                newest, newest_time = entry.path, modified
+        return newest
+
+    def file_changed(self, file_name):
+        # Writers that replace the file through a rename make the watcher drop it
+        if file_name not in self.watcher.files() and os.path.exists(file_name):
+            self.watcher.addPath(file_name)
+        self.schedule()
+
+    def directory_changed(self, directory):
+        newest = self.newest()
+        if newest is not None and newest != self.file_name:
+            self.follow(newest)
+            self.signature = None
+        self.schedule()
+
+    def schedule(self):
+        # Throttle rather than debounce, so a file rewritten continuously is still shown several times a second
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def fire(self):
+        if self.file_name is None:
+            return
+        current = signature(self.file_name)
+        if current is None or current == self.signature:
+            return
+        self.signature = current
+        self.changed.emit(self.file_name)
+
+
+def signature(file_name):
+    try:
+        stat = os.stat(file_name)
+    except (OSError, TypeError):
+        return None
+    return stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from profiler import profiler
+
+
+class ImageCache(object):
+    """
+    LRU cache of decoded TilePyramids keyed by file name and bounded by the number of bytes the pyramids hold
+    """
+
+    def __init__(self, max_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, file_name):
+        return file_name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, file_name):
+        pyramid = self.entries.get(file_name)
+        if pyramid is None:
+            self.misses += 1
+            profiler.count("image miss")
+            return None
+        self.hits += 1
+        profiler.count("image hit")
+        self.entries.move_to_end(file_name)
+        return pyramid
+
+    def put(self, file_name, pyramid):
+        self.entries[file_name] = pyramid
+        self.entries.move_to_end(file_name)
+        self.evict()
+        profiler.gauge("image cache", self.nbytes())
+
+    def evict(self):
+        """
+        Drops least recently used pyramids until the cache fits in max_bytes.  The most recent entry is always kept
+        so a single image larger than the budget can still be shown.
+        :return:
+        """
+        total = self.nbytes()
+        while total > self.max_bytes and len(self.entries) > 1:
+            _, pyramid = self.entries.popitem(last=False)
+            total -= pyramid.nbytes()
+
+    def nbytes(self):
+        return sum(pyramid.nbytes() for pyramid in self.entries.values())
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtGui, QtCore
+from tilepyramid import TilePyramid, PreviewPyramid, IDENTITY, image_bytes, from_transformation
+from mappedimage import map_image
+from tonemap import ArrayPyramid, load_array, high_bit_depth, qimage_array
+from tilestore import TileStore, BAND_BYTES, build_stored_pyramid, band_reader
+from sources import SOURCE_ERRORS, is_virtual, open_source, device_for, probe
+from profiler import profiler
+
+
+class DecodeSignals(QtCore.QObject):
+    preview_ready = QtCore.pyqtSignal(int, str, object)
+    image_ready = QtCore.pyqtSignal(int, str, object)
+    failed = QtCore.pyqtSignal(int, str, str)
+    prefetched = QtCore.pyqtSignal(str, object)
+    prefetch_failed = QtCore.pyqtSignal(str, str)
+
+
+class DecodeTask(QtCore.QRunnable):
+    """
+    Decodes one file on a QThreadPool worker.  When the format can decode straight to a smaller size (JPEG does
+    this from the DCT coefficients) a preview is emitted first, then the full image follows.
+    """
+
+    def __init__(self, file_name, generation, signals, preview_size, prefetch=False, reload=False, previous=None,
+                 store=None, colors=None):
+        """
+        :param file_name:
+        :param generation:
+        :param signals:
+        :param preview_size:
+        :param prefetch:
+        :param reload: the file is watched and may still be being written, so an incomplete file is accepted and
+        the checksums of its bands are taken
+        :param previous: pyramid of an earlier version of the file, whose work is reused for the rows that did not
+        change
+        :param store: (threshold, memory, hot, decode) in bytes; images whose decoded size is over threshold have
+        their tiles kept in a TileStore with the memory and hot budgets, and are decoded at most decode bytes at a
+        time
+        :param colors: ColorManager that converts 8-bit images from their color profile to the display, or None
+        """
+        super(DecodeTask, self).__init__()
+        self.file_name = file_name
+        self.generation = generation
+        self.signals = signals
+        self.preview_size = preview_size
+        self.prefetch = prefetch
+        self.reload = reload
+        self.previous = previous
+        self.store = store
+        self.colors = colors
+        # EXIF orientation is left to the view, which turns tiles as it draws them
+        self.orientation = IDENTITY
+
+    def run(self):
+        try:
+            self.decode()
+        except Exception as error:
+            # An exception escaping a QRunnable aborts the application, and the request has to be answered anyway
+            self.fail(str(error) or type(error).__name__)
+
+    def decode(self):
+        if is_virtual(self.file_name):
+            self.run_source()
+            return
+
+        with profiler.section("read"):
+            try:
+                loaded = load_array(self.file_name, partial=self.reload)
+            except (OSError, ValueError, KeyError, TypeError):
+                loaded = None
+        if loaded is not None:
+            self.emit(ArrayPyramid(loaded[0], resident_bytes=loaded[1]))
+            return
+
+        with profiler.section("read"):
+            mapped = map_image(self.file_name, partial=self.reload)
+        if mapped is not None:
+            # Uncompressed data is used in place, so there is nothing to gain from a preview
+            if high_bit_depth(mapped.qimage) and not mapped.flipped:
+                self.emit(ArrayPyramid(qimage_array(mapped.qimage), owner=mapped))
+            elif self.stored(mapped.qimage.size()) and not mapped.flipped and not self.reload:
+                # The mapped rows cost nothing, but the downscaled levels would be a third of them again
+                qimage = mapped.qimage
+                self.emit_stored(qimage.width(), qimage.height(),
+                                 lambda y, rows: qimage.copy(0, y, qimage.width(), rows))
+            else:
+                self.emit(TilePyramid(mapped.qimage, flipped=mapped.flipped, mapping=mapped.mapping))
+            return
+
+        with profiler.section("read"):
+            reader = QtGui.QImageReader(self.file_name)
+            size = reader.size()
+            self.orientation = from_transformation(reader.transformation())
+        if (self.preview_size > 0 and size.isValid() and
+                min(size.width(), size.height()) > 2 * self.preview_size and
+                reader.supportsOption(QtGui.QImageIOHandler.ScaledSize)):
+            reader.setScaledSize(size.scaled(self.preview_size, self.preview_size,
+                                             QtCore.Qt.KeepAspectRatioByExpanding))
+            with profiler.section("preview"):
+                preview = reader.read()
+            if not preview.isNull():
+                preview = TilePyramid(self.managed(preview))
+                preview.orientation = self.orientation
+                self.signals.preview_ready.emit(self.generation, self.file_name, preview)
+            reader = QtGui.QImageReader(self.file_name)
+
+        if self.stored(size) and not reader.supportsOption(QtGui.QImageIOHandler.Animation):
+            decode_bytes = self.store[3]
+            clipped = reader.supportsOption(QtGui.QImageIOHandler.ClipRect)
+            if not clipped and size.width() * size.height() * 4 > decode_bytes:
+                # The format can only be decoded whole, which would not fit in the budget
+                self.fail("%s is %d MB decoded, over the decode budget of %d MB" %
+                          (self.file_name, size.width() * size.height() * 4 // 1048576, decode_bytes // 1048576))
+                return
+            with profiler.section("decode"):
+                read_band = band_reader(self.file_name, reader)
+            if self.emit_stored(size.width(), size.height(), read_band, decode_bytes if clipped else BAND_BYTES):
+                return
+            if size.width() * size.height() * 4 > decode_bytes:
+                self.fail("Cannot decode %s in bands" % self.file_name)
+                return
+
+        with profiler.section("decode"):
+            qimage = reader.read()
+        self.emit_decoded(qimage, reader)
+
+    def run_source(self):
+        """
+        Decodes an archive member or URL.  Only the header is fetched first, which gives the size and, for JPEG, the
+        EXIF thumbnail to show while the rest of the file arrives.
+        """
+        try:
+            with profiler.section("read"):
+                file = open_source(self.file_name)
+                size, thumbnail = probe(file)
+        except SOURCE_ERRORS as error:
+            self.fail(str(error))
+            return
+        device = device_for(file)
+        reader = QtGui.QImageReader(device)
+        self.orientation = from_transformation(reader.transformation())
+        if self.preview_size > 0 and thumbnail is not None and size.isValid():
+            preview = PreviewPyramid(self.managed(thumbnail), size.width(), size.height())
+            preview.orientation = self.orientation
+            self.signals.preview_ready.emit(self.generation, self.file_name, preview)
+        with profiler.section("decode"):
+            qimage = reader.read()
+        self.emit_decoded(qimage, reader, frame_count=reader.imageCount())
+
+    def emit_decoded(self, qimage, reader, frame_count=1):
+        if qimage.isNull():
+            self.fail(reader.errorString())
+            return
+        if high_bit_depth(qimage):
+            pyramid = ArrayPyramid(qimage_array(qimage), owner=qimage, resident_bytes=image_bytes(qimage))
+        else:
+            pyramid = TilePyramid(self.managed(qimage))
+        pyramid.frame_count = max(1, frame_count)
+        self.emit(pyramid)
+
+    def managed(self, qimage):
+        """
+        Converts a decoded image from its color profile to the display here on the decode thread, in place and in
+        bounded bands, so the tiles cut from it while painting are plain copies
+        :param qimage:
+        :return: qimage in the display color space
+        """
+        conversion = self.colors.conversion(qimage.colorSpace()) if self.colors is not None else None
+        if conversion is None:
+            return qimage
+        with profiler.section("color"):
+            return conversion.convert(qimage)
+
+    def stored(self, size):
+        return self.store is not None and size.isValid() and size.width() * size.height() * 4 > self.store[0]
+
+    def emit_stored(self, width, height, read_band, band_bytes=BAND_BYTES):
+        """
+        :param width:
+        :param height:
+        :param read_band: see build_stored_pyramid
+        :param band_bytes: decoded size of the bands read_band is asked for
+        :return: True when the pyramid was emitted
+        """
+        with profiler.section("pyramid"):
+            pyramid = build_stored_pyramid(width, height, read_band, TileStore(self.store[1], self.store[2]),
+                                           band_bytes, colors=self.colors)
+        if pyramid is None:
+            return False
+        self.emit(pyramid)
+        return True
+
+    def emit(self, pyramid):
+        pyramid.orientation = self.orientation
+        with profiler.section("pyramid"):
+            if self.reload and not pyramid.flipped:
+                pyramid.band_checksums()
+            if self.previous is not None:
+                pyramid.extend_levels(self.previous)
+            else:
+                pyramid.build_levels()
+        if self.prefetch:
+            self.signals.prefetched.emit(self.file_name, pyramid)
+        else:
+            self.signals.image_ready.emit(self.generation, self.file_name, pyramid)
+
+    def fail(self, message):
+        """
+        Every request ends in a result or a failure, so the loader never keeps waiting on a file
+        :param message:
+        :return:
+        """
+        if self.prefetch:
+            self.signals.prefetch_failed.emit(self.file_name, message)
+        else:
+            self.signals.failed.emit(self.generation, self.file_name, message)
+
+
+class ImageLoader(QtCore.QObject):
+    """
+    Runs decodes off the GUI thread and forwards only the results of the most recent load request
+    """
+    preview_ready = QtCore.pyqtSignal(str, object)
+    image_ready = QtCore.pyqtSignal(str, object)
+    failed = QtCore.pyqtSignal(str, str)
+    prefetched = QtCore.pyqtSignal(str, object)
+    prefetch_failed = QtCore.pyqtSignal(str, str)
+
+    def __init__(self, parent=None):
+        super(ImageLoader, self).__init__(parent)
+        self.pool = QtCore.QThreadPool(self)
+        self.generation = 0
+        self.pending = set()
+        self.store = None
+        self.colors = None
+
+        self.signals = DecodeSignals(self)
+        self.signals.preview_ready.connect(self.on_preview_ready)
+        self.signals.image_ready.connect(self.on_image_ready)
+        self.signals.failed.connect(self.on_failed)
+        self.signals.prefetched.connect(self.on_prefetched)
+        self.signals.prefetch_failed.connect(self.on_prefetch_failed)
+
+    def load(self, file_name, preview_size=0):
+        self.generation += 1
+        self.pool.start(DecodeTask(file_name, self.generation, self.signals, preview_size,
+                                   store=self.store, colors=self.colors), 1)
+
+    def reload(self, file_name, previous=None):
+        """
+        Decodes a file again after it changed on disk, accepting it while it is still incomplete
+        :param file_name:
+        :param previous: pyramid shown for the earlier version of the file, or None
+        :return:
+        """
+        self.generation += 1
+        self.pool.start(DecodeTask(file_name, self.generation, self.signals, 0, reload=True, previous=previous,
+                                   colors=self.colors), 1)
+
+    def prefetch(self, file_name):
+        """
+        Queues a low priority decode whose result is only announced through prefetched or prefetch_failed
+        :param file_name:
+        :return:
+        """
+        if file_name in self.pending:
+            return
+        self.pending.add(file_name)
+        self.pool.start(DecodeTask(file_name, 0, self.signals, 0, prefetch=True, store=self.store,
+                                   colors=self.colors), 0)
+
+    def cancel_prefetch(self):
+        """
+        Drops every decode that has not started yet, prefetches as well as superseded loads
+        :return:
+        """
+        self.pool.clear()
+        self.pending.clear()
+
+    @QtCore.pyqtSlot(str, object)
+    def on_prefetched(self, file_name, pyramid):
+        self.pending.discard(file_name)
+        self.prefetched.emit(file_name, pyramid)
+
+    @QtCore.pyqtSlot(str, str)
+    def on_prefetch_failed(self, file_name, message):
+        self.pending.discard(file_name)
+        self.prefetch_failed.emit(file_name, message)
+
+    @QtCore.pyqtSlot(int, str, object)
+    def on_preview_ready(self, generation, file_name, pyramid):
+        if generation == self.generation:
+            self.preview_ready.emit(file_name, pyramid)
+
+    @QtCore.pyqtSlot(int, str, object)
+    def on_image_ready(self, generation, file_name, pyramid):
+        if generation == self.generation:
+            self.image_ready.emit(file_name, pyramid)
+
+    @QtCore.pyqtSlot(int, str, str)
+    def on_failed(self, generation, file_name, message):
+        if generation == self.generation:
+            self.failed.emit(file_name, message)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtGui, QtWidgets, QtCore
+from tilepyramid import PreviewPyramid
+from tonemap import ArrayPyramid
+from collections import OrderedDict
+import math
+import weakref
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+BINS = 256
+
+
+class Histogram(object):
+    """
+    Per channel counts over fixed bins, with the sums needed for the mean and deviation.  Histograms of tiles with
+    the same bins add up to the histogram of the area they cover.
+    """
+
+    def __init__(self, counts, sums, squares, lows, highs):
+        self.counts = counts
+        self.sums = sums
+        self.squares = squares
+        self.lows = lows
+        self.highs = highs
+
+    def __add__(self, other):
+        return Histogram(self.counts + other.counts, self.sums + other.sums, self.squares + other.squares,
+                         np.minimum(self.lows, other.lows), np.maximum(self.highs, other.highs))
+
+    def total(self):
+        return int(self.counts[0].sum())
+
+    def mean(self):
+        return self.sums / max(self.total(), 1)
+
+    def deviation(self):
+        mean = self.mean()
+        return np.sqrt(np.maximum(self.squares / max(self.total(), 1) - mean * mean, 0))
+
+
+def measure(samples, value_range):
+    """
+    Histogram of an array of shape (height, width) or (height, width, channels)
+    :param samples:
+    :param value_range: (low, high) mapped onto the bins; values outside go to the end bins
+    :return:
+    """
+    channels = 1 if samples.ndim == 2 else samples.shape[2]
+    values = samples.reshape(-1, channels)
+    low, high = value_range
+    counts = np.zeros((channels, BINS), np.int64)
+    sums = np.zeros(channels)
+    squares = np.zeros(channels)
+    lows = np.full(channels, np.inf)
+    highs = np.full(channels, -np.inf)
+    for channel in range(channels):
+        column = values[:, channel]
+        if column.dtype.kind == 'f':
+            column = column[np.isfinite(column)]
+        if column.size == 0:
+            continue
+        if column.dtype == np.uint8 and value_range == (0, 256):
+            index = column
+        else:
+            index = np.clip(((column - low) * (BINS / float(high - low))).astype(np.int64), 0, BINS - 1)
+        counts[channel] = np.bincount(index, minlength=BINS)[:BINS]
+        wide = column.astype(np.float64)
+        sums[channel] = wide.sum()
+        squares[channel] = np.dot(wide, wide)
+        lows[channel] = wide.min()
+        highs[channel] = wide.max()
+    return Histogram(counts, sums, squares, lows, highs)
+
+
+def qimage_samples(qimage):
+    """
+    Copies the RGB samples of a QImage into an array, a single channel for grey images
+    :param qimage:
+    :return:
+    """
+    qimage = qimage.convertToFormat(QtGui.QImage.Format_RGB32)
+    bits = qimage.constBits()
+    bits.setsize(qimage.height() * qimage.bytesPerLine())
+    pixels = np.frombuffer(bits, np.uint32).reshape(qimage.height(), qimage.bytesPerLine() // 4)
+    pixels = pixels[:, :qimage.width()]
+    rgb = np.stack([(pixels >> 16) & 255, (pixels >> 8) & 255, pixels & 255], axis=2).astype(np.uint8)
+    if (rgb[:, :, 0] == rgb[:, :, 1]).all() and (rgb[:, :, 1] == rgb[:, :, 2]).all():
+        return rgb[:, :, 0]
+    return rgb
+
+
+def tile_samples(pyramid, level, tx, ty):
+    if isinstance(pyramid, ArrayPyramid):
+        return pyramid.raw_tile(level, tx, ty)
+    return qimage_samples(pyramid.tile_image(level, tx, ty))
+
+
+def value_range(pyramid):
+    if not isinstance(pyramid, ArrayPyramid):
+        return 0, 256
+    dtype = pyramid.array.dtype
+    if dtype.kind in 'ui':
+        info = np.iinfo(dtype)
+        return int(info.min), int(info.max) + 1
+    samples = np.asarray(pyramid.sample(), dtype=np.float64)
+    samples = samples[np.isfinite(samples)]
+    if samples.size == 0:
+        return 0., 1.
+    low, high = float(samples.min()), float(samples.max())
+    return low, high if high > low else low + 1.
+
+
+def pixel_value(pyramid, x, y):
+    """
+    Samples of the full resolution pixel at image coordinates x, y
+    :param pyramid:
+    :param x:
+    :param y:
+    :return: tuple of values, or None outside the image or while only a preview is shown
+    """
+    x = int(math.floor(x))
+    y = int(math.floor(y))
+    if isinstance(pyramid, PreviewPyramid) or not (0 <= x < pyramid.width and 0 <= y < pyramid.height):
+        return None
+    if isinstance(pyramid, ArrayPyramid):
+        return tuple(np.atleast_1d(pyramid.array[y, x]).tolist())
+    if pyramid.levels[0] is not None:
+        qimage = pyramid.levels[0]
+        if pyramid.flipped:
+            y = pyramid.height - 1 - y
+    else:
+        qimage = pyramid.tile_image(0, x // pyramid.tile_size, y // pyramid.tile_size)
+        x %= pyramid.tile_size
+        y %= pyramid.tile_size
+    color = qimage.pixelColor(x, y)
+    if qimage.isGrayscale():
+        return color.red(),
+    if qimage.hasAlphaChannel():
+        return color.red(), color.green(), color.blue(), color.alpha()
+    return color.red(), color.green(), color.blue()
+
+
+class Inspector(object):
+    """
+    Histograms of what is on screen, made from cached per tile histograms.  Only tiles cut by the edge of the
+    viewport are measured again as the view pans, so the cost follows the viewport rather than the image.
+    """
+
+    def __init__(self, max_tiles=4096):
+        self.max_tiles = max_tiles
+        self.pyramid = lambda: None
+        self.value_range = None
+        self.tiles = OrderedDict()
+
+    def reset(self, pyramid):
+        if self.pyramid() is not pyramid:
+            self.pyramid = weakref.ref(pyramid)
+            self.value_range = value_range(pyramid)
+            self.tiles.clear()
+
+    def tile_histogram(self, pyramid, level, tx, ty):
+        key = (level, tx, ty)
+        histogram = self.tiles.get(key)
+        if histogram is None:
+            histogram = self.tiles[key] = measure(tile_samples(pyramid, level, tx, ty), self.value_range)
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        else:
+            self.tiles.move_to_end(key)
+        return histogram
+
+    def histogram(self, pyramid, level, viewport):
+        """
+        :param pyramid:
+        :param level: level whose samples are counted, normally the one on screen
+        :param viewport: (x, y, width, height) in full resolution image coordinates
+        :return: Histogram, or None when nothing is visible
+        """
+        self.reset(pyramid)
+        scale_x, scale_y = pyramid.level_scale(level)
+        left, top = viewport[0] / scale_x, viewport[1] / scale_y
+        right, bottom = (viewport[0] + viewport[2]) / scale_x, (viewport[1] + viewport[3]) / scale_y
+        total = None
+        for tx, ty, _ in pyramid.visible_tiles(level, viewport):
+            rect = pyramid.tile_rect(level, tx, ty)
+            x0 = max(int(math.floor(left)) - rect.x(), 0)
+            y0 = max(int(math.floor(top)) - rect.y(), 0)
+            x1 = min(int(math.ceil(right)) - rect.x(), rect.width())
+            y1 = min(int(math.ceil(bottom)) - rect.y(), rect.height())
+            if x1 <= x0 or y1 <= y0:
+                continue
+            if (x0, y0, x1, y1) == (0, 0, rect.width(), rect.height()):
+                histogram = self.tile_histogram(pyramid, level, tx, ty)
+            else:
+                histogram = measure(tile_samples(pyramid, level, tx, ty)[y0:y1, x0:x1], self.value_range)
+            total = histogram if total is None else total + histogram
+        return total
+
+
+class InspectorPanel(QtWidgets.QWidget):
+    """
+    Floating readout of the pixel under the cursor and of the histogram and statistics of the visible area.  The
+    histogram is refreshed a few times a second at most while the view changes.
+    """
+
+    def __init__(self, view, parent=None):
+        super(InspectorPanel, self).__init__(parent)
+        self.view = view
+        self.inspector = Inspector()
+        self.histogram = None
+        self.measured = None
+        self.pixel = None
+        self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents)
+        self.resize(280, 200)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(100)
+        self.timer.timeout.connect(self.refresh)
+        view.view_changed.connect(self.schedule)
+        view.hovered.connect(self.hover)
+
+    def schedule(self):
+        if self.isVisible() and not self.timer.isActive():
+            self.timer.start()
+
+    def refresh(self):
+        pyramid = self.view.qpixmap_ref()
+        histogram = None
+        measured = None
+        if np is not None and pyramid is not None and not isinstance(pyramid, PreviewPyramid):
+            level = pyramid.level_for(self.view.get_magnification())
+            viewport = self.view.return_viewport()
+            measured = (weakref.ref(pyramid), level, viewport)
+            # The edge tiles are measured again on every refresh, which is wasted when the view has not moved
+            if measured == self.measured:
+                return
+            histogram = self.inspector.histogram(pyramid, level, viewport)
+        self.histogram = histogram
+        self.measured = measured
+        self.update()
+
+    def hover(self, x, y):
+        if not self.isVisible():
+            return
+        pyramid = self.view.qpixmap_ref()
+        value = pixel_value(pyramid, x, y) if pyramid is not None else None
+        self.pixel = None if value is None else (int(math.floor(x)), int(math.floor(y)), value)
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), QtGui.QColor(0, 0, 0, 170))
+        painter.setPen(QtCore.Qt.white)
+        metrics = painter.fontMetrics()
+        line = metrics.height()
+        y = 6 + metrics.ascent()
+
+        if self.pixel is not None:
+            x, pixel_y, value = self.pixel
+            painter.drawText(8, y, "%d, %d: %s" % (x, pixel_y, " ".join(format_value(v) for v in value)))
+        y += line
+
+        histogram = self.histogram
+        if histogram is None:
+            painter.end()
+            return
+        plot = QtCore.QRectF(8, y, self.width() - 16, self.height() - y - 8 - 2 * line)
+        colors = ([QtGui.QColor(255, 255, 255, 200)] if len(histogram.counts) == 1 else
+                  [QtGui.QColor(255, 60, 60, 160), QtGui.QColor(60, 255, 60, 160), QtGui.QColor(60, 120, 255, 160)])
+        peak = float(max(histogram.counts[:, 1:-1].max(), 1))
+        bar = plot.width() / BINS
+        for channel, color in zip(range(len(histogram.counts)), colors):
+            path = QtGui.QPainterPath(QtCore.QPointF(plot.left(), plot.bottom()))
+            for index, count in enumerate(histogram.counts[channel]):
+                height = min(count / peak, 1.) * plot.height()
+                path.lineTo(plot.left() + index * bar, plot.bottom() - height)
+                path.lineTo(plot.left() + (index + 1) * bar, plot.bottom() - height)
+            path.lineTo(plot.right(), plot.bottom())
+            painter.fillPath(path, color)
+
+        y = plot.bottom() + 4 + metrics.ascent()
+        painter.drawText(8, y, "mean %s  sd %s" % (" ".join(format_value(v) for v in histogram.mean()),
+                                                   " ".join(format_value(v) for v in histogram.deviation())))
+        painter.drawText(8, y + line, "min %s  max %s" % (" ".join(format_value(v) for v in histogram.lows),
+                                                          " ".join(format_value(v) for v in histogram.highs)))
+        painter.end()
+
+
+def format_value(value):
+    if float(value).is_integer():
+        return "%d" % value
+    return "%.4g" % value
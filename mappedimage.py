@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtGui
+import json
+import mmap
+import os
+import struct
+
+try:
+    from PyQt5 import sip
+except ImportError:
+    import sip
+
+
+MAPPED_EXTENSIONS = (".pgm", ".ppm", ".pnm", ".bmp", ".tif", ".tiff")
+
+
+class MappedImage(object):
+    """
+    A QImage whose pixels live in a read-only memory map of the file they were read from.  The mapping must outlive
+    the QImage, so both are kept together.
+    """
+
+    def __init__(self, qimage, mapping, flipped=False):
+        self.qimage = qimage
+        self.mapping = mapping
+        self.flipped = flipped
+
+
+def map_image(file_name, partial=False):
+    """
+    Maps uncompressed PGM/PPM, BMP and TIFF files as well as raw dumps described by a JSON sidecar, without copying
+    the pixel data
+    :param file_name:
+    :param partial: accept a file that is still being written, mapping only the rows that are already complete
+    :return: a MappedImage, or None when the file is not in a layout QImage can use in place
+    """
+    sidecar = find_sidecar(file_name)
+    if sidecar is None and os.path.splitext(file_name)[1].lower() not in MAPPED_EXTENSIONS:
+        return None
+
+    with open(file_name, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        if sidecar is not None:
+            layout = parse_sidecar(sidecar)
+        elif mapping[:2] in (b"P5", b"P6"):
+            layout = parse_pnm(mapping)
+        elif mapping[:2] == b"BM":
+            layout = parse_bmp(mapping)
+        elif mapping[:4] in (b"II*\x00", b"MM\x00*"):
+            layout = parse_tiff(mapping)
+        else:
+            layout = None
+    except (struct.error, ValueError, KeyError, IndexError):
+        layout = None
+
+    if layout is None:
+        mapping.close()
+        return None
+    offset, width, height, bytes_per_line, image_format, color_table, flipped = layout
+    if partial and not flipped and bytes_per_line > 0:
+        # Bottom-up files are written starting with the last row, so they cannot be shown while incomplete
+        height = min(height, (len(mapping) - offset) // bytes_per_line)
+    if image_format is None or width <= 0 or height <= 0 or offset + bytes_per_line * height > len(mapping):
+        mapping.close()
+        return None
+
+    address = int(sip.voidptr(mapping)) + offset
+    qimage = QtGui.QImage(sip.voidptr(address), width, height, bytes_per_line, image_format)
+    if color_table is not None:
+        qimage.setColorTable(color_table)
+    return MappedImage(qimage, mapping, flipped)
+
+
+def qimage_format(name):
+    # Grayscale16 and BGR888 only exist in newer Qt releases
+    return getattr(QtGui.QImage, name, None)
+
+
+def find_sidecar(file_name):
+    for sidecar in (file_name + ".json", os.path.splitext(file_name)[0] + ".json"):
+        if sidecar != file_name and os.path.isfile(sidecar):
+            return sidecar
+    return None
+
+
+def parse_sidecar(sidecar):
+    """
+    Reads the layout of a raw dump, e.g. {"width": 4096, "height": 4096, "dtype": "uint16", "channels": 1}, with
+    optional "offset" and "stride" in bytes
+    :param sidecar:
+    :return:
+    """
+    with open(sidecar, 'r') as file:
+        header = json.load(file)
+    width = int(header['width'])
+    height = int(header['height'])
+    dtype = header.get('dtype', 'uint8')
+    channels = int(header.get('channels', 1))
+    image_format = {('uint8', 1): qimage_format('Format_Grayscale8'),
+                    ('uint8', 3): qimage_format('Format_RGB888'),
+                    ('uint8', 4): qimage_format('Format_RGBA8888'),
+                    ('uint16', 1): qimage_format('Format_Grayscale16')}.get((dtype, channels))
+    bytes_per_sample = 2 if dtype == 'uint16' else 1
+    stride = int(header.get('stride', width * channels * bytes_per_sample))
+    return int(header.get('offset', 0)), width, height, stride, image_format, None, False
+
+
+def parse_pnm(mapping):
+    """
+    Binary 8-bit PGM (P5) and PPM (P6).  16-bit files are big-endian, which no QImage format matches.
+    :param mapping:
+    :return:
+    """
+    fields = []
+    position = 2
+    while len(fields) < 3:
+        if position >= len(mapping):
+            return None
+        while mapping[position:position + 1].isspace():
+            position += 1
+        if mapping[position:position + 1] == b"#":
+            position = mapping.find(b"\n", position) + 1
+            continue
+        start = position
+        while position < len(mapping) and not mapping[position:position + 1].isspace():
+            position += 1
+        fields.append(int(mapping[start:position]))
+    width, height, maxval = fields
+    if maxval > 255:
+        return None
+    offset = position + 1
+    if mapping[:2] == b"P5":
+        return offset, width, height, width, qimage_format('Format_Grayscale8'), None, False
+    return offset, width, height, 3 * width, qimage_format('Format_RGB888'), None, False
+
+
+def parse_bmp(mapping):
+    """
+    Uncompressed 8, 24 and 32-bit BMPs.  Rows are stored bottom-up unless the height is negative, which is reported
+    through the flipped flag rather than by reordering the data.
+    :param mapping:
+    :return:
+    """
+    offset, = struct.unpack_from("<I", mapping, 10)
+    header_size, width, height, _, bits, compression = struct.unpack_from("<IiiHHI", mapping, 14)
+    if header_size < 40 or compression != 0:
+        return None
+    flipped = height > 0
+    height = abs(height)
+    bytes_per_line = (bits * width + 31) // 32 * 4
+
+    color_table = None
+    if bits == 8:
+        colors, = struct.unpack_from("<I", mapping, 46)
+        colors = colors or 256
+        palette = 14 + header_size
+        color_table = [0xff000000 | struct.unpack_from("<I", mapping, palette + 4 * index)[0] & 0xffffff
+                       for index in range(colors)]
+        image_format = qimage_format('Format_Indexed8')
+    elif bits == 24:
+        image_format = qimage_format('Format_BGR888')
+    elif bits == 32:
+        image_format = qimage_format('Format_RGB32')
+    else:
+        return None
+    return offset, width, height, bytes_per_line, image_format, color_table, flipped
+
+
+def parse_tiff(mapping):
+    """
+    Single-image, uncompressed, chunky TIFFs whose strips are stored back to back
+    :param mapping:
+    :return:
+    """
+    order = "<" if mapping[:2] == b"II" else ">"
+    ifd, = struct.unpack_from(order + "I", mapping, 4)
+    entries, = struct.unpack_from(order + "H", mapping, ifd)
+    tags = {}
+    for index in range(entries):
+        tag, kind, count, value = struct.unpack_from(order + "HHI4s", mapping, ifd + 2 + 12 * index)
+        size = {3: 2, 4: 4}.get(kind)
+        if size is None:
+            continue
+        code = order + str(count) + ("H" if kind == 3 else "I")
+        if size * count <= 4:
+            tags[tag] = struct.unpack_from(code, value)
+        else:
+            tags[tag] = struct.unpack_from(code, mapping, struct.unpack(order + "I", value)[0])
+
+    if tags.get(259, (1,))[0] != 1 or tags.get(284, (1,))[0] != 1 or 322 in tags:
+        return None
+    width = tags[256][0]
+    height = tags[257][0]
+    bits = tags.get(258, (1,))[0]
+    samples = tags.get(277, (1,))[0]
+    photometric = tags.get(262, (1,))[0]
+    offsets = tags[273]
+    counts = tags[279]
+    for index in range(len(offsets) - 1):
+        if offsets[index] + counts[index] != offsets[index + 1]:
+            return None
+
+    if photometric == 1 and samples == 1 and bits == 8:
+        image_format = qimage_format('Format_Grayscale8')
+    elif photometric == 1 and samples == 1 and bits == 16 and order == "<":
+        image_format = qimage_format('Format_Grayscale16')
+    elif photometric == 2 and samples == 3 and bits == 8:
+        image_format = qimage_format('Format_RGB888')
+    elif photometric == 2 and samples == 4 and bits == 8:
+        image_format = qimage_format('Format_RGBA8888')
+    else:
+        return None
+    return offsets[0], width, height, width * samples * bits // 8, image_format, None, False
+
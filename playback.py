@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtGui, QtCore
+from tilepyramid import TilePyramid
+from sources import SOURCE_ERRORS, open_reader
+from profiler import profiler
+import os
+import re
+import time
+
+
+class AnimationSource(object):
+    """
+    Frames of an animated GIF, APNG or WebP, or the pages of a multi-page TIFF.  Readers of these formats are
+    sequential, so one reader is kept and frames must be asked for from a single thread.
+    """
+
+    def __init__(self, file_name, count=None):
+        """
+        :param file_name:
+        :param count: number of frames when it is already known, otherwise the file is opened to count them
+        """
+        self.file_name = file_name
+        if count is None:
+            reader, device = open_reader(file_name)
+            count = reader.imageCount()
+        self.count = max(0, count)
+        self.reader = None
+        self.device = None
+        self.position = 0
+        self.serial = True
+
+    def frame(self, index):
+        """
+        :param index:
+        :return: (qimage, duration in milliseconds)
+        """
+        if self.reader is None or index < self.position:
+            try:
+                self.reader, self.device = open_reader(self.file_name)
+            except SOURCE_ERRORS:
+                self.reader = None
+                return QtGui.QImage(), 100
+            self.position = 0
+        if index > self.position and self.reader.jumpToImage(index):
+            self.position = index
+        while self.position < index:
+            self.reader.read()
+            self.position += 1
+        qimage = self.reader.read()
+        self.position += 1
+        delay = self.reader.nextImageDelay()
+        # Browsers show GIF frames with no or a tiny delay for 100 ms, and files are authored for that
+        return qimage, delay if delay > 10 else 100
+
+
+class SequenceSource(object):
+    """
+    Numbered image files played as frames at a fixed rate.  Every frame is a separate decode, so frames can be read
+    in parallel.
+    """
+
+    def __init__(self, files, fps=24.):
+        self.files = files
+        self.count = len(files)
+        self.duration = 1000. / fps
+        self.serial = False
+
+    def frame(self, index):
+        try:
+            reader, device = open_reader(self.files[index])
+        except SOURCE_ERRORS:
+            return QtGui.QImage(), self.duration
+        return reader.read(), self.duration
+
+
+def sequence_files(file_name, files):
+    """
+    Picks the files that differ from file_name only in its last run of digits, in frame order
+    :param file_name:
+    :param files: candidate files, e.g. the directory listing
+    :return:
+    """
+    directory, name = os.path.split(os.path.abspath(file_name))
+    match = re.match(r"^(.*?)(\d+)(\D*)$", name)
+    if match is None:
+        return []
+    pattern = re.compile(re.escape(match.group(1)) + r"(\d+)" + re.escape(match.group(3)) + "$")
+    frames = []
+    for candidate in files:
+        if os.path.dirname(os.path.abspath(candidate)) != directory:
+            continue
+        found = pattern.match(os.path.basename(candidate))
+        if found is not None:
+            frames.append((int(found.group(1)), candidate))
+    return [candidate for _, candidate in sorted(frames)]
+
+
+class FrameSignals(QtCore.QObject):
+    ready = QtCore.pyqtSignal(int, int, object, float)
+
+
+class FrameTask(QtCore.QRunnable):
+    def __init__(self, source, index, generation, signals):
+        super(FrameTask, self).__init__()
+        self.source = source
+        self.index = index
+        self.generation = generation
+        self.signals = signals
+
+    def run(self):
+        with profiler.section("decode"):
+            qimage, duration = self.source.frame(self.index)
+        if qimage.isNull():
+            pyramid = None
+        else:
+            pyramid = TilePyramid(qimage)
+            with profiler.section("pyramid"):
+                pyramid.build_levels()
+        self.signals.ready.emit(self.generation, self.index, pyramid, duration)
+
+
+class Player(QtCore.QObject):
+    """
+    Plays the frames of a source with decoding running ahead on worker threads into a bounded ring of frames.
+    Each frame is kept on screen for its own duration measured against the previous deadline, so timer jitter does
+    not accumulate.  A frame that is not decoded in time holds the current one rather than being skipped, and a frame
+    that fails to decode is passed over.
+    """
+    frame_changed = QtCore.pyqtSignal(int, object)
+
+    def __init__(self, source, capacity=16, max_bytes=512 * 1024 * 1024, parent=None):
+        """
+        :param source: AnimationSource or SequenceSource
+        :param capacity: most frames kept decoded, a couple behind the current one and the rest ahead
+        :param max_bytes: budget for the decoded frames
+        :param parent:
+        """
+        super(Player, self).__init__(parent)
+        self.source = source
+        self.capacity = max(3, min(capacity, source.count))
+        self.max_bytes = max_bytes
+        self.frames = {}
+        self.requested = set()
+        # Index to duration of the frames that failed to decode, which are passed over instead of requested again
+        self.failed = {}
+        self.generation = 0
+        self.index = 0
+        self.playing = False
+        self.waiting = None
+        self.deadline = 0
+
+        self.pool = QtCore.QThreadPool(self)
+        if source.serial:
+            self.pool.setMaxThreadCount(1)
+        self.signals = FrameSignals(self)
+        self.signals.ready.connect(self.on_ready)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.advance)
+
+    def play(self):
+        if self.playing:
+            return
+        self.playing = True
+        self.deadline = time.perf_counter()
+        self.advance()
+
+    def pause(self):
+        self.playing = False
+        self.timer.stop()
+
+    def toggle(self):
+        if self.playing:
+            self.pause()
+        else:
+            self.play()
+
+    def stop(self):
+        self.pause()
+        self.generation += 1
+        self.pool.clear()
+        self.frames.clear()
+        self.requested.clear()
+        self.failed.clear()
+
+    def step(self, delta):
+        """
+        Pauses and shows the frame delta frames away, waiting for it to be decoded when needed
+        :param delta:
+        :return:
+        """
+        self.pause()
+        self.seek((self.index + delta) % self.source.count)
+
+    def seek(self, index):
+        if index in self.frames:
+            self.show(index)
+        elif index in self.failed:
+            self.pass_over(index, self.failed[index])
+        else:
+            self.waiting = index
+            self.request(index)
+            self.fill()
+
+    def advance(self):
+        self.seek((self.index + 1) % self.source.count)
+
+    def show(self, index):
+        self.waiting = None
+        self.index = index
+        pyramid, duration = self.frames[index]
+        self.schedule(duration)
+        self.frame_changed.emit(index, pyramid)
+        self.evict()
+        self.fill()
+
+    def schedule(self, duration):
+        if self.playing:
+            now = time.perf_counter()
+            # On time the frame starts at the previous deadline, late it starts now and the delay is not made up
+            self.deadline = max(self.deadline, now) + duration / 1000.
+            self.timer.start(max(0, int(round((self.deadline - now) * 1000))))
+
+    def pass_over(self, index, duration):
+        """
+        Moves past a frame that cannot be decoded after its duration, holding the previous one on screen, so one
+        corrupt file does not stop the sequence
+        :param index:
+        :param duration:
+        :return:
+        """
+        self.waiting = None
+        self.index = index
+        self.schedule(duration)
+        self.fill()
+
+    def ahead(self, index):
+        return (index - self.index) % self.source.count
+
+    def fill(self):
+        # The two frames behind are kept for stepping back, the rest of the ring is decoded ahead
+        for offset in range(self.capacity - 2):
+            self.request((self.index + offset) % self.source.count)
+
+    def request(self, index):
+        if index in self.frames or index in self.requested or index in self.failed:
+            return
+        self.requested.add(index)
+        self.pool.start(FrameTask(self.source, index, self.generation, self.signals))
+
+    def distance(self, index):
+        """
+        :param index:
+        :return: sort key by which frames are evicted from the largest: first those outside the ring, played longest
+        ago first, then those ahead from the furthest, and the two behind the current frame last
+        """
+        ahead = self.ahead(index)
+        behind = self.source.count - ahead
+        if ahead < self.capacity - 2:
+            return 1, ahead
+        if behind <= 2:
+            return 0, behind
+        return 2, behind
+
+    def evict(self):
+        """
+        Drops frames until the ring is within its capacity and budget, never the current frame
+        :return:
+        """
+        total = sum(pyramid.nbytes() for pyramid, _ in self.frames.values())
+        while len(self.frames) > 1 and (len(self.frames) > self.capacity or total > self.max_bytes):
+            index = max((index for index in self.frames if index != self.index), key=self.distance)
+            pyramid, _ = self.frames.pop(index)
+            total -= pyramid.nbytes()
+
+    @QtCore.pyqtSlot(int, int, object, float)
+    def on_ready(self, generation, index, pyramid, duration):
+        if generation != self.generation:
+            return
+        self.requested.discard(index)
+        if pyramid is None:
+            profiler.count("frame failed")
+            self.failed[index] = duration
+            if index == self.waiting:
+                self.pass_over(index, duration)
+            return
+        self.frames[index] = (pyramid, duration)
+        if index == self.waiting:
+            self.show(index)
+        else:
+            self.evict()
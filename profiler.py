@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+import json
+import os
+import sys
+import time
+
+
+class Section(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+class NullSection(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Profiler(object):
+    """
+    Keeps the most recent timings of each named phase in ring buffers, along with counters and gauges.  It is off
+    unless FEATHERVIEW_PROFILE is set; a value other than 1 is taken as the log file the numbers are dumped to.
+    deque appends are atomic, so worker threads record into the same instance as the GUI thread, and readers work
+    on copies since a worker may add a name while they iterate.
+    """
+
+    def __init__(self, capacity=240):
+        self.capacity = capacity
+        setting = os.environ.get("FEATHERVIEW_PROFILE", "")
+        self.enabled = setting != ""
+        self.requested = self.enabled
+        self.huds = 0
+        self.log_file = setting if setting not in ("", "1") else None
+        self.timings = {}
+        self.counters = {}
+        self.gauges = {}
+        self.frames = deque(maxlen=capacity)
+
+    def show_hud(self, shown):
+        """
+        The HUD needs timings, so the profiler is on while any HUD is shown and back as it was once none is
+        :param shown:
+        :return:
+        """
+        self.huds = max(0, self.huds + (1 if shown else -1))
+        self.enabled = self.requested or self.huds > 0
+
+    def section(self, name):
+        if not self.enabled:
+            return NullSection()
+        return Section(self, name)
+
+    def record(self, name, milliseconds):
+        timings = self.timings.get(name)
+        if timings is None:
+            timings = self.timings.setdefault(name, deque(maxlen=self.capacity))
+        timings.append(milliseconds)
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def frame(self):
+        if self.enabled:
+            self.frames.append(time.perf_counter())
+
+    def last(self, name):
+        timings = list(self.timings.get(name, ()))
+        return timings[-1] if timings else None
+
+    def mean(self, name):
+        timings = list(self.timings.get(name, ()))
+        return sum(timings) / len(timings) if timings else None
+
+    def snapshot(self):
+        """
+        :return: dict of name to a list of its recent timings, copied so workers can keep recording
+        """
+        return dict((name, list(timings)) for name, timings in list(self.timings.items()))
+
+    def fps(self):
+        frames = self.frames
+        if len(frames) < 2 or frames[-1] == frames[0]:
+            return 0.
+        return (len(frames) - 1) / (frames[-1] - frames[0])
+
+    def hit_rate(self, name):
+        hits = self.counters.get(name + " hit", 0)
+        misses = self.counters.get(name + " miss", 0)
+        if hits + misses == 0:
+            return None
+        return float(hits) / (hits + misses)
+
+    def summary(self, snapshot=None):
+        snapshot = snapshot if snapshot is not None else self.snapshot()
+        return {"fps": self.fps(),
+                "timings": dict((name, {"last": timings[-1], "mean": sum(timings) / len(timings),
+                                        "max": max(timings)})
+                                for name, timings in snapshot.items() if timings),
+                "counters": dict(list(self.counters.items())),
+                "gauges": dict(list(self.gauges.items()))}
+
+    def hud_lines(self):
+        lines = ["%.1f fps" % self.fps()]
+        for name in ("paint", "read", "decode", "pyramid", "upload", "rendition"):
+            if self.last(name) is not None:
+                lines.append("%s %.1f ms (mean %.1f)" % (name, self.last(name), self.mean(name)))
+        for name in ("tile", "image"):
+            if self.hit_rate(name) is not None:
+                lines.append("%s cache hits %.0f%%" % (name, 100 * self.hit_rate(name)))
+        for name, value in sorted(list(self.gauges.items())):
+            lines.append("%s %.1f MB" % (name, value / 1024. / 1024.))
+        return lines
+
+    def dump(self, path=None):
+        path = path or self.log_file
+        if path is None:
+            return
+        snapshot = self.snapshot()
+        report = self.summary(snapshot)
+        report["buffers"] = snapshot
+        with open(path, 'a') as file:
+            file.write(json.dumps(report, sort_keys=True) + "\n")
+
+
+class StartupTimer(object):
+    """
+    Marks the phases of a cold launch.  Set FEATHERVIEW_STARTUP to print the breakdown, and
+    FEATHERVIEW_STARTUP_BUDGET to a number of milliseconds to be warned whenever a launch goes over it.
+    """
+
+    def __init__(self, begin):
+        self.marks = [("begin", begin)]
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+
+    def phases(self):
+        return [(name, (end - start) * 1000) for (_, start), (name, end) in zip(self.marks, self.marks[1:])]
+
+    def finish(self):
+        phases = self.phases()
+        for name, milliseconds in phases:
+            profiler.record("startup " + name, milliseconds)
+        total = sum(milliseconds for _, milliseconds in phases)
+        budget = float(os.environ.get("FEATHERVIEW_STARTUP_BUDGET", 0))
+        if os.environ.get("FEATHERVIEW_STARTUP") or 0 < budget < total:
+            lines = ["%-14s %8.1f ms" % (name, milliseconds) for name, milliseconds in phases]
+            lines.append("%-14s %8.1f ms" % ("total", total))
+            if 0 < budget < total:
+                lines.append("over the startup budget of %.0f ms" % budget)
+            sys.stderr.write("\n".join(lines) + "\n")
+
+
+profiler = Profiler()
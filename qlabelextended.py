@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 from PyQt5 import QtGui, QtWidgets, QtCore
-from PyQt5.QtCore import QRectF
+from PyQt5.QtCore import QRectF, QPointF
+from tilepyramid import TilePyramid, RENDITION_STEPS, IDENTITY, compose, oriented_size, orientation_transform
+from profiler import profiler
 import weakref
+import math
+import time
 
 
 def sign(x):
@@ -14,6 +18,9 @@ class QLabelExtended(QtWidgets.QLabel):
     """
     Extends QLabel to allow for ease of qpixmap loading and manipulating (translating and zooming)
     """
+    first_frame = QtCore.pyqtSignal()
+    view_changed = QtCore.pyqtSignal()
+    hovered = QtCore.pyqtSignal(float, float)
 
     def __init__(self, name="", parent=None):
         super(QLabelExtended, self).__init__(parent)
@@ -51,13 +58,66 @@ class QLabelExtended(QtWidgets.QLabel):
         self.timer.setSingleShot(True)
         self.just_switched = False
 
+        self.interacting = False
+        self.settle_timer = QtCore.QTimer()
+        self.settle_timer.timeout.connect(self.settle)
+        self.settle_timer.setSingleShot(True)
+
+        self.frame_timer = QtCore.QTimer()
+        self.frame_timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.frame_timer.timeout.connect(self.render_frame)
+        self.frame_timer.setSingleShot(True)
+        self.last_frame = 0
+        self.full_frame = False
+        self.checked_state = None
+        self.painted_state = None
+        self.announced_state = None
+        self.show_hud = False
+        self.overlay = None
+
+        # The view works in oriented coordinates, the image turned and mirrored by its EXIF orientation and the
+        # user's on top of that, and maps to image coordinates only at its edges: point, convert, return_viewport
+        self.orientation = IDENTITY
+        self.extra_orientation = IDENTITY
+        self.orient = QtGui.QTransform()
+        self.unorient = QtGui.QTransform()
+        self.device_ratio = 1.
+
         # self.mili_now = 0
 
-        self.init_gestures()
+        # Gestures are not needed to put the first image on screen
+        self.frames_painted = 0
+        self.first_frame.connect(self.init_gestures)
+        self.first_frame.connect(self.watch_screen)
 
     def init_gestures(self):
         self.grabGesture(QtCore.Qt.PinchGesture)
 
+    def watch_screen(self):
+        self.device_ratio = self.devicePixelRatioF()
+        handle = self.window().windowHandle()
+        if handle is not None:
+            handle.screenChanged.connect(self.screen_changed)
+
+    def screen_changed(self, screen):
+        """
+        Keeps a pixel exact view pixel exact when the window moves to a screen of another device pixel ratio, and
+        otherwise keeps the size the image has on screen.  Renditions are keyed by their step, which includes the
+        ratio, so those of both screens share one cache and moving back redraws from them.
+        :param screen:
+        :return:
+        """
+        ratio = self.devicePixelRatioF()
+        if ratio == self.device_ratio:
+            return
+        exact = abs(self.get_magnification() * self.device_ratio / ratio - 1) < 1e-6
+        self.device_ratio = ratio
+        if self.qpixmap_ref() is None:
+            return
+        if exact:
+            self.set_magnification(1)
+        self.request_frame(full=True)
+
     @QtCore.pyqtSlot(QtCore.QObject)
     def event(self, event):
         if self.qpixmap_ref is None:
@@ -96,7 +156,8 @@ class QLabelExtended(QtWidgets.QLabel):
         self.qpixmap = weakref.proxy(qpixmap)
         self.qpixmap_ref = weakref.ref(qpixmap)
         self.draw_qpixmap = True
-        self.qpixmap_size = [self.qpixmap.size().width(), self.qpixmap.size().height()]
+        self.extra_orientation = IDENTITY
+        self.apply_orientation()
 
         if self.qpixmap_size != self.old_qpixmap_size:
             self.old_qpixmap_size = self.qpixmap_size
@@ -123,6 +184,66 @@ class QLabelExtended(QtWidgets.QLabel):
 
         self.update()
 
+    def replace(self, qpixmap):
+        """
+        Swaps in another rendition of the image already shown, e.g. the full decode after a preview, scaling the
+        zoom and pan state so the view does not jump
+        :param qpixmap:
+        :return:
+        """
+        if self.qpixmap_ref() is None or self.initialized is False:
+            self.initialize(qpixmap)
+            return
+
+        old_width = float(self.qpixmap_size[0])
+        self.qpixmap = weakref.proxy(qpixmap)
+        self.qpixmap_ref = weakref.ref(qpixmap)
+        self.draw_qpixmap = True
+        self.apply_orientation()
+
+        scale = self.qpixmap_size[0] / old_width
+        center_x = self.center_x * scale
+        center_y = self.center_y * scale
+        half_width = self.half_width * scale
+        self.old_qpixmap_size = self.qpixmap_size
+        self.Center = [float(self.qpixmap_size[0]) / 2., float(self.qpixmap_size[1]) / 2.]
+        self.calculate_ratio()
+
+        self.center_x = center_x
+        self.center_y = center_y
+        self.half_width = half_width
+        self.update()
+
+    def apply_orientation(self):
+        pyramid = self.qpixmap_ref()
+        width, height = pyramid.size().width(), pyramid.size().height()
+        self.orientation = compose(getattr(pyramid, "orientation", IDENTITY), self.extra_orientation)
+        self.orient = orientation_transform(self.orientation, width, height)
+        self.unorient = self.orient.inverted()[0]
+        self.qpixmap_size = list(oriented_size(self.orientation, width, height))
+
+    def reorient(self, orientation):
+        """
+        Turns or mirrors the view on top of the orientation of the image, keeping the point at the center and the
+        magnification.  Tiles are drawn from caches of oriented tiles, so nothing is decoded or resampled again.
+        :param orientation: (quarter turns clockwise, mirrored)
+        :return:
+        """
+        if self.qpixmap_ref() is None:
+            return
+        magnification = self.get_magnification()
+        center = self.unorient.map(QPointF(self.center_x, self.center_y))
+        self.extra_orientation = compose(self.extra_orientation, orientation)
+        self.apply_orientation()
+        center = self.orient.map(center)
+        self.center_x = center.x()
+        self.center_y = center.y()
+        self.old_qpixmap_size = self.qpixmap_size
+        self.Center = [float(self.qpixmap_size[0]) / 2., float(self.qpixmap_size[1]) / 2.]
+        self.calculate_ratio()
+        self.set_magnification(magnification ** -1)
+        self.request_frame(full=True)
+
     def return_qpixmap(self):
         if self.qpixmap_ref() is None:
             return None
@@ -164,6 +285,96 @@ class QLabelExtended(QtWidgets.QLabel):
 
         self.timer.start(1000)
 
+    def interact(self):
+        """
+        Marks the view as being zoomed or panned so frames are drawn with the cheap nearest-neighbour path until input
+        stops for a moment
+        :return:
+        """
+        self.interacting = True
+        self.settle_timer.start(150)
+
+    def settle(self):
+        self.interacting = False
+        self.update()
+
+    def view_state(self):
+        return self.center_x, self.center_y, self.half_width, self.size[0], self.size[1], self.qpixmap_ref()
+
+    def frame_interval(self):
+        handle = self.window().windowHandle()
+        screen = handle.screen() if handle is not None else QtGui.QGuiApplication.primaryScreen()
+        rate = screen.refreshRate() if screen is not None else 0
+        return 1000.0 / (rate or 60.0)
+
+    def request_frame(self, full=False):
+        """
+        Coalesces view changes into at most one repaint per display refresh
+        :param full: the whole widget has to be redrawn even when the change is a plain pan
+        :return:
+        """
+        self.full_frame = self.full_frame or full
+        if self.frame_timer.isActive():
+            return
+        elapsed = (time.perf_counter() - self.last_frame) * 1000
+        self.frame_timer.start(max(0, int(self.frame_interval() - elapsed)))
+
+    def render_frame(self):
+        """
+        Applies the changes gathered since the last frame.  A pan by whole pixels scrolls what is already on screen
+        so only the newly exposed strips are painted.
+        :return:
+        """
+        self.last_frame = time.perf_counter()
+        if self.qpixmap_ref() is None:
+            return
+        self.check_bounds()
+        self.checked_state = state = self.view_state()
+        painted = self.painted_state
+        if self.full_frame or self.show_hud or painted is None or painted[2:] != state[2:]:
+            self.update()
+        elif painted[:2] != state[:2]:
+            scale = self.size[0] / (2 * self.half_width * self.ratio[0])
+            delta_x = (painted[0] - state[0]) * scale
+            delta_y = (painted[1] - state[1]) * scale
+            # A fractional device pixel ratio would land the scrolled pixels between device pixels
+            if (abs(delta_x - round(delta_x)) < 0.01 and abs(delta_y - round(delta_y)) < 0.01 and
+                    abs(delta_x) < self.size[0] and abs(delta_y) < self.size[1] and
+                    self.devicePixelRatioF().is_integer()):
+                self.scroll(int(round(delta_x)), int(round(delta_y)))
+                self.painted_state = state
+            else:
+                self.update()
+        self.full_frame = False
+        # Hover and HUD frames leave the view where it was, and nothing listening needs to hear about those
+        announced = state + (self.orientation,)
+        if announced != self.announced_state:
+            self.announced_state = announced
+            self.view_changed.emit()
+
+    def relative_view(self):
+        """
+        Zoom and pan in units of the image width, so views of images of different resolutions can be lined up
+        :return: (center_x, center_y, half_width)
+        """
+        width = float(self.qpixmap_size[0])
+        return self.center_x / width, self.center_y / width, self.half_width / width
+
+    def set_relative_view(self, relative):
+        width = float(self.qpixmap_size[0])
+        self.center_x = relative[0] * width
+        self.center_y = relative[1] * width
+        self.half_width = relative[2] * width
+
+    def pixel_round(self, distance):
+        """
+        Rounds a distance in image coordinates to a whole number of screen pixels, so the pan can be scrolled
+        :param distance:
+        :return:
+        """
+        scale = self.size[0] / (2 * self.half_width * self.ratio[0])
+        return round(distance * scale) / scale
+
     def hide_mouse(self):
         QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.BlankCursor)
         self.mouse_hidden = True
@@ -188,10 +399,11 @@ class QLabelExtended(QtWidgets.QLabel):
             self.zoom((1 + 0.1 * Scale ) ** scale, QtCore.QPoint(event.x(), event.y()))
         else:
             scale = self.half_width / 100 * (event.angleDelta().y() / 40)
-            self.center_y += scale
+            self.center_y += self.pixel_round(scale)
             scale = self.half_width / 100 * (event.angleDelta().x() / 40)
-            self.center_x += scale
-            self.update()
+            self.center_x += self.pixel_round(scale)
+            self.interact()
+            self.request_frame()
 
     def zoom(self, factor, center):
         half_width = self.half_width
@@ -219,7 +431,8 @@ class QLabelExtended(QtWidgets.QLabel):
         self.center_x = mouse_x - 2 * self.half_width / min_size * x_r
         self.center_y = mouse_y - 2 * self.half_width / min_size * y_r
 
-        self.update()
+        self.interact()
+        self.request_frame()
 
     def calculate_ratio(self):
         half_width = self.half_width
@@ -260,7 +473,14 @@ class QLabelExtended(QtWidgets.QLabel):
         if self.qpixmap_ref() is None:
             return
 
-        self.check_bounds()
+        state = self.view_state()
+        if state != self.checked_state:
+            self.check_bounds()
+            self.checked_state = state = self.view_state()
+        if event.rect() != self.rect() and state != self.painted_state:
+            # Part of the widget still shows an older view, so this partial paint cannot stand on its own
+            self.update()
+        self.painted_state = state
 
         size = self.size
         half_width = self.half_width
@@ -280,16 +500,107 @@ class QLabelExtended(QtWidgets.QLabel):
 
         painter = self.painter
         painter.begin(self)
-        if self.center_x - ratio_x != 0:
-            if size[0] / ratio_x < 4:
-                painter.setRenderHint(QtGui.QPainter.Antialiasing, True)
-                painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform, True)
-        painter.drawPixmap(target, self.qpixmap_ref(), source)
+        with profiler.section("paint"):
+            if self.center_x - ratio_x != 0:
+                if size[0] / ratio_x < 4:
+                    painter.setRenderHint(QtGui.QPainter.Antialiasing, True)
+                    painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform, True)
+            if isinstance(self.qpixmap_ref(), TilePyramid):
+                scale = size[0] / source.width()
+                exposed = QRectF(event.rect())
+                viewport = (source.x() + exposed.x() / scale, source.y() + exposed.y() / scale,
+                            exposed.width() / scale, exposed.height() / scale)
+                self.paint_tiles(painter, self.qpixmap_ref(), source, viewport)
+                profiler.gauge("pixmaps", self.qpixmap_ref().tiles.nbytes + self.qpixmap_ref().renditions.nbytes)
+            else:
+                painter.drawPixmap(target, self.qpixmap_ref(), source)
+        profiler.frame()
+        self.frames_painted += 1
+        if self.frames_painted == 1:
+            QtCore.QTimer.singleShot(0, self.first_frame.emit)
+
+        if self.overlay is not None:
+            painter.resetTransform()
+            with profiler.section("overlay"):
+                self.overlay.paint(painter, self)
+
+        if self.show_hud:
+            painter.resetTransform()
+            self.paint_hud(painter)
         painter.end()
 
+    def paint_hud(self, painter):
+        """
+        Draws the profiler readings in the top left corner
+        :param painter:
+        :return:
+        """
+        lines = profiler.hud_lines()
+        metrics = painter.fontMetrics()
+        height = metrics.height()
+        width = max(metrics.width(line) for line in lines)
+        painter.fillRect(QRectF(4, 4, width + 12, height * len(lines) + 8), QtGui.QColor(0, 0, 0, 160))
+        painter.setPen(QtCore.Qt.white)
+        for index, line in enumerate(lines):
+            painter.drawText(10, 8 + metrics.ascent() + index * height, line)
+
+    def paint_tiles(self, painter, pyramid, source, viewport):
+        """
+        Draws only the tiles of the level matching the current magnification that intersect the viewport, so the
+        cost of a frame depends on the widget size rather than on the image size
+        :param painter:
+        :param pyramid:
+        :param source: whole widget in oriented image coordinates
+        :param viewport: (x, y, width, height) of the area being repainted in oriented image coordinates
+        :return:
+        """
+        # Tiles are placed in device pixels with their edges rounded, so a rendition made for the screen is blitted
+        # one to one and neighbouring tiles meet without seams at any device pixel ratio
+        ratio = self.devicePixelRatioF()
+        scale = self.size[0] / source.width() * ratio
+        painter.scale(1 / ratio, 1 / ratio)
+        orientation = self.orientation
+        bounds = self.unorient.mapRect(QRectF(*viewport))
+        viewport = (bounds.x(), bounds.y(), bounds.width(), bounds.height())
+
+        magnification = self.get_magnification()
+        level = pyramid.level_for(magnification)
+        tile_scale = magnification * pyramid.level_scale(level)[0]
+
+        # While the user zooms or pans tiles are blitted unfiltered.  Once input settles, downscaled tiles are
+        # replaced by renditions made at the quantized scale, so only a residual of about 1% is left to filter.
+        smooth = self.interacting is False and tile_scale < 2
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform, smooth)
+        step = None
+        if smooth and tile_scale < 1:
+            step = int(round(math.log(tile_scale, 2) * RENDITION_STEPS))
+
+        deadline = time.perf_counter() + 0.008
+        incomplete = False
+        for tx, ty, rect in pyramid.visible_tiles(level, viewport):
+            qpixmap = None
+            if step is not None:
+                qpixmap = pyramid.rendition(level, tx, ty, step, build=time.perf_counter() < deadline,
+                                            orientation=orientation)
+                incomplete = incomplete or qpixmap is None
+            if qpixmap is None:
+                qpixmap = pyramid.tile(level, tx, ty, orientation)
+            rect = self.orient.mapRect(rect)
+            left = int(round((rect.left() - source.x()) * scale))
+            top = int(round((rect.top() - source.y()) * scale))
+            right = int(round((rect.right() - source.x()) * scale))
+            bottom = int(round((rect.bottom() - source.y()) * scale))
+            painter.drawPixmap(QtCore.QRect(left, top, right - left, bottom - top), qpixmap, qpixmap.rect())
+
+        if incomplete:
+            # Build the remaining renditions over the next frames rather than stalling this one
+            QtCore.QTimer.singleShot(0, self.update)
+
     @QtCore.pyqtSlot(QtCore.QObject)
     def point(self, pt):
         point = QtCore.QPoint()
+        pt = self.orient.map(QPointF(pt[0], pt[1]))
+        pt = [pt.x(), pt.y()]
 
         rpc = (self.size[0]) / (2 * self.half_width * self.ratio[0])
 
@@ -301,6 +612,24 @@ class QLabelExtended(QtWidgets.QLabel):
 
         return point
 
+    def image_transform(self):
+        """
+        The mapping of point, from image to widget coordinates, as a QTransform for QPainter
+        :return:
+        """
+        rpc = self.image_scale()
+        return self.orient * QtGui.QTransform(rpc, 0, 0, rpc,
+                                              (self.half_width - self.center_x) * rpc +
+                                              (self.ratio[0] - 1) / 2.0 * self.size[1],
+                                              (self.half_width - self.center_y) * rpc +
+                                              (self.ratio[1] - 1) / 2.0 * self.size[0])
+
+    def image_scale(self):
+        """
+        :return: widget pixels per image pixel
+        """
+        return (self.size[0]) / (2 * self.half_width * self.ratio[0])
+
     @QtCore.pyqtSlot(QtCore.QObject)
     def convert(self, pt):
         point = [0, 0]
@@ -313,7 +642,8 @@ class QLabelExtended(QtWidgets.QLabel):
         point[1] = ((pt[1] - (self.ratio[1] - 1) / 2.0 * self.size[0]) / rpc +
                     self.center_y - self.half_width)
 
-        return point
+        point = self.unorient.map(QPointF(point[0], point[1]))
+        return [point.x(), point.y()]
 
     def resetView(self):
         if self.qpixmap_ref() is None:
@@ -322,7 +652,7 @@ class QLabelExtended(QtWidgets.QLabel):
         self.center_y = self.Center[1]
         self.half_width = self.Half_width
         self.draw_line = False
-        self.update()
+        self.request_frame(full=True)
 
     @QtCore.pyqtSlot(QtCore.QObject)
     def mouseDoubleClickEvent(self, event):
@@ -393,6 +723,8 @@ class QLabelExtended(QtWidgets.QLabel):
 
         if self.panning_mode is not True:
             self.cycle_timer()
+            x, y = self.convert([event.x(), event.y()])
+            self.hovered.emit(x, y)
 
         if self.old_panning_point[0] is None or self.old_panning_point[1] is None:
             return
@@ -412,10 +744,11 @@ class QLabelExtended(QtWidgets.QLabel):
                 self.center_y -= 2 * self.half_width / self.panning_scale * delta_y * self.ratio[0]
 
                 self.old_panning_point = [event.x(), event.y()]
+                self.interact()
 
         event.accept()
 
-        self.update()
+        self.request_frame()
 
     @QtCore.pyqtSlot(list)
     def set_viewscope(self, coords):
@@ -423,7 +756,7 @@ class QLabelExtended(QtWidgets.QLabel):
             self.set_magnification(coords[0] ** -1)
             self.center_x = coords[1]
             self.center_y = coords[2]
-            self.update()
+            self.request_frame()
 
     def toggle_fullscreen(self):
         if self.full_screen is False:
@@ -452,22 +785,34 @@ class QLabelExtended(QtWidgets.QLabel):
             self.show()
             self.calculate_ratio()
 
+        if event.key() == QtCore.Qt.Key_I:
+            self.show_hud = not self.show_hud
+            profiler.show_hud(self.show_hud)
+            self.request_frame(full=True)
+
         if event.key() == QtCore.Qt.Key_F:
             if self.get_magnification() == 1:
                 self.resetView()
             else:
                 self.set_magnification(1)
 
+        if event.key() == QtCore.Qt.Key_R:
+            self.reorient((1, False))
+        if event.key() == QtCore.Qt.Key_E:
+            self.reorient((3, False))
+        if event.key() == QtCore.Qt.Key_M:
+            self.reorient((0, True))
+
         if event.key() == QtCore.Qt.Key_Right:
-            self.center_x += self.half_width / 10
+            self.center_x += self.pixel_round(self.half_width / 10)
         if event.key() == QtCore.Qt.Key_Left:
-            self.center_x -= self.half_width / 10
+            self.center_x -= self.pixel_round(self.half_width / 10)
         if event.key() == QtCore.Qt.Key_Up:
-            self.center_y += self.half_width / 10
+            self.center_y += self.pixel_round(self.half_width / 10)
         if event.key() == QtCore.Qt.Key_Down:
-            self.center_y -= self.half_width / 10
+            self.center_y -= self.pixel_round(self.half_width / 10)
 
-        self.update()
+        self.request_frame()
 
     @QtCore.pyqtSlot(QtCore.QObject)
     def keyReleaseEvent(self, event):
@@ -475,14 +820,19 @@ class QLabelExtended(QtWidgets.QLabel):
             return
 
     def set_magnification(self, mag):
-        self.half_width = mag * self.size[0] / 2 / self.ratio[0] * self.window().devicePixelRatio()
+        self.half_width = mag * self.size[0] / 2 / self.ratio[0] * self.window().devicePixelRatioF()
 
     def get_magnification(self):
-        return (2 * self.ratio[0] * self.half_width / self.size[0]) ** -1 * self.window().devicePixelRatio()
+        return (2 * self.ratio[0] * self.half_width / self.size[0]) ** -1 * self.window().devicePixelRatioF()
 
     def return_viewport(self):
-        return (self.center_x - self.half_width * self.ratio[0], self.center_y - self.half_width * self.ratio[1],
-                2 * self.half_width * self.ratio[0], 2 * self.half_width * self.ratio[1])
+        """
+        :return: (x, y, width, height) of the widget in image coordinates
+        """
+        rect = self.unorient.mapRect(QRectF(self.center_x - self.half_width * self.ratio[0],
+                                            self.center_y - self.half_width * self.ratio[1],
+                                            2 * self.half_width * self.ratio[0], 2 * self.half_width * self.ratio[1]))
+        return rect.x(), rect.y(), rect.width(), rect.height()
 
     @property
     def half_width(self):
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import getpass
+import os
+import socket
+import tempfile
+
+
+def server_name():
+    name = "FeatherView-" + getpass.getuser()
+    if os.name == 'nt':
+        return name
+    return os.path.join(tempfile.gettempdir(), name + ".sock")
+
+
+def handoff(argv):
+    """
+    Sends the file named on the command line to a running viewer, unless --new-window or --watch was given
+    :param argv:
+    :return: True when the file was handed over and this process can exit
+    """
+    if "--new-window" in argv or "--watch" in argv:
+        return False
+    arguments = [argument for argument in argv[1:] if not argument.startswith("--")]
+    return len(arguments) == 1 and os.path.isfile(arguments[0]) and send_to_running(arguments[0])
+
+
+def is_running():
+    """
+    :return: True when a viewer answers on the server name, False when nothing does or the socket is stale
+    """
+    if os.name != 'nt':
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(1)
+        try:
+            client.connect(server_name())
+            return True
+        except OSError:
+            return False
+        finally:
+            client.close()
+
+    from PyQt5 import QtNetwork
+    client = QtNetwork.QLocalSocket()
+    client.connectToServer(server_name())
+    connected = client.waitForConnected(500)
+    client.abort()
+    return connected
+
+
+def send_to_running(file_name):
+    """
+    Hands file_name to a viewer that is already running.  On POSIX this talks to the QLocalServer socket directly so
+    the caller never has to import PyQt5.
+    :param file_name:
+    :return: True when a running viewer accepted the file
+    """
+    message = (os.path.abspath(file_name) + "\n").encode("utf-8")
+    if os.name != 'nt':
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(1)
+        try:
+            client.connect(server_name())
+            client.sendall(message)
+            return True
+        except OSError:
+            return False
+        finally:
+            client.close()
+
+    from PyQt5 import QtNetwork
+    client = QtNetwork.QLocalSocket()
+    client.connectToServer(server_name())
+    if not client.waitForConnected(500):
+        return False
+    client.write(message)
+    client.waitForBytesWritten(1000)
+    client.disconnectFromServer()
+    return True
+
+
+class InstanceServer(object):
+    """
+    Listens for file names sent by later launches and passes each one to callback
+    """
+
+    def __init__(self, callback):
+        from PyQt5 import QtNetwork
+
+        self.callback = callback
+        self.connections = []
+        self.server = QtNetwork.QLocalServer()
+        self.server.setSocketOptions(QtNetwork.QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self.accept)
+        if not self.server.listen(server_name()) and not is_running():
+            # The server only starts after the first frame, so a launch that began before this one may have taken
+            # the name meanwhile; only a socket nothing answers on is stale and safe to remove
+            QtNetwork.QLocalServer.removeServer(server_name())
+            self.server.listen(server_name())
+
+    def accept(self):
+        while self.server.hasPendingConnections():
+            connection = self.server.nextPendingConnection()
+            connection.buffer = b""
+            connection.readyRead.connect(lambda connection=connection: self.read(connection))
+            connection.disconnected.connect(lambda connection=connection: self.close(connection))
+            self.connections.append(connection)
+
+    def read(self, connection):
+        connection.buffer += bytes(connection.readAll())
+        while b"\n" in connection.buffer:
+            line, connection.buffer = connection.buffer.split(b"\n", 1)
+            if line:
+                self.callback(line.decode("utf-8"))
+
+    def close(self, connection):
+        self.read(connection)
+        if connection in self.connections:
+            self.connections.remove(connection)
+        connection.deleteLater()
+
+    def shutdown(self):
+        self.server.close()
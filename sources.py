@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+"""
+Images that are not plain files: members of ZIP/CBZ and TAR/CBT archives, named as archive.cbz!/page01.jpg, and
+HTTP(S) URLs read with range requests.  Each is opened as a seekable file object and handed to QImageReader through
+a QIODevice, so only the bytes a reader asks for are fetched.
+
+The HTTP and archive modules are imported when they are first used, as most launches open a plain file, and the
+errors they raise are turned into OSError so callers only need SOURCE_ERRORS.
+"""
+from PyQt5 import QtGui, QtCore
+from collections import OrderedDict
+import io
+import os
+import re
+import struct
+import threading
+
+
+MEMBER_SEPARATOR = "!/"
+ZIP_EXTENSIONS = (".zip", ".cbz")
+TAR_EXTENSIONS = (".tar", ".cbt", ".tgz", ".tar.gz", ".tar.bz2", ".tar.xz")
+PROBE_BYTES = 64 * 1024
+SOURCE_ERRORS = (OSError, KeyError)
+
+
+def is_url(name):
+    return name.lower().startswith(("http://", "https://"))
+
+
+def is_archive(name):
+    return name.lower().endswith(ZIP_EXTENSIONS + TAR_EXTENSIONS)
+
+
+def split_member(name):
+    """
+    :param name:
+    :return: (archive, member), or None when name does not point into an archive
+    """
+    if is_url(name) or MEMBER_SEPARATOR not in name:
+        return None
+    archive, member = name.split(MEMBER_SEPARATOR, 1)
+    if not is_archive(archive):
+        return None
+    return archive, member
+
+
+def is_virtual(name):
+    return is_url(name) or split_member(name) is not None
+
+
+def absolute(name):
+    """
+    os.path.abspath for files and archive members, URLs are left as they are
+    :param name:
+    :return:
+    """
+    if is_url(name):
+        return name
+    member = split_member(name)
+    if member is not None:
+        return os.path.abspath(member[0]) + MEMBER_SEPARATOR + member[1]
+    return os.path.abspath(name)
+
+
+def exists(name):
+    if is_url(name):
+        return True
+    member = split_member(name)
+    return os.path.isfile(member[0] if member is not None else name)
+
+
+def first_image(name, extensions):
+    """
+    Resolves an archive named on its own to its first image, anything else to itself
+    :param name:
+    :param extensions: image file extensions, lower case with the dot
+    :return: name of an image, or None for an archive without images
+    """
+    if is_archive(name) and os.path.isfile(name):
+        try:
+            members = list_archive(name, extensions)
+        except SOURCE_ERRORS:
+            return None
+        return members[0] if members else None
+    return name
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive HTTP connections per host, shared by the decode threads so a series of range requests to the
+    same server does not pay for a new TCP and TLS handshake each time
+    """
+
+    def __init__(self, per_host=4, timeout=30):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, host):
+        import http.client
+
+        with self.lock:
+            connections = self.idle.get((scheme, host))
+            if connections:
+                return connections.pop()
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout)
+        return http.client.HTTPConnection(host, timeout=self.timeout)
+
+    def put(self, scheme, host, connection):
+        with self.lock:
+            connections = self.idle.setdefault((scheme, host), [])
+            if len(connections) < self.per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def request(self, url, headers):
+        """
+        :param url:
+        :param headers:
+        :return: (status, response, body)
+        """
+        import http.client
+        import urllib.parse
+
+        parts = urllib.parse.urlsplit(url)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        for attempt in range(2):
+            connection = self.get(parts.scheme, parts.netloc)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError) as error:
+                connection.close()
+                # A reused connection may have been dropped by the server while it was idle
+                if attempt:
+                    raise OSError("%s: %s" % (url, str(error) or type(error).__name__)) from error
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self.put(parts.scheme, parts.netloc, connection)
+            return response.status, response, body
+
+
+connections = ConnectionPool()
+
+
+class HTTPFile(object):
+    """
+    Read-only seekable file over HTTP range requests.  Data is fetched in blocks and kept in a bounded LRU.  Each
+    miss that continues the previous fetch doubles the amount read ahead, so a full decode costs a handful of
+    requests while a header probe costs a single small one.  A server that ignores ranges sends the whole file,
+    which is then kept as it is rather than downloaded again each time the LRU lets part of it go.
+    """
+
+    def __init__(self, url, block_size=64 * 1024, max_read_ahead=4 * 1024 * 1024, max_blocks=512):
+        self.url = url
+        self.block_size = block_size
+        self.max_read_ahead = max_read_ahead
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.length = None
+        self.read_ahead = block_size
+        self.next_block = None
+        self.whole = None
+
+    def fetch(self, block):
+        if block == self.next_block:
+            self.read_ahead = min(self.read_ahead * 2, self.max_read_ahead)
+        else:
+            self.read_ahead = self.block_size
+        start = block * self.block_size
+        end = start + self.read_ahead - 1
+        if self.length is not None:
+            end = min(end, self.length - 1)
+        status, response, body = connections.request(self.url, {"Range": "bytes=%d-%d" % (start, end)})
+        if status == 206:
+            total = response.getheader("Content-Range", "").rpartition("/")[2]
+            if total.isdigit():
+                self.length = int(total)
+        elif status == 200:
+            self.whole = body
+            self.length = len(body)
+            self.blocks.clear()
+            return
+        elif status == 416:
+            return
+        else:
+            raise OSError("HTTP %d for %s" % (status, self.url))
+        if self.length is None:
+            self.length = start + len(body)
+
+        first = start // self.block_size
+        for index in range(0, len(body), self.block_size):
+            self.blocks[first + index // self.block_size] = body[index:index + self.block_size]
+            self.blocks.move_to_end(first + index // self.block_size)
+        self.next_block = first + (len(body) + self.block_size - 1) // self.block_size
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+    def size(self):
+        if self.length is None:
+            self.fetch(0)
+        return self.length
+
+    def read(self, size=-1):
+        remaining = self.size() - self.position
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        chunks = []
+        while size > 0:
+            if self.whole is not None:
+                chunk = self.whole[self.position:self.position + size]
+                chunks.append(chunk)
+                self.position += len(chunk)
+                break
+            block, offset = divmod(self.position, self.block_size)
+            data = self.blocks.get(block)
+            if data is None:
+                self.fetch(block)
+                data = self.blocks.get(block)
+                if data is None and self.whole is not None:
+                    continue
+                if data is None:
+                    break
+            else:
+                self.blocks.move_to_end(block)
+            chunk = data[offset:offset + size]
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size()
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+class Archives(object):
+    """
+    Open archives, kept across reads of their members.  Each has a lock, since TarFile is not thread safe.
+    """
+
+    def __init__(self, limit=8):
+        self.limit = limit
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def handle(self, path):
+        import tarfile
+        import zipfile
+
+        modified = os.stat(path).st_mtime_ns
+        with self.lock:
+            entry = self.handles.get(path)
+            if entry is None or entry[2] != modified:
+                try:
+                    if path.lower().endswith(ZIP_EXTENSIONS) or zipfile.is_zipfile(path):
+                        archive = zipfile.ZipFile(path)
+                    else:
+                        archive = tarfile.open(path)
+                except (tarfile.TarError, zipfile.BadZipFile) as error:
+                    raise OSError("%s: %s" % (path, error)) from error
+                entry = self.handles[path] = (archive, threading.Lock(), modified)
+                while len(self.handles) > self.limit:
+                    # Another thread may still be reading the evicted archive, so it is left to close itself once
+                    # the last reference to it goes away
+                    self.handles.popitem(last=False)
+            self.handles.move_to_end(path)
+            return entry
+
+    def members(self, path):
+        import tarfile
+        import zipfile
+
+        archive, lock, _ = self.handle(path)
+        with lock:
+            try:
+                if isinstance(archive, zipfile.ZipFile):
+                    return [info.filename for info in archive.infolist() if not info.is_dir()]
+                return [info.name for info in archive.getmembers() if info.isfile()]
+            except (tarfile.TarError, zipfile.BadZipFile) as error:
+                raise OSError("%s: %s" % (path, error)) from error
+
+    def read(self, path, member):
+        import tarfile
+        import zipfile
+
+        archive, lock, _ = self.handle(path)
+        with lock:
+            try:
+                if isinstance(archive, zipfile.ZipFile):
+                    return archive.read(member)
+                return archive.extractfile(member).read()
+            except (tarfile.TarError, zipfile.BadZipFile) as error:
+                raise OSError("%s: %s" % (path, error)) from error
+
+
+archives = Archives()
+
+
+def list_archive(path, extensions):
+    """
+    :param path: archive file
+    :param extensions: file extensions of the members to list, lower case with the dot
+    :return: names of the members, in natural sort order
+    """
+    path = os.path.abspath(path)
+    return sorted((path + MEMBER_SEPARATOR + member for member in archives.members(path)
+                   if os.path.splitext(member)[1].lower() in extensions), key=natural_key)
+
+
+def natural_key(file_name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", file_name)]
+
+
+def open_source(name):
+    """
+    :param name: file, archive member or URL
+    :return: seekable binary file object
+    """
+    if is_url(name):
+        return HTTPFile(name)
+    member = split_member(name)
+    if member is not None:
+        return io.BytesIO(archives.read(*member))
+    return open(name, 'rb')
+
+
+class FileDevice(QtCore.QIODevice):
+    """
+    Presents a seekable Python file object to QImageReader.  It is unbuffered, so every read goes to the file at
+    the position Qt asked for.
+    """
+
+    def __init__(self, file):
+        super(FileDevice, self).__init__()
+        self.file = file
+        self.length = file.seek(0, 2)
+        file.seek(0)
+        self.open(QtCore.QIODevice.ReadOnly | QtCore.QIODevice.Unbuffered)
+
+    def isSequential(self):
+        return False
+
+    def size(self):
+        return self.length
+
+    def seek(self, position):
+        super(FileDevice, self).seek(position)
+        self.file.seek(position)
+        return True
+
+    def readData(self, size):
+        try:
+            return self.file.read(size)
+        except OSError:
+            return None
+
+    def writeData(self, data):
+        return -1
+
+
+def device_for(file):
+    if isinstance(file, io.BytesIO):
+        device = QtCore.QBuffer()
+        device.setData(file.getvalue())
+        device.open(QtCore.QIODevice.ReadOnly)
+        return device
+    return FileDevice(file)
+
+
+def open_reader(name):
+    """
+    :param name: file, archive member or URL
+    :return: (QImageReader, device), where the device must be kept for as long as the reader is used
+    """
+    if not is_virtual(name):
+        return QtGui.QImageReader(name), None
+    device = device_for(open_source(name))
+    return QtGui.QImageReader(device), device
+
+
+def probe(file):
+    """
+    Reads only the start of a file for its dimensions and, for JPEG, the thumbnail in its EXIF block
+    :param file:
+    :return: (QSize, which is invalid when the header is not enough, and QImage or None)
+    """
+    file.seek(0)
+    header = file.read(PROBE_BYTES)
+    file.seek(0)
+    buffer = QtCore.QBuffer()
+    buffer.setData(header)
+    buffer.open(QtCore.QIODevice.ReadOnly)
+    size = QtGui.QImageReader(buffer).size()
+    thumbnail = None
+    data = exif_thumbnail(header)
+    if data is not None:
+        thumbnail = QtGui.QImage.fromData(data)
+        if thumbnail.isNull():
+            thumbnail = None
+    return size, thumbnail
+
+
+def exif_thumbnail(data):
+    """
+    Finds the JPEG thumbnail of the EXIF APP1 segment of a JPEG file
+    :param data: start of the file
+    :return: bytes of the thumbnail, or None
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    position = 2
+    try:
+        while position + 4 <= len(data):
+            if data[position] != 0xff:
+                return None
+            marker = data[position + 1]
+            if marker == 0xff:
+                position += 1
+                continue
+            if marker == 0xda:
+                return None
+            length = struct.unpack(">H", data[position + 2:position + 4])[0]
+            if marker == 0xe1 and data[position + 4:position + 10] == b"Exif\x00\x00":
+                return tiff_thumbnail(data[position + 10:position + 2 + length])
+            position += 2 + length
+    except (struct.error, IndexError):
+        return None
+    return None
+
+
+def tiff_thumbnail(tiff):
+    order = "<" if tiff[:2] == b"II" else ">"
+    first = struct.unpack(order + "I", tiff[4:8])[0]
+    count = struct.unpack(order + "H", tiff[first:first + 2])[0]
+    second = struct.unpack(order + "I", tiff[first + 2 + 12 * count:first + 6 + 12 * count])[0]
+    if second == 0:
+        return None
+    count = struct.unpack(order + "H", tiff[second:second + 2])[0]
+    offset = length = None
+    for index in range(count):
+        entry = second + 2 + 12 * index
+        tag, _, _, value = struct.unpack(order + "HHII", tiff[entry:entry + 12])
+        if tag == 0x0201:
+            offset = value
+        elif tag == 0x0202:
+            length = value
+    if offset is None or not length or offset + length > len(tiff):
+        return None
+    return tiff[offset:offset + length]
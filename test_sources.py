@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Reads files through HTTPFile from a local http.server, once with range requests and once from a server that
+ignores them.  Run with python -m unittest test_sources.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import importlib.util
+import os
+import re
+import threading
+import unittest
+
+HAVE_QT = importlib.util.find_spec("PyQt5") is not None
+if HAVE_QT:
+    from sources import HTTPFile
+
+
+DATA = os.urandom(300 * 1024 + 17)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ranges = True
+    requests = []
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        self.requests.append(header)
+        match = re.match(r"bytes=(\d+)-(\d*)$", header or "")
+        if not self.ranges or match is None:
+            self.send_body(200, DATA)
+            return
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(DATA) - 1), len(DATA) - 1)
+        if start >= len(DATA):
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % len(DATA))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_body(206, DATA[start:end + 1], "bytes %d-%d/%d" % (start, end, len(DATA)))
+
+    def send_body(self, status, body, content_range=None):
+        self.send_response(status)
+        if content_range is not None:
+            self.send_header("Content-Range", content_range)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@unittest.skipUnless(HAVE_QT, "PyQt5 is not installed")
+class HTTPFileTest(unittest.TestCase):
+    def setUp(self):
+        RangeHandler.ranges = True
+        RangeHandler.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/image.bin" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def check_reads(self, file):
+        self.assertEqual(file.seek(0, 2), len(DATA))
+        for offset, size in ((0, 10), (70000, 5000), (len(DATA) - 100, 1000), (65530, 200000), (len(DATA), 10)):
+            file.seek(offset)
+            self.assertEqual(file.read(size), DATA[offset:offset + size])
+            self.assertEqual(file.tell(), min(offset + size, len(DATA)))
+        file.seek(0)
+        self.assertEqual(file.read(), DATA)
+
+    def test_range_requests(self):
+        file = HTTPFile(self.url, block_size=4096, max_read_ahead=64 * 1024)
+        self.check_reads(file)
+        self.assertTrue(all(header is not None for header in RangeHandler.requests))
+
+    def test_header_probe_fetches_one_block(self):
+        file = HTTPFile(self.url, block_size=4096)
+        self.assertEqual(file.read(16), DATA[:16])
+        self.assertEqual(RangeHandler.requests, ["bytes=0-4095"])
+
+    def test_server_without_ranges(self):
+        RangeHandler.ranges = False
+        file = HTTPFile(self.url, block_size=4096, max_blocks=4)
+        self.check_reads(file)
+        # The whole file came with the first response and is kept, however small the block LRU
+        self.assertEqual(len(RangeHandler.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
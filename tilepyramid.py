@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtGui, QtCore
+from collections import OrderedDict
+from profiler import profiler
+import math
+import zlib
+
+
+RENDITION_STEPS = 32
+# Rows of level 0 per checksum that tells the rows two versions of a file share
+CHECKSUM_ROWS = 64
+# Orientations are (quarter turns clockwise, mirrored), the mirror being applied before the turns
+IDENTITY = (0, False)
+
+
+class TilePyramid(object):
+    """
+    Holds an image as fixed-size tiles at power-of-two levels of detail.  Level 0 is the full resolution image and
+    each following level halves the previous one until the whole image fits in a single tile.  Only the tiles that
+    are asked for are converted to QPixmaps, and those are kept in a bounded LRU cache.
+    """
+
+    def __init__(self, qimage, tile_size=512, cache_bytes=256 * 1024 * 1024, flipped=False, mapping=None):
+        """
+        :param qimage:
+        :param tile_size:
+        :param cache_bytes: budget for the converted tile QPixmaps
+        :param flipped: qimage holds the rows bottom-up, as in most BMP files, and tiles are mirrored as they are cut
+        :param mapping: memory map owning the pixels of qimage, which is kept alive for as long as the pyramid
+        """
+        self.setup(qimage.width(), qimage.height(), tile_size, cache_bytes)
+        self.flipped = flipped
+        self.mapping = mapping
+        self.levels = [qimage] + [None] * (len(self.level_sizes) - 1)
+
+    def setup(self, width, height, tile_size, cache_bytes):
+        """
+        Lays out the levels for an image of the given size, independently of where its pixels come from
+        :param width:
+        :param height:
+        :param tile_size:
+        :param cache_bytes:
+        :return:
+        """
+        self.tile_size = tile_size
+        self.cache_bytes = cache_bytes
+        self.width = width
+        self.height = height
+
+        self.level_sizes = [(width, height)]
+        while max(width, height) > tile_size:
+            width = max(1, (width + 1) // 2)
+            height = max(1, (height + 1) // 2)
+            self.level_sizes.append((width, height))
+
+        self.tiles = PixmapCache(cache_bytes)
+        # The step of a rendition already includes the device pixel ratio, so one cache serves every screen
+        self.renditions = PixmapCache(cache_bytes // 2)
+        self.previous = None
+        self.stable_rows = []
+        self.orientation = IDENTITY
+        # ColorConversion that build_stored_pyramid applies to each tile as it is stored, or None
+        self.colors = None
+        # Frames or pages of the file, counted by the decode of archive members and URLs so the GUI thread does not
+        # have to open them again
+        self.frame_count = 1
+        # Set by band_checksums for decodes of a watched file, None otherwise
+        self.checksums = None
+
+    def size(self):
+        return QtCore.QSize(self.width, self.height)
+
+    def level_count(self):
+        return len(self.level_sizes)
+
+    def level_image(self, level):
+        """
+        Returns the QImage backing a level, downscaling it from the level below the first time it is needed.  This
+        only touches QImages so it is safe to call from a worker thread.
+        :param level:
+        :return:
+        """
+        if self.levels[level] is None:
+            below = self.level_image(level - 1)
+            width, height = self.level_sizes[level]
+            self.levels[level] = below.scaled(width, height, QtCore.Qt.IgnoreAspectRatio,
+                                              QtCore.Qt.SmoothTransformation)
+        return self.levels[level]
+
+    def build_levels(self):
+        for level in range(len(self.levels)):
+            self.level_image(level)
+
+    def band_checksums(self):
+        """
+        Records the CRC-32 of every band of CHECKSUM_ROWS rows of level 0.  They are taken when the pyramid is made,
+        since a memory mapped file that is rewritten in place changes the pixels of the pyramid along with it.
+        :return:
+        """
+        qimage = self.levels[0]
+        bits = qimage.constBits()
+        bits.setsize(qimage.height() * qimage.bytesPerLine())
+        data = memoryview(bits)
+        band = CHECKSUM_ROWS * qimage.bytesPerLine()
+        self.checksums = [zlib.crc32(data[start:start + band]) for start in range(0, len(data), band)]
+
+    def unchanged_rows(self, previous):
+        """
+        Only growth at the bottom is reused: the image has to be taller than previous, and every complete band of
+        previous has to have the same checksum in both
+        :param previous:
+        :return: number of rows of level 0 that are known to be the same in previous
+        """
+        if (previous.checksums is None or self.checksums is None or previous.width != self.width or
+                previous.height >= self.height):
+            return 0
+        bands = 0
+        while bands < previous.height // CHECKSUM_ROWS and previous.checksums[bands] == self.checksums[bands]:
+            bands += 1
+        return bands * CHECKSUM_ROWS
+
+    def extend_levels(self, previous):
+        """
+        Builds the levels of an image that has grown at the bottom since previous was made from it, as a file that
+        is still being written does, downscaling only the rows that are new.  Rows that only depend on unchanged
+        rows of the level below are copied from previous.  adopt_tiles then has to be called on the GUI thread.
+        :param previous: pyramid of an earlier version of the same file, both with band_checksums taken
+        :return:
+        """
+        compatible = (type(previous) is type(self) and previous.levels[0].format() == self.levels[0].format() and
+                      not previous.flipped and not self.flipped)
+        stable = self.unchanged_rows(previous) if compatible else 0
+        self.previous = previous if stable else None
+        self.stable_rows = [stable]
+        for level in range(1, len(self.level_sizes)):
+            stable = self.stable_rows[-1] // 2
+            if (stable == 0 or level >= len(previous.levels) or previous.levels[level] is None or
+                    previous.level_sizes[level][0] != self.level_sizes[level][0]):
+                stable = 0
+                self.level_image(level)
+            else:
+                self.levels[level] = self.extend_level(level, previous.levels[level], stable)
+            self.stable_rows.append(stable)
+
+    def extend_level(self, level, old, stable):
+        width, height = self.level_sizes[level]
+        if stable >= height:
+            return old.copy(0, 0, width, height)
+        below = self.level_image(level - 1)
+        band = below.copy(0, 2 * stable, below.width(), below.height() - 2 * stable)
+        band = band.scaled(width, height - stable, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+        qimage = QtGui.QImage(width, height, QtGui.QImage.Format_ARGB32_Premultiplied)
+        painter = QtGui.QPainter(qimage)
+        painter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+        painter.drawImage(QtCore.QPoint(0, 0), old, QtCore.QRect(0, 0, width, stable))
+        painter.drawImage(QtCore.QPoint(0, stable), band)
+        painter.end()
+        return qimage
+
+    def adopt_tiles(self):
+        """
+        Takes over the tile pixmaps and renditions of the pyramid passed to extend_levels that cover unchanged rows
+        :return:
+        """
+        previous = self.previous
+        if previous is None:
+            return
+        self.previous = None
+        for cache, old in ((self.tiles, previous.tiles), (self.renditions, previous.renditions)):
+            for key, qpixmap in list(old.entries.items()):
+                level, tx, ty = key[:3]
+                if level >= len(self.stable_rows):
+                    continue
+                rect = self.tile_rect(level, tx, ty)
+                if rect.bottom() < self.stable_rows[level] and rect == previous.tile_rect(level, tx, ty):
+                    cache.put(key, qpixmap)
+
+    def level_for(self, magnification):
+        """
+        Picks the coarsest level that still has at least one level pixel per device pixel
+        :param magnification: device pixels per image pixel, as returned by QLabelExtended.get_magnification
+        :return:
+        """
+        if magnification <= 0:
+            return len(self.level_sizes) - 1
+        level = int(math.floor(math.log(1.0 / magnification, 2)))
+        return min(max(level, 0), len(self.level_sizes) - 1)
+
+    def level_scale(self, level):
+        width, height = self.level_sizes[level]
+        return float(self.width) / width, float(self.height) / height
+
+    def visible_tiles(self, level, viewport):
+        """
+        Yields (tx, ty, image_rect) for every tile of a level that intersects viewport
+        :param level:
+        :param viewport: (x, y, width, height) in full resolution image coordinates
+        :return:
+        """
+        width, height = self.level_sizes[level]
+        scale_x, scale_y = self.level_scale(level)
+        span_x = self.tile_size * scale_x
+        span_y = self.tile_size * scale_y
+        columns = (width + self.tile_size - 1) // self.tile_size
+        rows = (height + self.tile_size - 1) // self.tile_size
+
+        first_x = max(int(math.floor(viewport[0] / span_x)), 0)
+        last_x = min(int(math.floor((viewport[0] + viewport[2]) / span_x)), columns - 1)
+        first_y = max(int(math.floor(viewport[1] / span_y)), 0)
+        last_y = min(int(math.floor((viewport[1] + viewport[3]) / span_y)), rows - 1)
+
+        for ty in range(first_y, last_y + 1):
+            for tx in range(first_x, last_x + 1):
+                rect = self.tile_rect(level, tx, ty)
+                yield tx, ty, QtCore.QRectF(rect.x() * scale_x, rect.y() * scale_y,
+                                            rect.width() * scale_x, rect.height() * scale_y)
+
+    def tile_rect(self, level, tx, ty):
+        width, height = self.level_sizes[level]
+        x = tx * self.tile_size
+        y = ty * self.tile_size
+        return QtCore.QRect(x, y, min(self.tile_size, width - x), min(self.tile_size, height - y))
+
+    def tile_image(self, level, tx, ty):
+        rect = self.tile_rect(level, tx, ty)
+        if self.flipped:
+            rect.moveTop(self.level_sizes[level][1] - rect.y() - rect.height())
+            return self.level_image(level).copy(rect).mirrored(False, True)
+        return self.level_image(level).copy(rect)
+
+    def corrected(self, qimage):
+        if self.colors is None:
+            return qimage
+        with profiler.section("color"):
+            return self.colors.convert(qimage)
+
+    def tile(self, level, tx, ty, orientation=IDENTITY):
+        """
+        Returns the QPixmap for a tile, converting it on first use.  QPixmaps may only be made on the GUI thread.
+        :param level:
+        :param tx:
+        :param ty:
+        :param orientation: the tile is rotated and mirrored before it is converted, so drawing it is a plain blit
+        :return:
+        """
+        key = (level, tx, ty) if orientation == IDENTITY else (level, tx, ty, orientation)
+        qpixmap = self.tiles.get(key)
+        if qpixmap is None:
+            profiler.count("tile miss")
+            with profiler.section("upload"):
+                qimage = orient_image(self.tile_image(level, tx, ty), orientation)
+                qpixmap = self.tiles.put(key, QtGui.QPixmap.fromImage(qimage))
+        else:
+            profiler.count("tile hit")
+        return qpixmap
+
+    def rendition(self, level, tx, ty, step, build=True, orientation=IDENTITY):
+        """
+        Returns a tile downscaled ahead of time to 2 ** (step / RENDITION_STEPS) of its size, so drawing it needs
+        almost no filtering
+        :param level:
+        :param tx:
+        :param ty:
+        :param step: quantized log2 of the tile scale
+        :param build: when False only an already cached rendition is returned, otherwise None
+        :param orientation:
+        :return:
+        """
+        key = (level, tx, ty, step) if orientation == IDENTITY else (level, tx, ty, step, orientation)
+        qpixmap = self.renditions.get(key)
+        if qpixmap is None and build:
+            with profiler.section("rendition"):
+                scale = 2 ** (float(step) / RENDITION_STEPS)
+                qimage = self.tile_image(level, tx, ty)
+                qimage = qimage.scaled(max(1, int(round(qimage.width() * scale))),
+                                       max(1, int(round(qimage.height() * scale))),
+                                       QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+                qpixmap = self.renditions.put(key, QtGui.QPixmap.fromImage(orient_image(qimage, orientation)))
+        return qpixmap
+
+    def clear_tiles(self):
+        self.tiles.clear()
+        self.renditions.clear()
+
+    def nbytes(self):
+        """
+        Bytes of process memory held by the pyramid.  A memory mapped level 0 lives in the page cache and is not
+        counted.
+        :return:
+        """
+        levels = self.levels[1:] if self.mapping is not None else self.levels
+        return (sum(image_bytes(qimage) for qimage in levels if qimage is not None) +
+                self.tiles.nbytes + self.renditions.nbytes)
+
+
+class PreviewPyramid(TilePyramid):
+    """
+    Stands in for an image of its full size while only a small preview of it is at hand, so a remembered zoom and
+    pan can be applied before the full decode arrives.  Levels finer than the preview are never used.
+    """
+
+    def __init__(self, preview, width, height, tile_size=512, cache_bytes=64 * 1024 * 1024):
+        self.setup(width, height, tile_size, cache_bytes)
+        self.flipped = False
+        self.mapping = None
+        self.preview = preview
+        self.levels = [None] * len(self.level_sizes)
+        self.preview_level = len(self.level_sizes) - 1
+        for level, (level_width, _) in enumerate(self.level_sizes):
+            if level_width <= preview.width():
+                self.preview_level = level
+                break
+
+    def level_for(self, magnification):
+        return max(TilePyramid.level_for(self, magnification), self.preview_level)
+
+    def level_image(self, level):
+        if self.levels[level] is None:
+            width, height = self.level_sizes[level]
+            self.levels[level] = self.preview.scaled(width, height, QtCore.Qt.IgnoreAspectRatio,
+                                                     QtCore.Qt.SmoothTransformation)
+        return self.levels[level]
+
+
+def compose(first, second):
+    """
+    :param first: orientation applied first
+    :param second: orientation applied to the result
+    :return: the orientation doing both
+    """
+    turns = second[0] - first[0] if second[1] else second[0] + first[0]
+    return turns % 4, first[1] != second[1]
+
+
+def from_transformation(transformation):
+    """
+    :param transformation: QImageIOHandler.Transformations, as QImageReader.transformation reads it from EXIF
+    :return: orientation
+    """
+    flags = int(transformation)
+    mirrored = bool(flags & 1)
+    turns = 0
+    if flags & 2:
+        # A vertical flip is a horizontal mirror turned twice
+        mirrored = not mirrored
+        turns = 2
+    if flags & 4:
+        turns += 1
+    return turns % 4, mirrored
+
+
+def oriented_size(orientation, width, height):
+    return (height, width) if orientation[0] % 2 else (width, height)
+
+
+def orientation_transform(orientation, width, height):
+    """
+    :param orientation:
+    :param width: of the image before it is oriented
+    :param height:
+    :return: QTransform from image coordinates to oriented image coordinates
+    """
+    transform = QtGui.QTransform()
+    if orientation[1]:
+        transform = QtGui.QTransform(-1, 0, 0, 1, width, 0)
+    for _ in range(orientation[0]):
+        transform = transform * QtGui.QTransform(0, 1, -1, 0, height, 0)
+        width, height = height, width
+    return transform
+
+
+def orient_image(qimage, orientation):
+    if orientation == IDENTITY:
+        return qimage
+    if orientation[1]:
+        qimage = qimage.mirrored(True, False)
+    if orientation[0]:
+        # Quarter turns take Qt's memrotate path rather than a general transform
+        qimage = qimage.transformed(QtGui.QTransform().rotate(90 * orientation[0]))
+    return qimage
+
+
+class PixmapCache(object):
+    """
+    LRU of QPixmaps bounded by bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        qpixmap = self.entries.get(key)
+        if qpixmap is not None:
+            self.entries.move_to_end(key)
+        return qpixmap
+
+    def put(self, key, qpixmap):
+        self.entries[key] = qpixmap
+        self.nbytes += pixmap_bytes(qpixmap)
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= pixmap_bytes(evicted)
+        return qpixmap
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+def image_bytes(qimage):
+    if hasattr(qimage, "sizeInBytes"):
+        return qimage.sizeInBytes()
+    return qimage.byteCount()
+
+
+def pixmap_bytes(qpixmap):
+    return qpixmap.width() * qpixmap.height() * max(qpixmap.depth(), 8) // 8
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtGui, QtCore
+from tilepyramid import TilePyramid, image_bytes
+from collections import OrderedDict
+from profiler import profiler
+import tempfile
+import zlib
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+# Decoded size of the bands stored pyramids are built from, unless the caller has a budget of its own
+BAND_BYTES = 256 * 1024 * 1024
+
+
+class TileStore(object):
+    """
+    Holds tile QImages compressed in memory, with LZ4 when it is installed and zlib otherwise.  The least recently
+    used compressed tiles are spilled to a temporary file once they go over memory_bytes, and the most recently used
+    tiles are also kept decoded up to hot_bytes.
+    """
+
+    def __init__(self, memory_bytes=512 * 1024 * 1024, hot_bytes=128 * 1024 * 1024, directory=None):
+        self.memory_bytes = memory_bytes
+        self.hot_bytes = hot_bytes
+        self.directory = directory
+        self.layouts = {}
+        self.compressed = OrderedDict()
+        self.compressed_bytes = 0
+        self.spilled = {}
+        self.spill_file = None
+        self.hot = OrderedDict()
+        self.decoded_bytes = 0
+
+    def put(self, key, qimage):
+        bits = qimage.constBits()
+        bits.setsize(image_bytes(qimage))
+        self.layouts[key] = (qimage.width(), qimage.height(), qimage.bytesPerLine(), qimage.format())
+        self.spilled.pop(key, None)
+        self.store(key, compress(bits.asstring()))
+
+    def store(self, key, data):
+        if key in self.compressed:
+            self.compressed_bytes -= len(self.compressed.pop(key))
+        self.compressed[key] = data
+        self.compressed_bytes += len(data)
+        while self.compressed_bytes > self.memory_bytes and len(self.compressed) > 1:
+            spilled_key, spilled = self.compressed.popitem(last=False)
+            self.compressed_bytes -= len(spilled)
+            self.spill(spilled_key, spilled)
+
+    def spill(self, key, data):
+        if key in self.spilled:
+            # Read back earlier and unchanged since, as put forgets the copy on disk, so the offset still holds
+            return
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix="FeatherView-tiles-", dir=self.directory)
+        # Each tile is written once, so the file grows only with the tiles of the image and is removed when closed
+        self.spill_file.seek(0, 2)
+        self.spilled[key] = (self.spill_file.tell(), len(data))
+        self.spill_file.write(data)
+        profiler.count("tile spilled")
+
+    def get(self, key):
+        qimage = self.hot.get(key)
+        if qimage is not None:
+            self.hot.move_to_end(key)
+            return qimage
+
+        data = self.compressed.get(key)
+        if data is not None:
+            self.compressed.move_to_end(key)
+        else:
+            offset, length = self.spilled[key]
+            self.spill_file.seek(offset)
+            data = self.spill_file.read(length)
+            self.store(key, data)
+        width, height, bytes_per_line, image_format = self.layouts[key]
+        with profiler.section("inflate"):
+            qimage = QtGui.QImage(decompress(data), width, height, bytes_per_line, image_format).copy()
+
+        self.hot[key] = qimage
+        self.decoded_bytes += image_bytes(qimage)
+        while self.decoded_bytes > self.hot_bytes and len(self.hot) > 1:
+            _, evicted = self.hot.popitem(last=False)
+            self.decoded_bytes -= image_bytes(evicted)
+        return qimage
+
+    def nbytes(self):
+        return self.compressed_bytes + self.decoded_bytes
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+
+def compress(data):
+    if lz4 is not None:
+        return lz4.compress(data)
+    return zlib.compress(data, 1)
+
+
+def decompress(data):
+    if lz4 is not None:
+        return lz4.decompress(data)
+    return zlib.decompress(data)
+
+
+class StoredPyramid(TilePyramid):
+    """
+    Tile pyramid whose tiles live in a TileStore instead of whole level QImages, so an image far larger than memory
+    costs its compressed size plus the tiles in use
+    """
+
+    def __init__(self, width, height, store, tile_size=512, cache_bytes=256 * 1024 * 1024):
+        self.setup(width, height, tile_size, cache_bytes)
+        self.flipped = False
+        self.mapping = None
+        self.store = store
+        self.levels = [None] * len(self.level_sizes)
+
+    def build_levels(self):
+        # The levels are built while the tiles are cut, see build_stored_pyramid
+        pass
+
+    def extend_levels(self, previous):
+        pass
+
+    def tile_image(self, level, tx, ty):
+        # Tiles were converted to the display color space before they were stored
+        return self.store.get((level, tx, ty))
+
+    def nbytes(self):
+        return self.store.nbytes() + self.tiles.nbytes + self.renditions.nbytes
+
+
+class PyramidBuilder(object):
+    """
+    Cuts bands of full resolution rows into tiles and feeds every row of tiles, downscaled by two, to the next level,
+    so no level is ever held whole
+    """
+
+    def __init__(self, pyramid):
+        self.pyramid = pyramid
+        self.pending = [None] * pyramid.level_count()
+        self.rows = [0] * pyramid.level_count()
+        self.image_format = None
+
+    def add(self, level, band):
+        if self.image_format is None:
+            self.image_format = (QtGui.QImage.Format_ARGB32_Premultiplied if band.hasAlphaChannel() else
+                                 QtGui.QImage.Format_RGB32)
+        if band.format() != self.image_format:
+            band = band.convertToFormat(self.image_format)
+        pending = stack(self.pending[level], band, self.image_format)
+        tile_size = self.pyramid.tile_size
+        while pending.height() >= tile_size:
+            self.cut(level, pending.copy(0, 0, pending.width(), tile_size), False)
+            pending = pending.copy(0, tile_size, pending.width(), pending.height() - tile_size)
+        self.pending[level] = pending
+
+    def cut(self, level, strip, last):
+        tile_size = self.pyramid.tile_size
+        ty = self.rows[level] // tile_size
+        for tx in range((strip.width() + tile_size - 1) // tile_size):
+            x = tx * tile_size
+            tile = strip.copy(x, 0, min(tile_size, strip.width() - x), strip.height())
+            self.pyramid.store.put((level, tx, ty), self.pyramid.corrected(tile))
+        self.rows[level] += strip.height()
+        if level + 1 < self.pyramid.level_count():
+            # Strips are a whole tile high, which is even, so only the last one can have an odd row left over
+            rows = (strip.height() + 1) // 2 if last else strip.height() // 2
+            self.add(level + 1, strip.scaled(self.pyramid.level_sizes[level + 1][0], rows,
+                                             QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation))
+
+    def finish(self):
+        for level in range(self.pyramid.level_count()):
+            pending = self.pending[level]
+            self.pending[level] = None
+            if pending is not None and pending.height() > 0:
+                self.cut(level, pending, True)
+
+
+def stack(top, bottom, image_format):
+    if top is None or top.height() == 0:
+        return bottom
+    qimage = QtGui.QImage(bottom.width(), top.height() + bottom.height(), image_format)
+    painter = QtGui.QPainter(qimage)
+    painter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+    painter.drawImage(0, 0, top)
+    painter.drawImage(0, top.height(), bottom)
+    painter.end()
+    return qimage
+
+
+def build_stored_pyramid(width, height, read_band, store, band_bytes=BAND_BYTES, tile_size=512,
+                         colors=None):
+    """
+    Builds a StoredPyramid from bands of rows, holding one band at a time
+    :param width:
+    :param height:
+    :param read_band: function (y, rows) returning a QImage of those full resolution rows
+    :param store: TileStore the tiles go to
+    :param band_bytes: approximate size of a decoded band
+    :param tile_size:
+    :param colors: ColorManager the tiles are converted to the display color space with as they are stored, or None
+    :return:
+    """
+    pyramid = StoredPyramid(width, height, store, tile_size)
+    band_rows = max(1, band_bytes // (width * 4) // tile_size) * tile_size
+    builder = PyramidBuilder(pyramid)
+    for y in range(0, height, band_rows):
+        band = read_band(y, min(band_rows, height - y))
+        if band.isNull():
+            return None
+        if y == 0 and colors is not None:
+            pyramid.colors = colors.conversion(band.colorSpace())
+        builder.add(0, band)
+    builder.finish()
+    return pyramid
+
+
+def band_reader(file_name, reader):
+    """
+    Reads bands of rows with clip rect decodes, or cuts them from a single full decode when the format has no
+    clip rect support.  Qt decodes every clip rect from the top of the file, so the bands should be as tall as the
+    memory budget allows: the whole read costs about half a full decode per band.
+    :param file_name:
+    :param reader: QImageReader for file_name that has not been read from yet
+    :return:
+    """
+    width = reader.size().width()
+    if reader.supportsOption(QtGui.QImageIOHandler.ClipRect):
+        def read_band(y, rows):
+            band = QtGui.QImageReader(file_name)
+            band.setClipRect(QtCore.QRect(0, y, width, rows))
+            return band.read()
+        return read_band
+
+    full = reader.read()
+    return lambda y, rows: full.copy(0, y, width, rows)
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtGui
+from tilepyramid import TilePyramid, CHECKSUM_ROWS
+from mappedimage import find_sidecar
+from collections import OrderedDict
+import importlib.util
+import json
+import os
+import zlib
+
+# NumPy is imported by load_numpy once an array or high bit depth image turns up, as importing it would take longer
+# than the rest of the start up
+np = None
+HAVE_NUMPY = importlib.util.find_spec("numpy") is not None
+
+
+GAMMAS = (1.0, 1.8, 2.2, 0.5)
+# Rows of the array read at a time while the coarse levels are built
+BAND_BYTES = 32 * 1024 * 1024
+ARRAY_EXTENSIONS = (".npy", ".exr") if HAVE_NUMPY else ()
+
+
+def load_numpy():
+    """
+    :return: True when NumPy is available, in which case np is set
+    """
+    global np
+    if np is None and HAVE_NUMPY:
+        import numpy
+        np = numpy
+    return np is not None
+
+
+class ToneMap(object):
+    """
+    Window/level and gamma mapping of high bit depth or float samples to 8 bits.  Integer data goes through a
+    lookup table built once per setting, float data through the same arithmetic applied to the whole tile.
+    """
+
+    def __init__(self, black=0., white=1., gamma=1.):
+        self.black = black
+        self.white = white
+        self.gamma = gamma
+        self.tables = {}
+
+    def set(self, black, white, gamma=None):
+        if white <= black:
+            white = black + max(abs(black) * 1e-6, 1e-12)
+        self.black = float(black)
+        self.white = float(white)
+        if gamma is not None:
+            self.gamma = gamma
+        self.tables.clear()
+
+    def auto_contrast(self, samples, low=0.5, high=99.5):
+        """
+        Sets the window to the given percentiles of samples, ignoring NaNs and infinities
+        :param samples: list of arrays, e.g. the raw visible tiles
+        :param low:
+        :param high:
+        :return:
+        """
+        values = np.concatenate([np.asarray(sample, dtype=np.float32).ravel() for sample in samples])
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        black, white = np.percentile(values, [low, high])
+        self.set(black, white)
+
+    def window(self, factor):
+        middle = (self.black + self.white) / 2.
+        span = (self.white - self.black) / 2. * factor
+        self.set(middle - span, middle + span)
+
+    def shift(self, fraction):
+        offset = (self.white - self.black) * fraction
+        self.set(self.black + offset, self.white + offset)
+
+    def cycle_gamma(self):
+        index = GAMMAS.index(self.gamma) if self.gamma in GAMMAS else -1
+        self.set(self.black, self.white, GAMMAS[(index + 1) % len(GAMMAS)])
+
+    def map_float(self, data):
+        scaled = (data.astype(np.float32) - self.black) / (self.white - self.black)
+        np.nan_to_num(scaled, copy=False)
+        np.clip(scaled, 0., 1., out=scaled)
+        if self.gamma != 1.:
+            np.power(scaled, 1. / self.gamma, out=scaled)
+        return (scaled * 255. + 0.5).astype(np.uint8)
+
+    def apply(self, data):
+        if data.dtype in (np.uint8, np.uint16):
+            table = self.tables.get(data.dtype)
+            if table is None:
+                table = self.tables[data.dtype] = self.map_float(np.arange(np.iinfo(data.dtype).max + 1))
+            return table[data]
+        return self.map_float(data)
+
+
+class ArrayPyramid(TilePyramid):
+    """
+    Tile pyramid over a NumPy array of shape (height, width) or (height, width, channels) of any numeric dtype.
+    Tiles of level 0 are slices of the array and each coarser tile averages 2 x 2 blocks of the tiles below it, so
+    only the samples under requested tiles are ever read and noisy data does not alias when zoomed out.  The raw
+    tile samples are cached separately from the tone mapped pixmaps, so changing the tone map only reruns the
+    vectorized mapping for the tiles on screen.  The coarse levels that fit in half the raw budget are averaged
+    whole on the decode thread, in one pass over the array, so a view of the whole image never waits on them.
+    """
+
+    def __init__(self, array, owner=None, resident_bytes=0, tile_size=512, cache_bytes=256 * 1024 * 1024,
+                 raw_bytes=256 * 1024 * 1024):
+        """
+        :param array:
+        :param owner: object owning the memory array views, e.g. a QImage or a memory map
+        :param resident_bytes: process memory held by array itself, zero when it is memory mapped
+        :param tile_size:
+        :param cache_bytes:
+        :param raw_bytes: budget for cached raw tile samples
+        """
+        if array.ndim == 3 and array.shape[2] <= 2:
+            # Grey, or grey with alpha
+            array = array[:, :, 0]
+        elif array.ndim == 3 and array.shape[2] > 3:
+            array = array[:, :, :3]
+        self.setup(array.shape[1], array.shape[0], tile_size, cache_bytes)
+        self.flipped = False
+        self.mapping = None
+        self.array = array
+        self.owner = owner
+        self.resident_bytes = resident_bytes
+        self.raw_tiles = OrderedDict()
+        self.raw_tiles_bytes = 0
+        self.max_raw_bytes = raw_bytes
+        # Level to array of every sample of that level, for the coarse levels built by build_coarse
+        self.coarse = {}
+        self.tone = ToneMap()
+
+    def build_levels(self):
+        # The initial window comes from a sparse sample, whose extremes the averaging has not smoothed away
+        self.tone.auto_contrast([self.sample()])
+        self.build_coarse()
+
+    def build_coarse(self, previous=None, stable=0):
+        """
+        Averages the levels that fit in half of the raw budget, coarsest first, from bands of the array.  Bands are a
+        multiple of 2 ** (levels - 1) rows, so every level comes out as if it had been averaged whole.
+        :param previous: pyramid of an earlier version of the array whose coarse levels are reused, or None
+        :param stable: rows of the array that are unchanged in previous
+        :return:
+        """
+        levels = len(self.level_sizes)
+        channels = self.array.shape[2] if self.array.ndim == 3 else 1
+        kept, total = [], 0
+        for level in range(levels - 1, 0, -1):
+            width, height = self.level_sizes[level]
+            total += width * height * channels * self.array.dtype.itemsize
+            if total > self.max_raw_bytes // 2:
+                break
+            kept.append(level)
+        if not kept:
+            return
+        unit = 2 ** (levels - 1)
+        band = max(1, BAND_BYTES // (unit * self.width * channels * self.array.dtype.itemsize)) * unit
+        parts = dict((level, []) for level in kept)
+        start = 0
+        if previous is not None and len(previous.level_sizes) == levels and all(level in previous.coarse
+                                                                               for level in kept):
+            # Rows of a level below start >> level only average rows of the array that did not change
+            start = stable // band * band
+            for level in kept:
+                parts[level].append(previous.coarse[level][:start >> level])
+        for y in range(start, self.height, band):
+            data = self.array[y:y + band]
+            for level in range(1, levels):
+                data = downsample(data)
+                if level in parts:
+                    parts[level].append(data)
+        self.coarse = dict((level, np.concatenate(parts[level], axis=0)) for level in kept)
+
+    def sample(self):
+        """
+        :return: every 2 ** level samples of the array for the coarsest level, about one tile of them
+        """
+        step = 2 ** (len(self.level_sizes) - 1)
+        return self.array[::step, ::step]
+
+    def band_checksums(self):
+        self.checksums = [zlib.crc32(np.ascontiguousarray(self.array[y:y + CHECKSUM_ROWS]))
+                          for y in range(0, self.height, CHECKSUM_ROWS)]
+
+    def extend_levels(self, previous):
+        """
+        Levels are views of the array, so nothing needs building; the tone map of previous is kept, so a frame
+        that is still being written does not change brightness every time it grows
+        :param previous:
+        :return:
+        """
+        if (not isinstance(previous, ArrayPyramid) or previous.array.dtype != self.array.dtype or
+                previous.array.shape[2:] != self.array.shape[2:]):
+            self.build_levels()
+            return
+        self.tone.set(previous.tone.black, previous.tone.white, previous.tone.gamma)
+        stable = self.unchanged_rows(previous)
+        self.build_coarse(previous if stable else None, stable)
+        if stable == 0:
+            return
+        self.previous = previous
+        # Row r of a level averages rows r * 2 ** level up to (r + 1) * 2 ** level of the array
+        self.stable_rows = [stable // 2 ** level for level in range(len(self.level_sizes))]
+
+    def adopt_tiles(self):
+        previous = self.previous
+        super(ArrayPyramid, self).adopt_tiles()
+        if previous is None:
+            return
+        for key, data in list(previous.raw_tiles.items()):
+            level, tx, ty = key
+            rect = self.tile_rect(level, tx, ty) if level < len(self.stable_rows) else None
+            if rect is not None and rect.bottom() < self.stable_rows[level] and \
+                    rect == previous.tile_rect(level, tx, ty):
+                self.raw_tiles[key] = data
+                self.raw_tiles_bytes += data.nbytes
+
+    def raw_tile(self, level, tx, ty):
+        coarse = self.coarse.get(level)
+        if coarse is not None:
+            rect = self.tile_rect(level, tx, ty)
+            return coarse[rect.y():rect.y() + rect.height(), rect.x():rect.x() + rect.width()]
+
+        key = (level, tx, ty)
+        data = self.raw_tiles.get(key)
+        if data is not None:
+            self.raw_tiles.move_to_end(key)
+            return data
+
+        if level == 0:
+            rect = self.tile_rect(level, tx, ty)
+            data = np.array(self.array[rect.y():rect.y() + rect.height(), rect.x():rect.x() + rect.width()])
+        else:
+            data = downsample(self.tiles_below(level, tx, ty))
+        self.raw_tiles[key] = data
+        self.raw_tiles_bytes += data.nbytes
+        while self.raw_tiles_bytes > self.max_raw_bytes and len(self.raw_tiles) > 1:
+            _, evicted = self.raw_tiles.popitem(last=False)
+            self.raw_tiles_bytes -= evicted.nbytes
+        return data
+
+    def tiles_below(self, level, tx, ty):
+        """
+        :return: the samples of level - 1 under a tile of level, joined from the up to four tiles holding them
+        """
+        width, height = self.level_sizes[level - 1]
+        columns = (width + self.tile_size - 1) // self.tile_size
+        rows = (height + self.tile_size - 1) // self.tile_size
+        return np.concatenate([np.concatenate([self.raw_tile(level - 1, x, y) for x in (2 * tx, 2 * tx + 1)
+                                               if x < columns], axis=1)
+                               for y in (2 * ty, 2 * ty + 1) if y < rows], axis=0)
+
+    def tile_image(self, level, tx, ty):
+        return array_qimage(self.tone.apply(self.raw_tile(level, tx, ty)))
+
+    def visible_samples(self, level, viewport):
+        return [self.raw_tile(level, tx, ty) for tx, ty, _ in self.visible_tiles(level, viewport)]
+
+    def auto_contrast(self, level, viewport):
+        self.tone.auto_contrast(self.visible_samples(level, viewport))
+        self.retone()
+
+    def retone(self):
+        """
+        Drops the tone mapped pixmaps after a change to the tone map; raw samples stay cached
+        :return:
+        """
+        self.tiles.clear()
+        self.renditions.clear()
+
+    def nbytes(self):
+        return (self.resident_bytes + self.raw_tiles_bytes + sum(data.nbytes for data in self.coarse.values()) +
+                self.tiles.nbytes + self.renditions.nbytes)
+
+
+def downsample(data):
+    """
+    Averages 2 x 2 blocks of samples, repeating the last row or column when there is an odd number of them
+    :param data: array of shape (height, width) or (height, width, channels)
+    :return: array of half the size and the same dtype
+    """
+    padding = [(0, data.shape[0] % 2), (0, data.shape[1] % 2)] + [(0, 0)] * (data.ndim - 2)
+    if padding[0][1] or padding[1][1]:
+        data = np.pad(data, padding, mode='edge')
+    blocks = data.reshape((data.shape[0] // 2, 2, data.shape[1] // 2, 2) + data.shape[2:])
+    if data.dtype.kind in 'ui':
+        # Integers stay integers, so 8 and 16-bit data keeps going through the lookup tables of ToneMap
+        return ((blocks.sum(axis=(1, 3), dtype=np.int64) + 2) // 4).astype(data.dtype)
+    return blocks.mean(axis=(1, 3)).astype(data.dtype, copy=False)
+
+
+def array_qimage(data):
+    data = np.ascontiguousarray(data)
+    height, width = data.shape[:2]
+    if data.ndim == 2:
+        image_format = QtGui.QImage.Format_Grayscale8
+    else:
+        image_format = QtGui.QImage.Format_RGB888
+    return QtGui.QImage(data.data, width, height, data.strides[0], image_format).copy()
+
+
+def high_bit_depth(qimage):
+    formats = [getattr(QtGui.QImage, name, None) for name in
+               ("Format_Grayscale16", "Format_RGBX64", "Format_RGBA64", "Format_RGBA64_Premultiplied")]
+    return qimage.format() in formats and load_numpy()
+
+
+def qimage_array(qimage):
+    """
+    Views the samples of a 16-bit QImage as a NumPy array without copying them
+    :param qimage:
+    :return:
+    """
+    bits = qimage.constBits()
+    bits.setsize(qimage.height() * qimage.bytesPerLine())
+    samples = np.frombuffer(bits, np.uint16)
+    if qimage.format() == getattr(QtGui.QImage, "Format_Grayscale16", None):
+        return samples.reshape(qimage.height(), qimage.bytesPerLine() // 2)[:, :qimage.width()]
+    return samples.reshape(qimage.height(), qimage.bytesPerLine() // 8, 4)[:, :qimage.width(), :3]
+
+
+def load_array(file_name, partial=False):
+    """
+    Loads data that QImage cannot represent: NPY files, EXR files when imageio is installed, and raw dumps of
+    16-bit or float samples described by a JSON sidecar
+    :param file_name:
+    :param partial: accept a raw dump that is still being written, keeping only the rows that are complete
+    :return: (array, resident_bytes), or None
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    sidecar = None
+    if extension not in (".npy", ".exr"):
+        sidecar = find_sidecar(file_name)
+        if sidecar is None:
+            return None
+    if not load_numpy():
+        return None
+    if extension == ".npy":
+        return np.load(file_name, mmap_mode='r'), 0
+    if extension == ".exr":
+        try:
+            import imageio
+        except ImportError:
+            return None
+        array = np.asarray(imageio.imread(file_name))
+        return array, array.nbytes
+
+    with open(sidecar, 'r') as file:
+        header = json.load(file)
+    dtype = np.dtype(header.get('dtype', 'uint8')).newbyteorder(header.get('byteorder', '<'))
+    if dtype.itemsize == 1:
+        # 8-bit dumps are shown in place by the memory mapped QImage path
+        return None
+    width = int(header['width'])
+    height = int(header['height'])
+    channels = int(header.get('channels', 1))
+    stride = int(header.get('stride', width * channels * dtype.itemsize))
+    offset = int(header.get('offset', 0))
+    buffer = np.memmap(file_name, dtype=np.uint8, mode='r')
+    row_bytes = width * channels * dtype.itemsize
+    if partial and buffer.size < offset + stride * (height - 1) + row_bytes:
+        height = max(0, (buffer.size - offset - row_bytes) // stride + 1)
+        if height == 0:
+            return None
+    if channels == 1:
+        shape, strides = (height, width), (stride, dtype.itemsize)
+    else:
+        shape, strides = (height, width, channels), (stride, channels * dtype.itemsize, dtype.itemsize)
+    array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset, strides=strides)
+    return array, 0
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtCore
+
+
+class ViewGroup(QtCore.QObject):
+    """
+    Locks zoom and pan across QLabelExtended views.  Whenever one view renders a frame, the others take over its
+    view and render in the same pass, so Qt flushes all of them together instead of each one waiting for its own
+    frame timer.
+    """
+
+    def __init__(self, parent=None):
+        super(ViewGroup, self).__init__(parent)
+        self.views = []
+        self.syncing = False
+
+    def add(self, view):
+        self.views.append(view)
+        view.view_changed.connect(self.changed)
+
+    def remove(self, view):
+        if view in self.views:
+            self.views.remove(view)
+            view.view_changed.disconnect(self.changed)
+
+    @QtCore.pyqtSlot()
+    def changed(self):
+        leader = self.sender()
+        if self.syncing or leader is None or leader.qpixmap_ref() is None:
+            return
+        relative = leader.relative_view()
+        self.syncing = True
+        try:
+            for view in self.views:
+                if view is leader or view.qpixmap_ref() is None:
+                    continue
+                view.set_relative_view(relative)
+                if leader.interacting:
+                    view.interact()
+                view.frame_timer.stop()
+                view.render_frame()
+        finally:
+            self.syncing = False
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from PyQt5 import QtGui, QtCore
+import json
+import os
+import time
+
+
+class ViewStateStore(object):
+    """
+    SQLite table of what was last seen of each file: the zoom and pan, the image size and format and a small
+    preview.  Rows are matched to the file by its size and modification time, so a rewritten file starts afresh.
+    """
+
+    def __init__(self, path, limit=5000):
+        self.path = path
+        self.limit = limit
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            # Imported here, as the config reading below is needed at start up and SQLite is not
+            import sqlite3
+
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS views (path TEXT PRIMARY KEY, modified INTEGER, "
+                                    "bytes INTEGER, width INTEGER, height INTEGER, format TEXT, center_x REAL, "
+                                    "center_y REAL, half_width REAL, preview BLOB, opened REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS views_opened ON views (opened)")
+        return self.connection
+
+    def get(self, file_name):
+        """
+        :param file_name: absolute path
+        :return: dict of the stored columns, with preview as a QImage or None, or None when nothing matches
+        """
+        signature = file_signature(file_name)
+        if signature is None:
+            return None
+        row = self.connect().execute("SELECT width, height, format, center_x, center_y, half_width, preview FROM "
+                                     "views WHERE path = ? AND modified = ? AND bytes = ?",
+                                     (file_name,) + signature).fetchone()
+        if row is None:
+            return None
+        preview = None
+        if row[6] is not None:
+            preview = QtGui.QImage.fromData(row[6])
+            if preview.isNull():
+                preview = None
+        return {"width": row[0], "height": row[1], "format": row[2], "view": (row[3], row[4], row[5]),
+                "preview": preview}
+
+    def put(self, file_name, width, height, image_format, view, preview=None):
+        """
+        Stores the view of a file, keeping the stored preview when none is given
+        :param file_name: absolute path
+        :param width:
+        :param height:
+        :param image_format:
+        :param view: (center_x, center_y, half_width) relative to the image width, see QLabelExtended.relative_view
+        :param preview: QImage, or None
+        :return:
+        """
+        signature = file_signature(file_name)
+        if signature is None:
+            return
+        connection = self.connect()
+        with connection:
+            if preview is None:
+                updated = connection.execute("UPDATE views SET center_x = ?, center_y = ?, half_width = ?, "
+                                             "opened = ? WHERE path = ? AND modified = ? AND bytes = ?",
+                                             tuple(view) + (time.time(), file_name) + signature).rowcount
+                if updated:
+                    return
+            connection.execute("INSERT OR REPLACE INTO views VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (file_name,) + signature + (width, height, image_format) + tuple(view) +
+                               (encode_preview(preview), time.time()))
+            connection.execute("DELETE FROM views WHERE path IN (SELECT path FROM views ORDER BY opened DESC "
+                               "LIMIT -1 OFFSET ?)", (self.limit,))
+
+    def has_preview(self, file_name):
+        signature = file_signature(file_name)
+        if signature is None:
+            return False
+        row = self.connect().execute("SELECT preview IS NOT NULL FROM views WHERE path = ? AND modified = ? AND "
+                                     "bytes = ?", (file_name,) + signature).fetchone()
+        return row is not None and bool(row[0])
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def file_signature(file_name):
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def encode_preview(qimage):
+    if qimage is None or qimage.isNull():
+        return None
+    data = QtCore.QByteArray()
+    buffer = QtCore.QBuffer(data)
+    buffer.open(QtCore.QIODevice.WriteOnly)
+    qimage.save(buffer, "PNG" if qimage.hasAlphaChannel() else "JPG", -1 if qimage.hasAlphaChannel() else 85)
+    buffer.close()
+    return bytes(data)
+
+
+class ConfigSignals(QtCore.QObject):
+    loaded = QtCore.pyqtSignal(object)
+
+
+class ConfigTask(QtCore.QRunnable):
+    """
+    Reads the JSON config off the GUI thread.  A missing or damaged file reads as an empty config.
+    """
+
+    def __init__(self, path, signals):
+        super(ConfigTask, self).__init__()
+        self.path = path
+        self.signals = signals
+
+    def run(self):
+        self.signals.loaded.emit(read_config(self.path))
+
+
+def read_config(path):
+    """
+    :param path:
+    :return: dict of the settings, empty when the file is missing or damaged
+    """
+    try:
+        with open(path, 'r') as file:
+            controls = json.load(file)
+    except (OSError, ValueError):
+        controls = {}
+    if not isinstance(controls, dict):
+        controls = {}
+    return controls